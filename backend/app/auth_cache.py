@@ -0,0 +1,66 @@
+import collections
+import os
+import threading
+import time
+from typing import Any, Hashable, Optional
+
+# --- Configuration ---
+# Also the longest another API process can keep serving a changed user record,
+# since invalidation only reaches the process that made the change
+AUTH_CACHE_TTL_SECONDS = float(os.getenv("AUTH_CACHE_TTL_SECONDS", 60))
+AUTH_CACHE_MAX_USERS = int(os.getenv("AUTH_CACHE_MAX_USERS", 10000))
+AUTH_CACHE_MAX_TOKENS = int(os.getenv("AUTH_CACHE_MAX_TOKENS", 10000))
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries also expire after `ttl` seconds (or their own ttl)."""
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None):
+        ttl = self.ttl if ttl is None else min(ttl, self.ttl)
+        if ttl <= 0 or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Authenticated users (detached, read-only User rows) keyed by token subject
+user_cache = TTLCache(AUTH_CACHE_MAX_USERS, AUTH_CACHE_TTL_SECONDS)
+# Verified claims of recently seen access tokens, never kept past the token's expiry
+token_cache = TTLCache(AUTH_CACHE_MAX_TOKENS, AUTH_CACHE_TTL_SECONDS)
+
+
+def invalidate_user(user_id: int, email: Optional[str] = None):
+    """Drops a user from this process's cache; call after changing the user's row."""
+    user_cache.pop(("id", user_id))
+    if email is not None:
+        user_cache.pop(("email", email))
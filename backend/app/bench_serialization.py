@@ -0,0 +1,108 @@
+"""
+Benchmark of history serialization: ORM objects + Pydantic validation (the
+response_model path) against row tuples + serializers.FastJSONResponse.
+
+    python -m app.bench_serialization [--rows 20000] [--repeat 3]
+
+Runs against a throwaway in-memory SQLite database filled with synthetic
+predictions, checks that both paths produce the same JSON, and prints the
+query and serialization cost per 1,000 rows.
+"""
+import argparse
+import datetime as _dt
+import json
+import random
+import time
+from typing import List
+
+import sqlalchemy as _sql
+import sqlalchemy.orm as _orm
+from pydantic import TypeAdapter
+
+from . import models, schemas, serializers, services
+
+
+def _fill(db: _orm.Session, rows: int):
+    db.add(models.User(id=1, email="bench@example.com", hashed_password="x"))
+    db.execute(_sql.insert(models.Patient), [
+        {"id": i, "owner_id": 1, "patient_id": f"P{i}", "name": f"Patient {i}", "age": 20 + i % 60, "gender": "F"}
+        for i in range(1, 201)
+    ])
+    start = _dt.datetime(2024, 1, 1)
+    db.execute(_sql.insert(models.Prediction), [
+        {
+            "owner_id": 1, "patient_record_id": 1 + i % 200,
+            "predicted_class": random.choice(["glioma", "meningioma", "notumor", "pituitary", "no_tumor"]),
+            "confidence": random.random(), "reason": "Model focus consistent with 'glioma' features.",
+            "image_url": f"ab/cd/{i:032x}.png" if i % 10 else None, "overlay_pending": not i % 10,
+            "model_version": "default", "prediction_timestamp": start + _dt.timedelta(seconds=37 * i),
+        }
+        for i in range(rows)
+    ])
+    db.commit()
+
+
+def _time(fn, repeat: int):
+    best, result = float("inf"), None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def run(rows: int, repeat: int) -> List[dict]:
+    engine = _sql.create_engine("sqlite://")
+    models.Base.metadata.create_all(bind=engine)
+    db = _orm.Session(bind=engine)
+    _fill(db, rows)
+    adapter = TypeAdapter(List[schemas.PredictionWithPatient])
+
+    def orm_query():
+        db.expunge_all()
+        return (
+            db.query(models.Prediction)
+            .options(_orm.joinedload(models.Prediction.patient))
+            .filter(models.Prediction.owner_id == 1)
+            .order_by(models.Prediction.prediction_timestamp.desc(), models.Prediction.id.desc())
+            .all()
+        )
+
+    def pydantic_serialize(objects):
+        # What FastAPI does for response_model: validate, dump to JSON types, json.dumps
+        content = adapter.dump_python(adapter.validate_python(objects, from_attributes=True), mode="json")
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+
+    def row_query():
+        return services.get_predictions_for_user(db, user_id=1, limit=rows)[0]
+
+    def fast_serialize(tuples):
+        return serializers.FastJSONResponse(serializers.predictions_with_patients(tuples)).body
+
+    before_query, objects = _time(orm_query, repeat)
+    before_serialize, before_body = _time(lambda: pydantic_serialize(objects), repeat)
+    after_query, tuples = _time(row_query, repeat)
+    after_serialize, after_body = _time(lambda: fast_serialize(tuples), repeat)
+    if json.loads(before_body) != json.loads(after_body):
+        raise AssertionError("The fast path does not reproduce the response schema")
+
+    per_k = 1000 / rows * 1000  # seconds for `rows` -> milliseconds per 1,000 rows
+    return [
+        {"path": "ORM + Pydantic (before)", "query_ms": before_query * per_k, "serialize_ms": before_serialize * per_k},
+        {"path": "rows + " + ("orjson" if serializers.orjson else "json") + " (after)",
+         "query_ms": after_query * per_k, "serialize_ms": after_serialize * per_k},
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.bench_serialization", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+    print(f"{'per 1,000 rows':<28}{'query ms':>10}{'serialize ms':>14}")
+    for result in run(args.rows, args.repeat):
+        print(f"{result['path']:<28}{result['query_ms']:>10.2f}{result['serialize_ms']:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
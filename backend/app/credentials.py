@@ -0,0 +1,177 @@
+"""
+Refresh tokens and API keys.
+
+Both are random opaque strings of 256 bits, stored only as an HMAC-SHA256
+under CREDENTIAL_HASH_KEY. Secrets that long need no slow hash (that is for
+guessable passwords), so checking one is a keyed hash plus a lookup on a unique
+index; API keys are then kept in auth_cache like access tokens. No request
+after sign-in ever pays for bcrypt.
+
+Refresh tokens rotate: each use replaces the token with a new one of the same
+family. A replaced token that shows up again means it was copied, so the whole
+family is revoked and that sign-in ends for the thief and the owner alike.
+"""
+import datetime as _dt
+import hashlib
+import hmac
+import os
+import secrets
+from typing import List, Optional, Tuple
+
+import sqlalchemy.orm as _orm
+
+from . import auth_cache, database, models
+
+# --- Configuration ---
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", 30))
+# Key of the stored hashes; changing it invalidates every refresh token and API key
+CREDENTIAL_HASH_KEY = (os.getenv("CREDENTIAL_HASH_KEY") or os.getenv("SECRET_KEY") or "").encode()
+API_KEY_PREFIX = "btk_"  # Tells API keys apart from JWT access tokens in the Authorization header
+
+# --- Scopes ---
+# Endpoints declare the scope they need (fastapi.Security); access tokens from
+# /token carry all of them, API keys only those they were created with.
+PREDICT = "predict"
+READ = "read"
+ADMIN = "admin"
+GRANTABLE_SCOPES = (PREDICT, READ, ADMIN)
+# Never granted to an API key: keys cannot create or revoke keys
+MANAGE_KEYS = "api_keys"
+
+
+class InvalidCredential(Exception):
+    pass
+
+
+def credential_hash(secret: str) -> str:
+    return hmac.new(CREDENTIAL_HASH_KEY, secret.encode(), hashlib.sha256).hexdigest()
+
+
+def _utcnow() -> _dt.datetime:
+    return _dt.datetime.utcnow()
+
+
+# --- Refresh Tokens ---
+
+def issue_refresh_token(db: _orm.Session, user_id: int, family: str = None) -> str:
+    """Stores and returns a new refresh token; a new family unless continuing one."""
+    token = secrets.token_urlsafe(32)
+    now = _utcnow()
+    db.add(models.RefreshToken(
+        user_id=user_id, token_hash=credential_hash(token), family=family or secrets.token_hex(16),
+        created_at=now, expires_at=now + _dt.timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS),
+    ))
+    db.commit()
+    return token
+
+
+def revoke_refresh_family(db: _orm.Session, family: str):
+    db.query(models.RefreshToken).filter(
+        models.RefreshToken.family == family, models.RefreshToken.revoked_at.is_(None)
+    ).update({"revoked_at": _utcnow()}, synchronize_session=False)
+    db.commit()
+
+
+def rotate_refresh_token(db: _orm.Session, token: str) -> Tuple[models.User, str]:
+    """
+    Exchanges a refresh token for its successor: (user, new token). Raises
+    InvalidCredential for unknown, expired or revoked tokens, and revokes the
+    family when a token that was already rotated is presented again.
+    """
+    row = db.query(models.RefreshToken).filter(models.RefreshToken.token_hash == credential_hash(token)).first()
+    if row is None or row.revoked_at is not None:
+        raise InvalidCredential("Invalid refresh token")
+    now = _utcnow()
+    if row.expires_at <= now:
+        raise InvalidCredential("Refresh token expired")
+    # Conditional update, so of two concurrent uses only one can win
+    rotated = db.query(models.RefreshToken).filter(
+        models.RefreshToken.id == row.id,
+        models.RefreshToken.replaced_at.is_(None),
+        models.RefreshToken.revoked_at.is_(None),
+    ).update({"replaced_at": now}, synchronize_session=False)
+    if not rotated:
+        db.rollback()
+        revoke_refresh_family(db, row.family)
+        raise InvalidCredential("Refresh token reused; sign in again")
+    user = db.get(models.User, row.user_id)
+    if user is None:
+        db.rollback()
+        raise InvalidCredential("Invalid refresh token")
+    return user, issue_refresh_token(db, row.user_id, family=row.family)  # Commits the rotation too
+
+
+def revoke_refresh_token(db: _orm.Session, token: str) -> bool:
+    """Signs out: revokes the token's whole family. False for an unknown token."""
+    row = db.query(models.RefreshToken).filter(models.RefreshToken.token_hash == credential_hash(token)).first()
+    if row is None:
+        return False
+    revoke_refresh_family(db, row.family)
+    return True
+
+
+# --- API Keys ---
+
+def create_api_key(db: _orm.Session, user: models.User, name: str, scopes: List[str],
+                   expires_at: Optional[_dt.datetime] = None) -> Tuple[models.ApiKey, str]:
+    """Stores a new API key and returns it with the plaintext key, which is shown only once."""
+    unknown = sorted(set(scopes) - set(GRANTABLE_SCOPES))
+    if unknown:
+        raise ValueError(f"Unknown scope(s): {', '.join(unknown)}")
+    if not scopes:
+        raise ValueError("An API key needs at least one scope")
+    if ADMIN in scopes and not user.is_admin:
+        raise ValueError("Only admins can create keys with the admin scope")
+    key = API_KEY_PREFIX + secrets.token_urlsafe(32)
+    db_key = models.ApiKey(
+        user_id=user.id, name=name, key_hash=credential_hash(key), prefix=key[:len(API_KEY_PREFIX) + 6],
+        scopes=" ".join(scope for scope in GRANTABLE_SCOPES if scope in scopes), expires_at=expires_at,
+    )
+    db.add(db_key)
+    db.commit()
+    db.refresh(db_key)
+    return db_key, key
+
+
+def list_api_keys(db: _orm.Session, user_id: int) -> List[models.ApiKey]:
+    return db.query(models.ApiKey).filter(models.ApiKey.user_id == user_id).order_by(models.ApiKey.id).all()
+
+
+def revoke_api_key(db: _orm.Session, user_id: int, key_id: int) -> Optional[models.ApiKey]:
+    """
+    Revokes one of the user's keys, or returns None if there is no such key.
+    Other API processes stop accepting it within AUTH_CACHE_TTL_SECONDS.
+    """
+    db_key = db.query(models.ApiKey).filter(models.ApiKey.id == key_id, models.ApiKey.user_id == user_id).first()
+    if db_key is None:
+        return None
+    if db_key.revoked_at is None:
+        db_key.revoked_at = _utcnow()
+        db.commit()
+    auth_cache.token_cache.pop(("api_key", db_key.key_hash))
+    return db_key
+
+
+def authenticate_api_key(key: str) -> Optional[Tuple[int, frozenset]]:
+    """(user id, scopes) of a valid API key, else None. Valid keys are cached (auth_cache)."""
+    digest = credential_hash(key)
+    cached = auth_cache.token_cache.get(("api_key", digest))
+    if cached is not None:
+        return cached
+    db = database.SessionLocal()
+    try:
+        db_key = db.query(models.ApiKey).filter(
+            models.ApiKey.key_hash == digest, models.ApiKey.revoked_at.is_(None)
+        ).first()
+        if db_key is None:
+            return None
+        ttl = None
+        if db_key.expires_at is not None:
+            ttl = (db_key.expires_at - _utcnow()).total_seconds()
+            if ttl <= 0:
+                return None
+        principal = (db_key.user_id, frozenset(db_key.scopes.split()))
+    finally:
+        db.close()
+    auth_cache.token_cache.set(("api_key", digest), principal, ttl=ttl)
+    return principal
@@ -1,17 +1,56 @@
+import logging
 import os
+import time
 from dotenv import load_dotenv
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables from a .env file
 load_dotenv()
 
 # Get the database URL from the environment variables
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# --- Connection Pool ---
+# Applied to both engines; each uvicorn worker process has its own pools, so the
+# database must accept workers x (2 x (DB_POOL_SIZE + DB_MAX_OVERFLOW) + EXPORT_POOL_SIZE) connections
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))  # Replace connections older than this (seconds)
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() == "true"
+DB_POOL_WARN_UTILIZATION = float(os.getenv("DB_POOL_WARN_UTILIZATION", 0.8))
+# Streaming exports hold a connection for the whole download; they get their own pool of this size
+EXPORT_POOL_SIZE = int(os.getenv("EXPORT_POOL_SIZE", 2))
+
+def _pool_kwargs(url: str):
+    parsed = make_url(url)
+    if parsed.get_backend_name() == "sqlite" and parsed.database in (None, "", ":memory:"):
+        return {}  # In-memory SQLite uses a single-connection pool that takes no sizing
+    return {
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+def async_database_url(url: str) -> str:
+    """The async driver variant of a database URL (asyncpg for PostgreSQL, aiosqlite for SQLite)."""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend == "postgresql":
+        return parsed.set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+    if backend == "sqlite":
+        return parsed.set(drivername="sqlite+aiosqlite").render_as_string(hide_password=False)
+    return url
+
 # Create the SQLAlchemy engine, which is the entry point to our database
-engine = create_engine(DATABASE_URL)
+engine = create_engine(DATABASE_URL, **_pool_kwargs(DATABASE_URL))
 
 # Each instance of the SessionLocal class will be a database session.
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -28,4 +67,115 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def dialect_insert(dialect_name: str):
+    """The dialect's insert() construct, which supports ON CONFLICT upserts (PostgreSQL or SQLite)."""
+    if dialect_name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert
+
+# --- Async Engine (used by the async endpoints) ---
+_async_engine = None
+_AsyncSessionLocal = None
+
+def get_async_engine():
+    """Created on first use, so processes that never need it don't require the async driver."""
+    global _async_engine, _AsyncSessionLocal
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+        _async_engine = create_async_engine(async_database_url(DATABASE_URL), **_pool_kwargs(DATABASE_URL))
+        instrument_pool(_async_engine.sync_engine, "async")
+        # Objects stay readable after commit: async sessions cannot lazy-load expired attributes
+        _AsyncSessionLocal = async_sessionmaker(_async_engine, autoflush=False, expire_on_commit=False)
+    return _async_engine
+
+async def get_async_db():
+    """
+    Async counterpart of get_db. Services written for the sync Session run on
+    it through `await db.run_sync(fn, ...)`, without blocking the event loop.
+    """
+    get_async_engine()
+    async with _AsyncSessionLocal() as db:
+        yield db
+
+async def dispose_async_engine():
+    if _async_engine is not None:
+        await _async_engine.dispose()
+
+# --- Export Engine ---
+_export_engine = None
+_ExportSessionLocal = None
+
+def get_export_session():
+    """
+    A session on the export pool (EXPORT_POOL_SIZE connections, no overflow), so
+    long downloads cannot starve request handlers of connections.
+    """
+    global _export_engine, _ExportSessionLocal
+    if _ExportSessionLocal is None:
+        kwargs = _pool_kwargs(DATABASE_URL)
+        if kwargs:
+            kwargs.update(pool_size=EXPORT_POOL_SIZE, max_overflow=0)
+            _export_engine = create_engine(DATABASE_URL, **kwargs)
+            instrument_pool(_export_engine, "export")
+        else:
+            _export_engine = engine  # In-memory SQLite: another engine would be another database
+        _ExportSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=_export_engine)
+    return _ExportSessionLocal()
+
+# --- Pool Metrics ---
+_pool_stats = {}
+
+def instrument_pool(sync_engine, name: str):
+    """Counts connects, checkouts and invalidations, and warns when the pool nears exhaustion."""
+    stats = _pool_stats[name] = {
+        "engine": sync_engine,
+        "checkouts": 0,
+        "connects": 0,
+        "invalidated": 0,
+        "last_warning": 0.0,
+    }
+
+    @event.listens_for(sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        stats["connects"] += 1
+
+    @event.listens_for(sync_engine, "checkout")
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        stats["checkouts"] += 1
+        status = pool_status(name)
+        if status["utilization"] is not None and status["utilization"] >= DB_POOL_WARN_UTILIZATION:
+            now = time.monotonic()
+            if now - stats["last_warning"] > 60:
+                stats["last_warning"] = now
+                logger.warning("Database pool '%s' is %.0f%% utilized: %s", name, 100 * status["utilization"], status)
+
+    @event.listens_for(sync_engine, "invalidate")
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        stats["invalidated"] += 1
+
+def pool_status(name: str) -> dict:
+    """Current size and usage of an instrumented pool ("sync", "async" or "export")."""
+    stats = _pool_stats[name]
+    pool = stats["engine"].pool
+    status = {"pool": type(pool).__name__, "checkouts": stats["checkouts"], "connects": stats["connects"],
+              "invalidated": stats["invalidated"], "utilization": None}
+    if hasattr(pool, "checkedout"):
+        capacity = pool.size() + max(getattr(pool, "_max_overflow", 0), 0)
+        status.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=max(pool.overflow(), 0),
+            capacity=capacity,
+            utilization=round(pool.checkedout() / capacity, 3) if capacity else None,
+        )
+    return status
+
+def pool_metrics() -> dict:
+    return {name: pool_status(name) for name in _pool_stats}
+
+instrument_pool(engine, "sync")
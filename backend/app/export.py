@@ -0,0 +1,137 @@
+"""
+Streaming prediction exports (CSV or NDJSON) for audits.
+
+Rows are read through a server-side cursor in batches of EXPORT_FETCH_SIZE,
+selecting only the exported columns, and encoded into chunks as they arrive,
+so memory stays flat however many predictions are exported.
+
+The cursor holds a database connection until the download ends, so exports
+use their own pool (database.EXPORT_POOL_SIZE): at most that many run at once
+per worker, and further ones get ExportBusy (503 + Retry-After).
+
+CSV cells starting with a formula character are prefixed with a quote, so a
+patient name like "=HYPERLINK(...)" is shown as text by spreadsheets.
+"""
+import csv
+import datetime as _dt
+import io
+import json
+import os
+from typing import Iterator, Optional
+
+import sqlalchemy as _sql
+
+from . import database, models, services
+
+# --- Configuration ---
+EXPORT_FETCH_SIZE = int(os.getenv("EXPORT_FETCH_SIZE", 2000))  # Rows per server-side cursor fetch
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+COLUMNS = (
+    models.Prediction.id,
+    models.Prediction.prediction_timestamp,
+    models.Prediction.owner_id,
+    models.Patient.patient_id,
+    models.Patient.name.label("patient_name"),
+    models.Patient.age.label("patient_age"),
+    models.Patient.gender.label("patient_gender"),
+    models.Prediction.predicted_class,
+    models.Prediction.confidence,
+    models.Prediction.reason,
+    models.Prediction.model_version,
+    models.Prediction.duplicate_of_id,
+    models.Prediction.result_reused,
+    models.Prediction.image_missing,
+)
+FIELDS = [column.key for column in COLUMNS]
+
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+class ExportBusy(Exception):
+    """Raised when every export connection is streaming."""
+    def __init__(self, detail: str = "Too many exports in progress", retry_after: int = 30):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def export_query(user_id: Optional[int] = None, date_from: Optional[_dt.datetime] = None,
+                 date_to: Optional[_dt.datetime] = None):
+    """Predictions of one user (or all users, in id order) with their patient fields."""
+    query = _sql.select(*COLUMNS).outerjoin(models.Patient, models.Prediction.patient_record_id == models.Patient.id)
+    if user_id is not None:
+        query = query.where(models.Prediction.owner_id == user_id).order_by(
+            models.Prediction.prediction_timestamp, models.Prediction.id  # ix_predictions_owner_timestamp_id
+        )
+    else:
+        query = query.order_by(models.Prediction.id)
+    if date_from is not None:
+        query = query.where(models.Prediction.prediction_timestamp >= services.naive_utc(date_from))
+    if date_to is not None:
+        query = query.where(models.Prediction.prediction_timestamp < services.naive_utc(date_to))
+    return query
+
+
+def open_session():
+    """
+    Checks out an export connection up front, so a full pool is refused before
+    the response starts; the session is closed when iter_export finishes.
+    """
+    db = database.get_export_session()
+    try:
+        db.connection()
+    except _sql.exc.TimeoutError as e:
+        db.close()
+        raise ExportBusy() from e
+    return db
+
+
+def _iter_rows(query, db) -> Iterator:
+    # The session outlives the request handler that returned the stream
+    try:
+        result = db.execute(query.execution_options(stream_results=True, yield_per=EXPORT_FETCH_SIZE))
+        yield from result
+    finally:
+        db.close()
+
+
+def _csv_safe(row):
+    return [
+        "'" + value if isinstance(value, str) and value.startswith(FORMULA_PREFIXES) else value
+        for value in row
+    ]
+
+
+def _json_default(value):
+    if isinstance(value, (_dt.datetime, _dt.date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def iter_export(query, fmt: str, db=None) -> Iterator[bytes]:
+    """
+    Encodes the rows of `query` as CSV (with a header) or NDJSON, in chunks of
+    about EXPORT_CHUNK_BYTES. Reads through `db` (default: open_session()) and closes it.
+    """
+    buffer = io.StringIO()
+    if fmt == "csv":
+        writer = csv.writer(buffer)
+        writer.writerow(FIELDS)
+
+        def write(row):
+            writer.writerow(_csv_safe(row))
+    else:
+        def write(row):
+            buffer.write(json.dumps(dict(zip(FIELDS, row)), default=_json_default))
+            buffer.write("\n")
+    for row in _iter_rows(query, db if db is not None else open_session()):
+        write(row)
+        if buffer.tell() >= EXPORT_CHUNK_BYTES:
+            yield buffer.getvalue().encode()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
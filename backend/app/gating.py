@@ -0,0 +1,364 @@
+"""
+Vectorized no_tumor gating over stored model outputs.
+
+    python -m app.gating regate [--conf-thresh X] [--cam-area-thresh X] [--cam-threshold X] [--dry-run]
+    python -m app.gating sweep --labels labels.csv [--conf 0.3:0.9:0.05] [--cam-area 0,0.005,0.01] [--cam 0.2:0.5:0.05]
+                           [--model-version V]
+
+`regate` re-applies the gating thresholds (ml_services.CONF_THRESH,
+CAM_AREA_THRESH, CAM_THRESHOLD) to every prediction that has stored
+probabilities and a CAM area curve, without running the model. `sweep` scores a
+grid of threshold combinations against a labeled set (a CSV of
+prediction_id,label) to tune them.
+
+Stored probabilities are in the class order of the model version that produced
+them, so each version is read with the label map registered for it (see
+model_registry); predictions of versions no longer registered are skipped.
+"""
+import argparse
+import itertools
+import json
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from . import database, ml_services, model_registry, models, services, stats
+
+FETCH_BATCH_SIZE = 10000
+UPDATE_BATCH_SIZE = 5000
+
+
+def load_classes(model_version: Optional[str] = None) -> List[str]:
+    """
+    Class names in probability order of a registered model version (None, as
+    stored by predictions from before versioning: the default one), without
+    loading the model. Raises KeyError for versions that are not registered.
+    """
+    version = model_version or model_registry.DEFAULT_MODEL_VERSION
+    label_map_path = model_registry.registry.label_map_paths()[version]
+    with open(model_registry.resolve_model_file(label_map_path), "r") as f:
+        return json.load(f)["classes"]
+
+
+def version_filter(model_version: Optional[str]):
+    if model_version is None:
+        return models.Prediction.model_version.is_(None)
+    return models.Prediction.model_version == model_version
+
+
+def classes_by_version(db, filters=()) -> Tuple[Dict[Optional[str], List[str]], List[Optional[str]]]:
+    """
+    The class names of every model version with stored outputs among the
+    predictions matching `filters`, and the versions whose label map is unknown.
+    """
+    versions = (
+        db.query(models.Prediction.model_version)
+        .filter(models.Prediction.probabilities.isnot(None), *filters)
+        .distinct()
+    )
+    classes, unknown = {}, []
+    for (version,) in versions:
+        try:
+            classes[version] = load_classes(version)
+        except (KeyError, ValueError, OSError):
+            unknown.append(version)
+    return classes, unknown
+
+
+class StoredOutputs(NamedTuple):
+    ids: np.ndarray  # (N,) prediction ids
+    predicted_class: np.ndarray  # (N,) stored gated labels (object)
+    reason: np.ndarray  # (N,) stored reasons (object)
+    probs: np.ndarray  # (N, C) calibrated probabilities
+    area_curves: np.ndarray  # (N, 256) uint16, see ml_services.cam_area_curve
+
+
+def load_outputs(db, num_classes: int, filters=()) -> StoredOutputs:
+    """
+    Loads the stored outputs of all predictions matching `filters` into arrays.
+    Blobs are fixed width, so each column becomes one frombuffer over the
+    concatenated bytes. Rows scored with a different class count are skipped.
+    """
+    query = (
+        db.query(
+            models.Prediction.id, models.Prediction.predicted_class, models.Prediction.reason,
+            models.Prediction.probabilities, models.Prediction.cam_area_curve,
+        )
+        .filter(
+            models.Prediction.probabilities.isnot(None),
+            models.Prediction.cam_area_curve.isnot(None),
+            *filters,
+        )
+        .order_by(models.Prediction.id)
+        .execution_options(yield_per=FETCH_BATCH_SIZE)
+    )
+    ids, labels, reasons, probs, curves = [], [], [], [], []
+    prob_width = 4 * num_classes
+    for row in query:
+        if len(row.probabilities) != prob_width:
+            continue
+        ids.append(row.id)
+        labels.append(row.predicted_class)
+        reasons.append(row.reason)
+        probs.append(row.probabilities)
+        curves.append(row.cam_area_curve)
+    return StoredOutputs(
+        ids=np.array(ids, dtype=np.int64),
+        predicted_class=np.array(labels, dtype=object),
+        reason=np.array(reasons, dtype=object),
+        probs=ml_services.decode_probabilities(b"".join(probs)).reshape(len(ids), num_classes),
+        area_curves=ml_services.decode_area_curve(b"".join(curves)).reshape(len(ids), 256),
+    )
+
+
+class GateResult(NamedTuple):
+    label: np.ndarray  # (N,) final labels (object)
+    is_no_tumor: np.ndarray  # (N,) bool
+    reason: np.ndarray  # (N,) reasons (object)
+
+
+def gate_arrays(probs: np.ndarray, area_curves: np.ndarray, classes: List[str],
+                conf_thresh: float = None, cam_area_thresh: float = None,
+                cam_threshold: float = None) -> GateResult:
+    """
+    ml_services.gate_prediction over N predictions at once. Labels and reasons
+    come from gate_prediction itself, called once per distinct outcome, so they
+    match the live path exactly.
+    """
+    conf_thresh = ml_services.CONF_THRESH if conf_thresh is None else conf_thresh
+    cam_area_thresh = ml_services.CAM_AREA_THRESH if cam_area_thresh is None else cam_area_thresh
+    cam_threshold = ml_services.CAM_THRESHOLD if cam_threshold is None else cam_threshold
+
+    pred_idx = probs.argmax(axis=1)
+    confidence = probs[np.arange(len(probs)), pred_idx]
+    low_conf = confidence < conf_thresh
+    tiny_area = ml_services.cam_area_fraction(area_curves, cam_threshold) < cam_area_thresh
+
+    # Outcome code: predicted class x low confidence x tiny area
+    codes = pred_idx * 4 + low_conf * 2 + tiny_area
+    gated = [
+        ml_services.gate_prediction(
+            classes[code // 4],
+            # Any value on the right side of each threshold gives the same outcome
+            conf_thresh - 1.0 if code & 2 else conf_thresh,
+            cam_area_thresh - 1.0 if code & 1 else cam_area_thresh,
+            conf_thresh, cam_area_thresh,
+        )
+        for code in range(len(classes) * 4)
+    ]
+    labels = np.array([g[0] for g in gated], dtype=object)
+    no_tumor = np.array([g[1] for g in gated], dtype=bool)
+    reasons = np.array([g[2] for g in gated], dtype=object)
+    return GateResult(label=labels[codes], is_no_tumor=no_tumor[codes], reason=reasons[codes])
+
+
+def regate(db, conf_thresh: float = None, cam_area_thresh: float = None,
+           cam_threshold: float = None, dry_run: bool = False) -> dict:
+    """
+    Re-gates all stored predictions and bulk-updates the ones whose label or
+    reason changed. Predictions that flipped to or from no_tumor get their
+    overlay marked pending, since the focus circle colour depends on the gate.
+    """
+    version_classes, unknown = classes_by_version(db)
+    report = {"rows": 0, "changed": 0, "to_no_tumor": 0, "from_no_tumor": 0, "skipped_versions": unknown}
+    labels_changed = False
+    for version, classes in version_classes.items():
+        stored = load_outputs(db, len(classes), filters=(version_filter(version),))
+        result = gate_arrays(stored.probs, stored.area_curves, classes, conf_thresh, cam_area_thresh, cam_threshold)
+
+        changed = (result.label != stored.predicted_class) | (result.reason != stored.reason)
+        was_no_tumor = stored.predicted_class == "no_tumor"  # gate_prediction's label for every no_tumor outcome
+        flipped = result.is_no_tumor != was_no_tumor
+        report["rows"] += int(len(stored.ids))
+        report["changed"] += int(changed.sum())
+        report["to_no_tumor"] += int((flipped & result.is_no_tumor).sum())
+        report["from_no_tumor"] += int((flipped & ~result.is_no_tumor).sum())
+        if dry_run or not changed.any():
+            continue
+
+        idx = np.flatnonzero(changed)
+        for start in range(0, len(idx), UPDATE_BATCH_SIZE):
+            mappings = []
+            for i in idx[start:start + UPDATE_BATCH_SIZE]:
+                mapping = {"id": int(stored.ids[i]), "predicted_class": result.label[i], "reason": result.reason[i]}
+                if flipped[i]:
+                    mapping.update(image_url=None, overlay_pending=True)
+                mappings.append(mapping)
+            db.bulk_update_mappings(models.Prediction, mappings)
+            db.commit()
+        labels_changed |= bool((result.label != stored.predicted_class).any())
+    if report["changed"] and not dry_run:
+        services.bump_history_revision(db)
+        db.commit()
+        if labels_changed:
+            stats.backfill(db)  # Class counts moved between rollup rows
+    return report
+
+
+# --- Threshold Sweep ---
+def read_labels(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads a CSV with prediction_id and label columns (label: a class name or
+    no_tumor) into (ids, labels) arrays; a repeated id keeps its last label.
+    """
+    table = np.genfromtxt(path, delimiter=",", names=True, dtype=None, encoding="utf-8", autostrip=True, ndmin=1)
+    ids = np.asarray(table["prediction_id"], dtype=np.int64)
+    labels = np.asarray(table["label"], dtype=str)
+    # np.unique keeps the first occurrence, so look for it from the end
+    _, last = np.unique(ids[::-1], return_index=True)
+    keep = len(ids) - 1 - last
+    return ids[keep], labels[keep]
+
+
+def parse_grid(spec: str) -> np.ndarray:
+    """"start:stop:step" (inclusive) or a comma-separated list of values."""
+    if ":" in spec:
+        start, stop, step = (float(v) for v in spec.split(":"))
+        return np.round(np.arange(start, stop + step / 2, step), 6)
+    return np.array([float(v) for v in spec.split(",")])
+
+
+def sweep(probs: np.ndarray, area_curves: np.ndarray, truth: np.ndarray, classes: List[str],
+          conf_grid: np.ndarray, cam_area_grid: np.ndarray, cam_grid: np.ndarray,
+          baseline: Optional[np.ndarray] = None) -> List[dict]:
+    """
+    Evaluates every (conf, cam area, cam threshold) combination at once.
+    `truth` holds class indexes into `classes`; gated no_tumor outcomes count as
+    the "no" class. Returns per combination the per-class sensitivity and
+    specificity, accuracy, and the fraction of predictions whose gated class
+    differs from `baseline` (by default, the gate at the current thresholds).
+    """
+    C, N = len(classes), len(probs)
+    no_idx = next(i for i, label in enumerate(classes) if "no" in label.lower())
+    pred_idx = probs.argmax(axis=1)
+    confidence = probs[np.arange(N), pred_idx]
+    pred_no = pred_idx == no_idx
+    if baseline is None:
+        baseline = np.where(gate_arrays(probs, area_curves, classes).is_no_tumor, no_idx, pred_idx)
+
+    low_conf = confidence[None, :] < conf_grid[:, None]  # (K1, N)
+    combos = len(conf_grid) * len(cam_area_grid)
+    offsets = (np.arange(combos) * C * C)[:, None]
+    results = []
+    for cam_threshold in cam_grid:
+        area = ml_services.cam_area_fraction(area_curves, cam_threshold)
+        tiny = area[None, :] < cam_area_grid[:, None]  # (K2, N)
+        final_no = pred_no | low_conf[:, None, :] | tiny[None, :, :]  # (K1, K2, N)
+        final = np.where(final_no, no_idx, pred_idx).reshape(combos, N)
+
+        # One bincount yields the confusion matrix of every combination
+        cells = offsets + truth[None, :] * C + final
+        confusion = np.bincount(cells.ravel(), minlength=combos * C * C).reshape(combos, C, C)
+        tp = np.diagonal(confusion, axis1=1, axis2=2)
+        actual, predicted = confusion.sum(axis=2), confusion.sum(axis=1)
+        fn, fp = actual - tp, predicted - tp
+        tn = N - tp - fn - fp
+        with np.errstate(invalid="ignore", divide="ignore"):
+            sensitivity = tp / actual
+            specificity = tn / (tn + fp)
+        accuracy = tp.sum(axis=1) / N
+        flip_rate = (final != baseline[None, :]).mean(axis=1)
+
+        for k, (conf, cam_area) in enumerate(itertools.product(conf_grid, cam_area_grid)):
+            results.append({
+                "conf_thresh": float(conf),
+                "cam_area_thresh": float(cam_area),
+                "cam_threshold": float(cam_threshold),
+                "accuracy": round(float(accuracy[k]), 4),
+                "flip_rate": round(float(flip_rate[k]), 4),
+                "per_class": {
+                    label: {
+                        "sensitivity": None if np.isnan(sensitivity[k, c]) else round(float(sensitivity[k, c]), 4),
+                        "specificity": None if np.isnan(specificity[k, c]) else round(float(specificity[k, c]), 4),
+                    }
+                    for c, label in enumerate(classes)
+                },
+            })
+    return results
+
+
+def run_sweep(db, labels_path: str, conf_grid: np.ndarray, cam_area_grid: np.ndarray, cam_grid: np.ndarray,
+              model_version: Optional[str] = None):
+    label_ids, label_names = read_labels(labels_path)  # Sorted by id
+    # Only the labelled predictions are read, in chunks that stay under bind-parameter limits
+    id_filters = [
+        models.Prediction.id.in_(label_ids[i:i + FETCH_BATCH_SIZE].tolist())
+        for i in range(0, len(label_ids), FETCH_BATCH_SIZE)
+    ]
+    version_filters = () if model_version is None else (version_filter(model_version),)
+    version_classes = {}
+    for id_filter in id_filters:
+        found, unknown = classes_by_version(db, (id_filter, *version_filters))
+        if unknown:
+            raise SystemExit(f"No registered label map for model version(s): {', '.join(map(str, unknown))}")
+        version_classes.update(found)
+    class_lists = {tuple(classes) for classes in version_classes.values()}
+    if len(class_lists) > 1:
+        raise SystemExit(
+            f"The labeled predictions come from model versions with different classes "
+            f"({', '.join(map(str, version_classes))}); pick one with --model-version"
+        )
+    if not class_lists:
+        raise SystemExit("None of the labeled predictions have stored model outputs")
+    classes = list(class_lists.pop())
+    chunks = [
+        load_outputs(db, len(classes), filters=(id_filter, *version_filters))
+        for id_filter in id_filters
+    ]
+    stored = StoredOutputs(*(np.concatenate(column) for column in zip(*chunks)))
+    if not len(stored.ids):
+        raise SystemExit("None of the labeled predictions have stored model outputs")
+
+    # Map the few distinct label names to class indices, then every row through the inverse index
+    names, inverse = np.unique(label_names[np.searchsorted(label_ids, stored.ids)], return_inverse=True)
+    no_idx = next(i for i, label in enumerate(classes) if "no" in label.lower())
+    class_index = {label: i for i, label in enumerate(classes)}
+    unknown = [n for n in names if n not in class_index and "no" not in n.lower()]
+    if unknown:
+        raise SystemExit(f"Unknown labels: {', '.join(unknown)} (expected one of {classes})")
+    truth = np.array([class_index.get(n, no_idx) for n in names], dtype=np.int64)[inverse]
+    return sweep(stored.probs, stored.area_curves, truth, classes, conf_grid, cam_area_grid, cam_grid)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(prog="python -m app.gating", description=__doc__.strip().splitlines()[0])
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    regate_parser = subcommands.add_parser("regate", help="re-apply gating thresholds to stored predictions")
+    regate_parser.add_argument("--conf-thresh", type=float, default=ml_services.CONF_THRESH)
+    regate_parser.add_argument("--cam-area-thresh", type=float, default=ml_services.CAM_AREA_THRESH)
+    regate_parser.add_argument("--cam-threshold", type=float, default=ml_services.CAM_THRESHOLD)
+    regate_parser.add_argument("--dry-run", action="store_true", help="report changes without writing them")
+    sweep_parser = subcommands.add_parser("sweep", help="score a grid of thresholds against labeled predictions")
+    sweep_parser.add_argument("--labels", required=True, help="CSV with prediction_id,label columns")
+    sweep_parser.add_argument("--conf", default="0.3:0.9:0.05", help="CONF_THRESH grid")
+    sweep_parser.add_argument("--cam-area", default="0,0.0025,0.005,0.01,0.02,0.05", help="CAM_AREA_THRESH grid")
+    sweep_parser.add_argument("--cam", default="0.2:0.5:0.05", help="CAM_THRESHOLD grid")
+    sweep_parser.add_argument("--model-version", help="only predictions of this model version")
+    sweep_parser.add_argument("--top", type=int, default=10, help="print the N most accurate combinations")
+    sweep_parser.add_argument("--output", help="write every combination as JSON to this file")
+    args = parser.parse_args(argv)
+
+    db = database.SessionLocal()
+    try:
+        if args.command == "regate":
+            print(json.dumps(regate(db, args.conf_thresh, args.cam_area_thresh, args.cam_threshold, args.dry_run), indent=2))
+            return
+        results = run_sweep(db, args.labels, parse_grid(args.conf), parse_grid(args.cam_area), parse_grid(args.cam),
+                            args.model_version)
+    finally:
+        db.close()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    best = sorted(results, key=lambda r: (-r["accuracy"], r["flip_rate"]))[:args.top]
+    print(f"{'conf':>6} {'area':>7} {'cam':>5} {'acc':>7} {'flips':>7}  sensitivity / specificity per class")
+    for r in best:
+        per_class = "  ".join(
+            f"{label}={m['sensitivity']}/{m['specificity']}" for label, m in r["per_class"].items()
+        )
+        print(f"{r['conf_thresh']:>6} {r['cam_area_thresh']:>7} {r['cam_threshold']:>5} "
+              f"{r['accuracy']:>7} {r['flip_rate']:>7}  {per_class}")
+
+
+if __name__ == "__main__":
+    main()
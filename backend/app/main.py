@@ -1,22 +1,33 @@
-import uuid
+import asyncio
+import functools
+import time
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List
-from fastapi import FastAPI, Depends, HTTPException, status, File, UploadFile, Form
+from typing import List, Optional
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Security, status, File, UploadFile, Form
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import FileResponse, JSONResponse, RedirectResponse, Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
+from starlette.background import BackgroundTask
 from fastapi.security import OAuth2PasswordRequestForm
 import sqlalchemy.orm as orm
-from . import models, database, schemas, services, ml_services
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import models, database, schemas, services, ml_services, scheduler, migrations, volumes, vector_index, storage, write_behind, stats, export, serializers, passwords, credentials
+from .model_registry import VersionExists, registry
 
 # This command tells SQLAlchemy to create all the tables
 models.Base.metadata.create_all(bind=database.engine)
 
-# Create a directory for uploads if it doesn't exist
-Path("uploads").mkdir(exist_ok=True)
 
 # Initialize the FastAPI app
 app = FastAPI(title="Brain Tumor Detection API")
 
+# Size limit and queue check for inference uploads, before FastAPI reads the body
+app.add_middleware(
+    scheduler.UploadAdmissionMiddleware,
+    limits={"/predict/image": scheduler.MAX_UPLOAD_BYTES, "/predict/volume": volumes.MAX_VOLUME_BYTES},
+)
+
 # CORS Middleware
 origins = [
     "http://localhost",
@@ -28,50 +39,223 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "X-Sync-Cursor", "ETag"],
 )
 
-app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
 @app.on_event("startup")
 def on_startup():
-    database.Base.metadata.create_all(bind=database.engine)
+    migrations.upgrade(database.engine)
+
+@app.on_event("startup")
+async def start_scheduler():
+    await scheduler.inference_scheduler.start()
+
+@app.on_event("shutdown")
+async def stop_scheduler():
+    await scheduler.inference_scheduler.stop()
+
+@app.on_event("startup")
+async def load_models():
+    # Load the serving (and shadow) models up front rather than on the first request
+    await run_in_threadpool(registry.serving)
+    registry.watch()
+
+@app.on_event("shutdown")
+def stop_model_registry():
+    registry.stop()
+
+@app.on_event("startup")
+async def start_prediction_writer():
+    if write_behind.PREDICTION_WRITE_BEHIND:
+        await write_behind.prediction_writer.start()
+
+@app.on_event("shutdown")
+def stop_password_hashing():
+    passwords.shutdown()
+
+@app.on_event("shutdown")
+async def close_database():
+    await write_behind.prediction_writer.stop()  # Flush queued writes before the pools close
+    await database.dispose_async_engine()
+
+def load_embedding_index():
+    db = database.SessionLocal()
+    try:
+        vector_index.embedding_index.load(lambda after_id: services.iter_embeddings(db, after_id=after_id))
+    finally:
+        db.close()
+
+@app.on_event("startup")
+async def start_embedding_index():
+    # Loaded in the background; similarity search fills in as the catch-up progresses.
+    # New predictions are held back until it finishes (see EmbeddingIndex.load)
+    vector_index.embedding_index.begin_load()
+    asyncio.get_running_loop().run_in_executor(None, load_embedding_index)
+
+@app.on_event("shutdown")
+def save_embedding_index():
+    vector_index.embedding_index.save()
+
+@app.exception_handler(scheduler.InferenceRejected)
+def inference_rejected_handler(request: Request, exc: scheduler.InferenceRejected):
+    # 503 + Retry-After tells clients (and the proxy) to back off instead of piling on
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.exception_handler(passwords.HashingBusy)
+def hashing_busy_handler(request: Request, exc: passwords.HashingBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+@app.exception_handler(export.ExportBusy)
+def export_busy_handler(request: Request, exc: export.ExportBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": exc.detail},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the Brain Tumor Detection API"}
 
-@app.post("/token")
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: orm.Session = Depends(database.get_db)):
-    user = services.authenticate_user(db, email=form_data.username, password=form_data.password)
+@app.post("/token", response_model=schemas.Token)
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(database.get_async_db)):
+    user = await services.authenticate_user(db, email=form_data.username, password=form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
-    access_token = services.create_access_token(data={"sub": user.email})
-    return {"access_token": access_token, "token_type": "bearer"}
+    access_token = services.create_access_token(data={"sub": user.email, "uid": user.id})
+    refresh_token = await db.run_sync(credentials.issue_refresh_token, user.id)
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@app.post("/token/refresh", response_model=schemas.Token)
+def refresh_access_token(body: schemas.RefreshRequest, db: orm.Session = Depends(database.get_db)):
+    """Exchanges a refresh token for a new access token and a new refresh token (the old one is spent)."""
+    try:
+        user, refresh_token = credentials.rotate_refresh_token(db, body.refresh_token)
+    except credentials.InvalidCredential as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e))
+    access_token = services.create_access_token(data={"sub": user.email, "uid": user.id})
+    return {"access_token": access_token, "token_type": "bearer", "refresh_token": refresh_token}
+
+@app.post("/token/revoke", status_code=status.HTTP_204_NO_CONTENT)
+def revoke_refresh_token(body: schemas.RefreshRequest, db: orm.Session = Depends(database.get_db)):
+    """Signs out: the refresh token and every token rotated from the same sign-in stop working."""
+    credentials.revoke_refresh_token(db, body.refresh_token)
 
 @app.get("/users/me", response_model=schemas.User)
 def read_users_me(current_user: models.User = Depends(services.get_current_user)):
     return current_user
 
+# --- API Keys ---
+@app.post("/users/me/api-keys", response_model=schemas.ApiKeyCreated, status_code=status.HTTP_201_CREATED)
+def create_api_key(
+    body: schemas.ApiKeyCreate,
+    db: orm.Session = Depends(database.get_db),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.MANAGE_KEYS]),
+):
+    """Creates a scoped API key for machine clients (sent as a bearer token). The key is only shown in this response."""
+    expires_at = None
+    if body.expires_in_days is not None:
+        expires_at = datetime.utcnow() + timedelta(days=body.expires_in_days)
+    try:
+        db_key, key = credentials.create_api_key(db, current_user, body.name, body.scopes, expires_at)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    db_key.key = key  # Not a column: only this response ever carries the plaintext key
+    return db_key
+
+@app.get("/users/me/api-keys", response_model=List[schemas.ApiKey])
+def read_api_keys(
+    db: orm.Session = Depends(database.get_db),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.MANAGE_KEYS]),
+):
+    return credentials.list_api_keys(db, current_user.id)
+
+@app.delete("/users/me/api-keys/{key_id}", status_code=status.HTTP_204_NO_CONTENT)
+def revoke_api_key(
+    key_id: int,
+    db: orm.Session = Depends(database.get_db),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.MANAGE_KEYS]),
+):
+    if credentials.revoke_api_key(db, current_user.id, key_id) is None:
+        raise HTTPException(status_code=404, detail="API key not found")
+
+def _default_priority(request: Request) -> str:
+    # API keys belong to scripted uploaders: bulk unless they ask for interactive
+    token = request.headers.get("authorization", "").partition(" ")[2]
+    return scheduler.BULK if token.startswith(credentials.API_KEY_PREFIX) else scheduler.INTERACTIVE
+
 # --- PREDICT ENDPOINT (CHANGED) ---
 @app.post("/predict/image") # Removed response_model to allow for multiple response types
 async def predict_image(
+    request: Request,
     patient_id: str = Form(...),
     name: str = Form(...),
     age: int = Form(...),
     gender: str = Form(...),
     force_predict: bool = Form(False), # Added force_predict flag
+    priority: Optional[str] = Form(None), # "bulk" for scripted uploads; the default depends on the credential
+    reuse_duplicate: Optional[bool] = Form(None), # Return the earlier result for a near-identical scan
     image: UploadFile = File(...),
-    db: orm.Session = Depends(database.get_db),
-    current_user: models.User = Depends(services.get_current_user),
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.PREDICT]),
 ):
+    priority = priority or _default_priority(request)
+    if priority not in scheduler.PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(scheduler.PRIORITIES)}")
+    # Per-user and per-class admission; the global queue check and the size limit
+    # already ran in UploadAdmissionMiddleware, before the body was read
+    scheduler.inference_scheduler.ensure_capacity(user=current_user.id, priority=priority)
+    if image.size is not None and image.size > scheduler.MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Image is too large.")
+
     image_bytes = await image.read()
+    try:
+        # Decoded once: the hash and the model both work from this array
+        img, phash = await run_in_threadpool(ml_services.decode_and_hash, image_bytes)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # Re-submissions of the same slice (re-exported, re-encoded) are recognized by their perceptual hash
+    duplicate = await db.run_sync(
+        services.find_near_duplicate,
+        user_id=current_user.id, patient_id=patient_id, phash=phash, max_distance=ml_services.PHASH_MAX_DISTANCE,
+    )
+    if reuse_duplicate is None:
+        reuse_duplicate = ml_services.PHASH_REUSE_RESULTS
+    patient_schema = schemas.PatientCreate(patient_id=patient_id, name=name, age=age, gender=gender)
+    if duplicate is not None and reuse_duplicate:
+        db_prediction = await write_behind.store_prediction(
+            db, patient_schema, services.reused_prediction_values(duplicate, phash)
+        )
+        await run_in_threadpool(
+            vector_index.embedding_index.add, db_prediction.id, current_user.id, db_prediction.embedding
+        )
+        return schemas.Prediction.model_validate(db_prediction, from_attributes=True)
+    # End the read transaction so the connection goes back to the pool while the scan waits for the model
+    await db.commit()
+
     try:
         # Pass the force_predict flag to the service
-        inference_result = ml_services.run_inference(image_bytes, force_predict=force_predict)
+        inference_result = await scheduler.inference_scheduler.submit(
+            functools.partial(ml_services.run_inference, image_bytes, force_predict=force_predict, img=img),
+            is_disconnected=request.is_disconnected,
+            user=current_user.id,
+            priority=priority,
+            max_running=current_user.max_concurrent_inferences,
+        )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -80,39 +264,360 @@ async def predict_image(
         return inference_result
 
     # If it's a full prediction, proceed as before
-    unique_id = uuid.uuid4()
-    image_filename = f"{unique_id}.png"
-    image_path = Path("uploads") / image_filename
-    with open(image_path, "wb") as f:
-        f.write(inference_result["overlay_image_bytes"])
-    
-    patient_schema = schemas.PatientCreate(patient_id=patient_id, name=name, age=age, gender=gender)
-    db_patient = services.create_patient(db, patient_schema)
+    store = storage.get_storage()
+    # The original is always kept: with the stored CAM it re-renders the overlay without the model
+    if inference_result["original_image_bytes"] is not None:
+        # Single-channel copy of a color-encoded grayscale scan
+        original_key = storage.content_key(inference_result["original_image_bytes"], ".png")
+        await store.put(original_key, inference_result["original_image_bytes"], "image/png")
+    else:
+        original_key = storage.content_key(image_bytes, Path(image.filename or "").suffix)
+        await store.put(original_key, image_bytes, image.content_type or "application/octet-stream")
+    image_key = None
+    if not inference_result["overlay_pending"]:
+        image_key = storage.content_key(inference_result["overlay_image_bytes"], ".png")
+        await store.put(image_key, inference_result["overlay_image_bytes"], "image/png")
 
     prediction_schema = schemas.PredictionCreate(
         predicted_class=inference_result["prediction"]["class"],
         confidence=inference_result["prediction"]["confidence"],
         reason=inference_result["reason"],
-        image_url=str(image_path)
+        image_url=image_key,
+        overlay_pending=inference_result["overlay_pending"],
+        duplicate_of_id=duplicate.id if duplicate is not None else None,
+        model_version=inference_result["model_version"],
+    )
+    prediction_values = services.prediction_values(
+        prediction_schema,
+        user_id=current_user.id,
+        original_url=original_key,
+        embedding=inference_result["embedding"],
+        phash=phash,
+        outputs={column: inference_result[column] for column in services.OUTPUT_COLUMNS},
     )
-    return services.create_prediction(
-        db, 
-        prediction=prediction_schema, 
-        user_id=current_user.id, 
-        patient_id=db_patient.id
+    db_prediction = await write_behind.store_prediction(db, patient_schema, prediction_values)
+    await run_in_threadpool(
+        vector_index.embedding_index.add, db_prediction.id, current_user.id, db_prediction.embedding
     )
+    # Serialize through the schema so internal columns (embedding, ...) stay out of the response
+    return schemas.Prediction.model_validate(db_prediction, from_attributes=True)
+
+@app.post("/predictions/{prediction_id}/overlay", response_model=schemas.Prediction)
+async def render_prediction_overlay(
+    prediction_id: int,
+    request: Request,
+    alpha: Optional[float] = Query(None, ge=0.0, le=1.0),
+    colormap: Optional[str] = Query(None),
+    db: AsyncSession = Depends(database.get_async_db),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.PREDICT]),
+):
+    """
+    Renders the overlay of a prediction whose overlay is pending, or re-renders it
+    in another style (alpha, colormap). Predictions with a stored CAM are drawn
+    without the model; older ones go through the inference queue.
+    """
+    db_prediction = await db.run_sync(
+        services.get_prediction_for_user, prediction_id=prediction_id, user_id=current_user.id
+    )
+    if db_prediction is None:
+        raise HTTPException(status_code=404, detail="Prediction not found")
+    await db.commit()  # Don't hold a pooled connection through storage reads and rendering
+    if colormap is not None and colormap not in ml_services.COLORMAPS:
+        raise HTTPException(status_code=400, detail=f"colormap must be one of {sorted(ml_services.COLORMAPS)}")
+    restyle = alpha is not None or colormap is not None
+    if not db_prediction.overlay_pending and not restyle:
+        return db_prediction
+    store = storage.get_storage()
+    if not db_prediction.original_url or not await store.has(db_prediction.original_url):
+        raise HTTPException(status_code=410, detail="Original image is no longer available")
+
+    image_bytes = await store.get(db_prediction.original_url)
+    if db_prediction.cam is not None:
+        overlay_bytes = await run_in_threadpool(
+            ml_services.render_stored_overlay, image_bytes, db_prediction.cam, db_prediction.predicted_class,
+            alpha, colormap,
+        )
+    elif restyle:
+        raise HTTPException(status_code=409, detail="This prediction has no stored heatmap to re-render")
+    else:
+        inference_result = await scheduler.inference_scheduler.submit(
+            functools.partial(ml_services.run_inference, image_bytes, force_predict=True, render=True),
+            is_disconnected=request.is_disconnected,
+            user=current_user.id,
+            max_running=current_user.max_concurrent_inferences,
+        )
+        overlay_bytes = inference_result["overlay_image_bytes"]
+    image_key = storage.content_key(overlay_bytes, ".png")
+    await store.put(image_key, overlay_bytes, "image/png")
+    return await db.run_sync(services.set_prediction_overlay, db_prediction, image_url=image_key)
+
+@app.get("/predictions/{prediction_id}/similar", response_model=List[schemas.SimilarCase])
+def read_similar_cases(
+    prediction_id: int,
+    k: int = Query(5, ge=1, le=50),
+    db: orm.Session = Depends(database.get_db),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.READ]),
+):
+    """Returns the k prior cases of this user whose scans look most like this one."""
+    db_prediction = services.get_prediction_for_user(db, prediction_id=prediction_id, user_id=current_user.id)
+    if db_prediction is None:
+        raise HTTPException(status_code=404, detail="Prediction not found")
+    if db_prediction.embedding is None:
+        raise HTTPException(status_code=409, detail="No embedding stored for this prediction")
+
+    matches = vector_index.embedding_index.search(
+        current_user.id, db_prediction.embedding, k=k, exclude_id=prediction_id
+    )
+    predictions = services.get_predictions_by_ids(db, [i for i, _ in matches], user_id=current_user.id)
+    return [
+        {"similarity": round(score, 4), "prediction": predictions[i]}
+        for i, score in matches if i in predictions
+    ]
+
+@app.post("/predict/volume")
+async def predict_volume(
+    request: Request,
+    priority: str = Form(scheduler.BULK),
+    files: List[UploadFile] = File(...),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.PREDICT]),
+):
+    """
+    Classifies a whole study in one pass: a DICOM series (one or more files) or a
+    single NIfTI volume (.nii / .nii.gz). Returns the per-volume aggregate.
+    """
+    if priority not in scheduler.PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(scheduler.PRIORITIES)}")
+    scheduler.inference_scheduler.ensure_capacity(user=current_user.id, priority=priority)
+    if sum(f.size or 0 for f in files) > volumes.MAX_VOLUME_BYTES:
+        raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Volume is too large.")
+
+    # Slices are streamed from the spooled upload files inside the workers, one
+    # scheduler job per slice batch so interactive scans can run in between
+    volume = volumes.VolumeInference([f.file for f in files], [f.filename for f in files])
+    deadline = time.monotonic() + volumes.VOLUME_TIMEOUT_SECONDS
+    try:
+        while await scheduler.inference_scheduler.submit(
+            volume.step,
+            timeout=max(0.0, deadline - time.monotonic()),
+            is_disconnected=request.is_disconnected,
+            user=current_user.id,
+            priority=priority,
+            max_running=current_user.max_concurrent_inferences,
+        ):
+            pass
+        return volume.result()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        await run_in_threadpool(volume.close)
+
+@app.get("/" + storage.MEDIA_URL_PREFIX + "/{key:path}")
+def read_media(key: str, request: Request, expires: int = Query(...), signature: str = Query(...)):
+    """
+    Serves a stored image behind a signed URL (see storage.signed_media_url).
+    Objects are content-addressed, so responses are cacheable forever. With
+    MEDIA_ACCEL_REDIRECT_PREFIX set, nginx streams the file instead of Python.
+    """
+    if not storage.verify_media_signature(key, expires, signature):
+        raise HTTPException(status_code=403, detail="Invalid or expired link")
+    store = storage.get_storage()
+    if not isinstance(store, storage.LocalStorage):
+        # Object stores serve their own bytes
+        return RedirectResponse(store.url(key))
+    try:
+        path = store.path(key)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not found")
+
+    etag = '"' + Path(key).stem + '"'
+    headers = {"ETag": etag, "Cache-Control": storage.MEDIA_CACHE_CONTROL}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    if storage.MEDIA_ACCEL_REDIRECT_PREFIX:
+        headers["X-Accel-Redirect"] = storage.MEDIA_ACCEL_REDIRECT_PREFIX + store.normalize_key(key)
+        return Response(headers=headers)
+    if not path.is_file():
+        raise HTTPException(status_code=404, detail="Not found")
+    return FileResponse(path, headers=headers)  # Handles Range requests
+
+# --- Users (admin) ---
+@app.patch("/admin/users/{user_id}", response_model=schemas.User)
+def update_user_endpoint(
+    user_id: int,
+    body: schemas.UserUpdate,
+    db: orm.Session = Depends(database.get_db),
+    admin: models.User = Depends(services.get_current_admin),
+):
+    """Changes a user's admin flag or inference limit; other API processes pick it up within AUTH_CACHE_TTL_SECONDS."""
+    db_user = services.update_user(db, user_id, body.model_dump(exclude_unset=True))
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return db_user
+
+# --- Export (admin) ---
+@app.get("/admin/export")
+def export_all_predictions(
+    fmt: str = Query("csv", alias="format"),
+    user_id: Optional[int] = Query(None),  # Default: every user
+    date_from: Optional[datetime] = Query(None),
+    date_to: Optional[datetime] = Query(None),
+    admin: models.User = Depends(services.get_current_admin),
+):
+    """Streams the predictions of all users (in id order) or of one user as CSV or NDJSON."""
+    query = export.export_query(user_id, date_from, date_to)
+    return _export_response(query, fmt, "all-predictions" if user_id is None else f"user-{user_id}-predictions")
+
+# --- Database (admin) ---
+@app.get("/admin/db/pool")
+def read_pool_metrics(admin: models.User = Depends(services.get_current_admin)):
+    """Connection pool usage of this worker, for the sync and async engines."""
+    return database.pool_metrics()
+
+# --- Model Registry (admin) ---
+@app.get("/admin/models")
+def read_models(admin: models.User = Depends(services.get_current_admin)):
+    """Registered model versions, the serving and shadow choice, and shadow agreement so far."""
+    return registry.describe()
+
+@app.post("/admin/models", status_code=status.HTTP_201_CREATED)
+async def register_model(body: schemas.ModelRegistration, admin: models.User = Depends(services.get_current_admin)):
+    """Loads a new model version next to the serving one (it does not serve until activated)."""
+    try:
+        await run_in_threadpool(registry.register, body.version, body.model_path, body.label_map_path)
+    except VersionExists as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return registry.describe()
+
+@app.post("/admin/models/{version}/activate")
+async def activate_model(version: str, admin: models.User = Depends(services.get_current_admin)):
+    """Switches live traffic to `version`; requests already running finish on the previous model."""
+    try:
+        await run_in_threadpool(registry.activate, version)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Model version not found")
+    return registry.describe()
+
+@app.put("/admin/models/shadow")
+async def configure_shadow(body: schemas.ShadowConfig, admin: models.User = Depends(services.get_current_admin)):
+    """Runs `version` in shadow on a `fraction` of live predictions (off the response path)."""
+    if not 0.0 <= body.fraction <= 1.0:
+        raise HTTPException(status_code=400, detail="fraction must be between 0 and 1")
+    try:
+        await run_in_threadpool(registry.set_shadow, body.version, body.fraction)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Model version not found")
+    return registry.describe()
+
+@app.delete("/admin/models/{version}")
+def unregister_model(version: str, admin: models.User = Depends(services.get_current_admin)):
+    try:
+        registry.unregister(version)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return registry.describe()
 
 @app.post("/users", response_model=schemas.User)
-def create_user_endpoint(user: schemas.UserCreate, db: orm.Session = Depends(database.get_db)):
-    db_user = services.get_user_by_email(db=db, email=user.email)
+async def create_user_endpoint(user: schemas.UserCreate, db: AsyncSession = Depends(database.get_async_db)):
+    db_user = await db.run_sync(services.get_user_by_email, user.email)
+    await db.commit()  # Release the connection while the password is hashed
     if db_user:
         raise HTTPException(status_code=400, detail="Email already registered")
-    return services.create_user(db=db, user=user)
+    hashed_password = await passwords.hash_password_async(user.password)
+    return await db.run_sync(services.create_user, user, hashed_password)
 
 @app.get("/users/me/history", response_model=List[schemas.PredictionWithPatient])
 def read_user_history(
-    current_user: models.User = Depends(services.get_current_user), 
+    request: Request,
+    limit: int = Query(services.HISTORY_PAGE_SIZE, ge=1, le=services.HISTORY_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),  # X-Next-Cursor of the previous page
+    since: Optional[str] = Query(None),  # X-Sync-Cursor of the client's last sync
+    predicted_class: Optional[str] = Query(None),
+    date_from: Optional[datetime] = Query(None),  # Inclusive
+    date_to: Optional[datetime] = Query(None),  # Exclusive
+    patient_id: Optional[str] = Query(None),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.READ]), 
     db: orm.Session = Depends(database.get_db)
 ):
-    return services.get_predictions_for_user(db, user_id=current_user.id)
+    """
+    The user's predictions, newest first, one page at a time. The cursor of the
+    next page is returned in the X-Next-Cursor header (absent on the last page).
 
+    Delta sync: first pages and `since` requests also return X-Sync-Cursor, the
+    position of the newest prediction seen; `since=<that cursor>` later returns
+    the predictions made after it, oldest first, plus a short overlap before it
+    that may repeat some (dedupe by id). Further pages of a sync keep the same
+    `since` and add `cursor=<X-Next-Cursor>`.
+    Responses carry an ETag, and If-None-Match gets a 304 while nothing changed.
+    """
+    etag = services.history_etag(
+        db, current_user.id, request.query_params.multi_items(), storage.get_storage().url_epoch()
+    )
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}  # Revalidate on every use
+    if etag in [tag.strip() for tag in request.headers.get("if-none-match", "").split(",")]:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    try:
+        predictions, next_cursor = services.get_predictions_for_user(
+            db, user_id=current_user.id, limit=limit, cursor=cursor, predicted_class=predicted_class,
+            date_from=date_from, date_to=date_to, patient_id=patient_id, since=since,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if next_cursor is not None:
+        headers["X-Next-Cursor"] = next_cursor
+    if since is not None:
+        newest = predictions[-1] if predictions else None
+        # A page of only overlap rows must not move the client's position back
+        newer = newest is not None and (newest.prediction_timestamp, newest.id) > services.decode_cursor(since)
+        headers["X-Sync-Cursor"] = services.encode_cursor(newest) if newer else since
+    elif cursor is None:
+        newest = predictions[0] if predictions else None
+        if newest is not None:
+            headers["X-Sync-Cursor"] = services.encode_cursor(newest)
+    # Rows are serialized directly (same schema as response_model, without per-object validation)
+    return serializers.FastJSONResponse(serializers.predictions_with_patients(predictions), headers=headers)
+
+
+def _export_response(query, fmt: str, name: str):
+    if fmt not in export.FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of {sorted(export.FORMATS)}")
+    filename = f"{name}-{datetime.utcnow():%Y%m%d}.{fmt}"
+    db = export.open_session()  # ExportBusy (503) when the export pool is in use
+    return StreamingResponse(
+        export.iter_export(query, fmt, db),
+        media_type=export.FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+        background=BackgroundTask(db.close),  # Also when the client disconnects before the end
+    )
+
+@app.get("/users/me/export")
+def export_user_history(
+    fmt: str = Query("csv", alias="format"),
+    date_from: Optional[datetime] = Query(None),
+    date_to: Optional[datetime] = Query(None),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.READ]),
+):
+    """Streams all of the user's predictions as CSV or NDJSON, oldest first."""
+    return _export_response(export.export_query(current_user.id, date_from, date_to), fmt, "predictions")
+
+@app.get("/users/me/stats", response_model=schemas.UserStats)
+def read_user_stats(
+    days: int = Query(30, ge=1, le=366),
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.READ]),
+    db: orm.Session = Depends(database.get_db),
+):
+    """Prediction counts per class (all time) and per day (last `days` days), from the rollup table."""
+    return stats.get_user_stats(db, user_id=current_user.id, days=days)
+
+@app.get("/patients/{patient_id}/timeline", response_model=schemas.PatientTimeline)
+def read_patient_timeline(
+    patient_id: str,
+    current_user: models.User = Security(services.get_current_user, scopes=[credentials.READ]),
+    db: orm.Session = Depends(database.get_db),
+):
+    """All predictions of one of the user's patients, oldest first."""
+    timeline = services.get_patient_timeline(db, user_id=current_user.id, patient_id=patient_id)
+    if timeline is None:
+        raise HTTPException(status_code=404, detail="Patient not found")
+    return serializers.FastJSONResponse(serializers.patient_timeline(*timeline))
@@ -0,0 +1,200 @@
+"""
+Storage maintenance for prediction images.
+
+    python -m app.maintenance compact [--older-than-days N]
+    python -m app.maintenance gc [--grace-hours N] [--dry-run]
+    python -m app.maintenance usage
+    python -m app.maintenance run [--interval-hours N]   # all of the above, periodically
+"""
+import argparse
+import collections
+import datetime as _dt
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+
+from . import database, models, services, storage
+
+# --- Configuration ---
+COMPACT_AFTER_DAYS = int(os.getenv("COMPACT_AFTER_DAYS", 30))
+COMPACT_WEBP_QUALITY = int(os.getenv("COMPACT_WEBP_QUALITY", 85))
+GC_GRACE_HOURS = float(os.getenv("GC_GRACE_HOURS", 24))  # Never delete files younger than this
+BATCH_SIZE = 500
+
+
+def _key(value):
+    return storage.Storage.normalize_key(value) if value else None
+
+
+def compact_overlays(db, store, older_than_days: int = COMPACT_AFTER_DAYS):
+    """
+    Re-encodes PNG overlays older than the cutoff as WebP and repoints every row
+    that references them. Originals are left untouched.
+    Returns (files compacted, bytes saved).
+    """
+    cutoff = _dt.datetime.utcnow() - _dt.timedelta(days=older_than_days)
+    compacted, saved, last_id = 0, 0, 0
+    while True:
+        rows = (
+            db.query(models.Prediction.id, models.Prediction.image_url)
+            .filter(
+                models.Prediction.id > last_id,
+                models.Prediction.prediction_timestamp < cutoff,
+                models.Prediction.image_url.like("%.png"),
+            )
+            .order_by(models.Prediction.id)
+            .limit(BATCH_SIZE)
+            .all()
+        )
+        if not rows:
+            break
+        last_id = rows[-1].id
+        for old_key in {row.image_url for row in rows}:
+            try:
+                data = store.read(old_key)
+            except (OSError, ValueError, KeyError):
+                continue  # Reported by gc as missing
+            img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if img is None:
+                continue
+            ok, buf = cv2.imencode(".webp", img, [cv2.IMWRITE_WEBP_QUALITY, COMPACT_WEBP_QUALITY])
+            if not ok or len(buf) >= len(data):
+                continue
+            new_key = storage.content_key(buf.tobytes(), ".webp")
+            store.write(new_key, buf.tobytes(), "image/webp")
+            # Keys are shared between rows (re-used results), so repoint all of them
+            db.query(models.Prediction).filter(models.Prediction.image_url == old_key).update(
+                {models.Prediction.image_url: new_key}, synchronize_session=False
+            )
+            db.commit()
+            store.remove(old_key)
+            compacted += 1
+            saved += len(data) - len(buf)
+    if compacted:
+        services.bump_history_revision(db)  # Image URLs in histories changed
+        db.commit()
+    return compacted, saved
+
+
+def _referenced_keys(db):
+    """Maps every stored key referenced by a prediction to the owners referencing it."""
+    owners = collections.defaultdict(set)
+    query = (
+        db.query(models.Prediction.owner_id, models.Prediction.image_url, models.Prediction.original_url)
+        .yield_per(5000)
+    )
+    for owner_id, image_url, original_url in query:
+        for key in (_key(image_url), _key(original_url)):
+            if key:
+                owners[key].add(owner_id)
+    return owners
+
+
+def collect_garbage(db, store, grace_hours: float = GC_GRACE_HOURS, dry_run: bool = False):
+    """
+    Deletes stored files no prediction references and flags predictions whose
+    files are gone. Files younger than the grace period are kept: uploads are
+    written before their row is committed.
+    Returns (orphans deleted, bytes freed, rows marked missing).
+    """
+    referenced = _referenced_keys(db)
+    existing = set()
+    deleted, freed = 0, 0
+    cutoff = time.time() - grace_hours * 3600
+    for key, size, modified in store.iter_objects():
+        existing.add(key)
+        if key in referenced or modified > cutoff:
+            continue
+        if not dry_run:
+            store.remove(key)
+        deleted += 1
+        freed += size
+
+    missing = {key for key in referenced if key not in existing}
+    # Stored values may be legacy paths, so match on the normalized key
+    missing_ids = [
+        prediction_id
+        for prediction_id, image_url, original_url in db.query(
+            models.Prediction.id, models.Prediction.image_url, models.Prediction.original_url
+        ).yield_per(5000)
+        if _key(image_url) in missing or _key(original_url) in missing
+    ]
+    previously_missing = {
+        prediction_id for (prediction_id,) in
+        db.query(models.Prediction.id).filter(models.Prediction.image_missing.is_(True))
+    }
+    if not dry_run and previously_missing != set(missing_ids):
+        # Reset flags first so files that came back (restored backups) are unmarked
+        db.query(models.Prediction).filter(models.Prediction.image_missing.is_(True)).update(
+            {models.Prediction.image_missing: False}, synchronize_session=False
+        )
+        for start in range(0, len(missing_ids), BATCH_SIZE):
+            db.query(models.Prediction).filter(
+                models.Prediction.id.in_(missing_ids[start:start + BATCH_SIZE])
+            ).update({models.Prediction.image_missing: True}, synchronize_session=False)
+        services.bump_history_revision(db)  # Image URLs in histories changed
+        db.commit()
+    return deleted, freed, len(missing_ids)
+
+
+def storage_usage(db, store):
+    """
+    Bytes and file count per user. A file shared by several predictions of one
+    user is counted once for that user.
+    """
+    referenced = _referenced_keys(db)
+    usage = collections.defaultdict(lambda: {"files": 0, "bytes": 0})
+    for key, size, _ in store.iter_objects():
+        for owner_id in referenced.get(key, ()):
+            usage[owner_id]["files"] += 1
+            usage[owner_id]["bytes"] += size
+    emails = dict(db.query(models.User.id, models.User.email).filter(models.User.id.in_(list(usage))).all())
+    return [
+        {"user_id": owner_id, "email": emails.get(owner_id), **stats}
+        for owner_id, stats in sorted(usage.items(), key=lambda item: -item[1]["bytes"])
+    ]
+
+
+def run_all(db, store, args):
+    compacted, saved = compact_overlays(db, store, args.older_than_days)
+    print(f"compact: {compacted} overlays re-encoded, {saved / 1e6:.1f} MB saved")
+    deleted, freed, marked = collect_garbage(db, store, args.grace_hours, args.dry_run)
+    print(f"gc: {deleted} orphaned files ({freed / 1e6:.1f} MB) deleted, {marked} predictions marked missing")
+    print(json.dumps(storage_usage(db, store), indent=2))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.maintenance", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["compact", "gc", "usage", "run"])
+    parser.add_argument("--older-than-days", type=int, default=COMPACT_AFTER_DAYS)
+    parser.add_argument("--grace-hours", type=float, default=GC_GRACE_HOURS)
+    parser.add_argument("--dry-run", action="store_true", help="gc: report without deleting or marking")
+    parser.add_argument("--interval-hours", type=float, default=None, help="run: repeat every N hours")
+    args = parser.parse_args(argv)
+
+    store = storage.get_storage()
+    while True:
+        db = database.SessionLocal()
+        try:
+            if args.command == "compact":
+                compacted, saved = compact_overlays(db, store, args.older_than_days)
+                print(f"{compacted} overlays re-encoded, {saved / 1e6:.1f} MB saved")
+            elif args.command == "gc":
+                deleted, freed, marked = collect_garbage(db, store, args.grace_hours, args.dry_run)
+                print(f"{deleted} orphaned files ({freed / 1e6:.1f} MB) deleted, {marked} predictions marked missing")
+            elif args.command == "usage":
+                print(json.dumps(storage_usage(db, store), indent=2))
+            else:
+                run_all(db, store, args)
+        finally:
+            db.close()
+        if args.command != "run" or not args.interval_hours:
+            break
+        time.sleep(args.interval_hours * 3600)
+
+
+if __name__ == "__main__":
+    main()
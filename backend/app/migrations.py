@@ -0,0 +1,95 @@
+import sqlalchemy as _sql
+from .database import Base
+
+# --- Lightweight Schema Migrations ---
+# `create_all` only creates missing tables. Columns added to existing models are
+# brought in here; every step must be idempotent because it runs on each startup.
+
+def add_missing_columns(engine):
+    """
+    Adds columns declared on the models but missing from existing tables.
+    New columns must be nullable or carry a server default.
+    """
+    inspector = _sql.inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                col_type = column.type.compile(dialect=engine.dialect)
+                ddl = f'ALTER TABLE {table.name} ADD COLUMN {column.name} {col_type}'
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    if isinstance(default, _sql.sql.ClauseElement):
+                        default = default.compile(dialect=engine.dialect)
+                    ddl += f" DEFAULT {default}"
+                if not column.nullable and column.server_default is not None:
+                    ddl += " NOT NULL"
+                conn.execute(_sql.text(ddl))
+
+def relax_not_null(engine):
+    """
+    Drops NOT NULL from columns the models now declare nullable.
+    SQLite cannot alter columns in place, so this only runs on PostgreSQL.
+    """
+    if engine.dialect.name != "postgresql":
+        return
+    inspector = _sql.inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            db_columns = {col["name"]: col for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                db_column = db_columns.get(column.name)
+                if db_column is not None and column.nullable and not db_column["nullable"] and not column.primary_key:
+                    conn.execute(_sql.text(f"ALTER TABLE {table.name} ALTER COLUMN {column.name} DROP NOT NULL"))
+
+def merge_duplicate_patients(engine):
+    """
+    Collapses the one-patient-row-per-scan history into one row per
+    (owner, patient_id), keeping the newest row's demographics, and repoints
+    predictions at it. Runs until the unique index exists, which it must precede.
+    """
+    inspector = _sql.inspect(engine)
+    if not inspector.has_table("patients"):
+        return
+    if "uq_patients_owner_patient_id" in {index["name"] for index in inspector.get_indexes("patients")}:
+        return
+    # The newest row with the same owner and patient_id; rows without one are the keepers
+    newer = (
+        "SELECT 1 FROM patients AS newer WHERE newer.owner_id = patients.owner_id "
+        "AND newer.patient_id = patients.patient_id AND newer.id > patients.id"
+    )
+    with engine.begin() as conn:
+        conn.execute(_sql.text(
+            "UPDATE patients SET owner_id = (SELECT MIN(owner_id) FROM predictions "
+            "WHERE predictions.patient_record_id = patients.id) WHERE owner_id IS NULL"
+        ))
+        conn.execute(_sql.text(
+            "UPDATE predictions SET patient_record_id = ("
+            "SELECT MAX(keeper.id) FROM patients AS dup JOIN patients AS keeper "
+            "ON keeper.owner_id = dup.owner_id AND keeper.patient_id = dup.patient_id "
+            "WHERE dup.id = predictions.patient_record_id) "
+            f"WHERE patient_record_id IN (SELECT id FROM patients WHERE EXISTS ({newer}))"
+        ))
+        conn.execute(_sql.text(f"DELETE FROM patients WHERE EXISTS ({newer})"))
+
+def create_missing_indexes(engine):
+    """Creates indexes declared on the models for tables that already existed."""
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
+def upgrade(engine):
+    """Brings the database schema up to date with the models."""
+    Base.metadata.create_all(bind=engine)
+    add_missing_columns(engine)
+    relax_not_null(engine)
+    merge_duplicate_patients(engine)
+    create_missing_indexes(engine)
@@ -1,66 +1,127 @@
 import torch
-import torch.nn as nn
 import cv2
 import numpy as np
-import json
-from torchvision import models, transforms
-from pathlib import Path
-from .utils_cam import GradCAM, heatmap_to_circle, overlay_cam
+import os
+import struct
+import zlib
+from torchvision import transforms
+from .utils_cam import heatmap_to_circle, overlay_cam, upsample_cam
+from . import scheduler
+from .model_registry import DEVICE, LABEL_MAP_PATH, MODEL_PATH, LoadedModel, registry
+from .vector_index import encode_embedding
 
 # --- Configuration ---
 IM_SIZE = 384
 IMNET_MEAN = [0.485, 0.456, 0.406]
 IMNET_STD = [0.229, 0.224, 0.225]
-MODEL_PATH = Path("outputs/model_calibrated.pt")
-LABEL_MAP_PATH = Path("outputs/label_map.json")
-DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
 
 # --- Gating Logic Thresholds ---
-CONF_THRESH = 0.55
-CAM_AREA_THRESH = 0.005
-CAM_THRESHOLD = 0.35
-
-# --- Model Loading (Singleton Pattern) ---
-class ModelSingleton:
-    _instance = None
-    def __new__(cls):
-        if cls._instance is None:
-            print("Loading model for the first time...")
-            cls._instance = super(ModelSingleton, cls).__new__(cls)
-            
-            checkpoint = torch.load(MODEL_PATH, map_location=DEVICE)
-            
-            with open(LABEL_MAP_PATH, "r") as f:
-                cls.classes = json.load(f)["classes"]
-            
-            num_classes = len(cls.classes)
-            
-            model = models.resnet50()
-            model.fc = nn.Linear(model.fc.in_features, num_classes)
-            model.load_state_dict(checkpoint['model'])
-            model.to(DEVICE)
-            model.eval()
-
-            cls.model = model
-            cls.T = float(checkpoint.get('T', 1.0))
-            print("Model loaded successfully.")
-        return cls._instance
+# After changing these, `python -m app.gating regate` re-applies them to history
+CONF_THRESH = float(os.getenv("CONF_THRESH", 0.55))
+CAM_AREA_THRESH = float(os.getenv("CAM_AREA_THRESH", 0.005))
+CAM_THRESHOLD = float(os.getenv("CAM_THRESHOLD", 0.35))
+
+# --- Overlay Style (re-renders from stored CAMs pick up changes) ---
+OVERLAY_ALPHA = float(os.getenv("OVERLAY_ALPHA", 0.35))
+OVERLAY_COLORMAP = os.getenv("OVERLAY_COLORMAP", "jet")
+COLORMAPS = {
+    "jet": cv2.COLORMAP_JET,
+    "turbo": cv2.COLORMAP_TURBO,
+    "inferno": cv2.COLORMAP_INFERNO,
+    "viridis": cv2.COLORMAP_VIRIDIS,
+    "hot": cv2.COLORMAP_HOT,
+}
+
+# --- Near-Duplicate Detection ---
+# Band lookup (services.phash_columns) splits hashes into 4 bands of 16 bits. Hashes
+# at most 3 bits apart always share a band, so 3 is the largest distance it can serve
+PHASH_BANDS = 4
+
+def _phash_max_distance(value: str) -> int:
+    distance = int(value)
+    if not 0 <= distance < PHASH_BANDS:
+        raise ValueError(
+            f"PHASH_MAX_DISTANCE must be between 0 and {PHASH_BANDS - 1}: "
+            f"the {PHASH_BANDS}-band index cannot find hashes {distance} bits apart"
+        )
+    return distance
+
+PHASH_MAX_DISTANCE = _phash_max_distance(os.getenv("PHASH_MAX_DISTANCE", "3"))
+# Default for /predict/image's reuse_duplicate: return the earlier result instead of re-running the model
+PHASH_REUSE_RESULTS = os.getenv("PHASH_REUSE_RESULTS", "false").lower() == "true"
+
+# --- Perceptual Hash ---
+def perceptual_hash(img: np.ndarray) -> int:
+    """
+    64-bit DCT perceptual hash of a decoded image (see decode_image), stable
+    across re-encoding, slight resizing and metadata changes. Computed from the
+    array the upload is decoded to for inference anyway, so it costs no decode.
+    Returned as a signed 64-bit int so it fits a BIGINT column.
+    """
+    gray = img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8].ravel()[1:]  # Lowest frequencies, without the DC term
+    bits = low > np.median(low)
+    value = 0
+    for bit in bits:
+        value = (value << 1) | int(bit)
+    value <<= 1  # 63 coefficient bits; keep the hash 64 bits wide
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin((a ^ b) & ((1 << 64) - 1)).count("1")
+
+# --- Decoding ---
+def decode_image(image_bytes: bytes) -> np.ndarray:
+    """
+    Decodes an upload to a 2D grayscale array when it is genuinely single-channel
+    (including color-encoded scans whose channels are identical), else to BGR.
+    MRIs are the common case, and keeping them single-channel cuts the memory
+    traffic of every stage before the model to a third.
+    """
+    img = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_UNCHANGED)
+    if img is None: raise ValueError("Invalid image data")
+    if img.dtype == np.uint16: img = (img >> 8).astype(np.uint8)  # 16-bit PNG/TIFF exports
+    if img.ndim == 2: return img
+    if img.shape[2] == 4: img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return as_grayscale(img)
+
+def as_grayscale(bgr: np.ndarray) -> np.ndarray:
+    """Returns the single channel of a BGR image whose channels are identical, else `bgr`."""
+    b, g, r = bgr[..., 0], bgr[..., 1], bgr[..., 2]
+    # A strided sample rejects color images before the full comparison
+    if not (np.array_equal(b[::8, ::8], g[::8, ::8]) and np.array_equal(b[::8, ::8], r[::8, ::8])):
+        return bgr
+    if np.array_equal(b, g) and np.array_equal(b, r):
+        return np.ascontiguousarray(b)
+    return bgr
+
+def decode_and_hash(image_bytes: bytes):
+    """(decode_image(image_bytes), its perceptual_hash): the one decode of an upload."""
+    img = decode_image(image_bytes)
+    return img, perceptual_hash(img)
+
+def to_bgr(img: np.ndarray) -> np.ndarray:
+    return cv2.cvtColor(img, cv2.COLOR_GRAY2BGR) if img.ndim == 2 else img
 
 # --- Heuristic MRI Validation (CHANGED) ---
-def is_valid_mri(bgr: np.ndarray):
+def is_valid_mri(img: np.ndarray):
     """
-    Heuristic check for brain MRI-like images. 
+    Heuristic check for brain MRI-like images (grayscale or BGR).
     Returns a warning string if a check fails, otherwise returns None.
     """
-    if bgr is None: return "Invalid image data."
-    H, W = bgr.shape[:2]
+    if img is None: return "Invalid image data."
+    H, W = img.shape[:2]
     if H < 128 or W < 128: return "Warning: Image is very small (<128px)."
 
-    hsv = cv2.cvtColor(bgr, cv2.COLOR_BGR2HSV)
-    sat_mean = hsv[..., 1].mean()
-    if sat_mean > 20: return "Warning: Image has high color saturation, may not be a standard MRI."
-
-    gray = cv2.cvtColor(bgr, cv2.COLOR_BGR2GRAY)
+    if img.ndim == 2:
+        gray = img  # No color, so the saturation check cannot fail
+    else:
+        hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+        sat_mean = hsv[..., 1].mean()
+        if sat_mean > 20: return "Warning: Image has high color saturation, may not be a standard MRI."
+        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
     brightness = gray.mean()
     if brightness < 5: return "Warning: Image is extremely dark."
@@ -76,82 +137,245 @@ def is_valid_mri(bgr: np.ndarray):
     return None # Return None if all checks pass
 
 # --- Preprocessing ---
-def preprocess_bgr(bgr: np.ndarray):
-    rgb = cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB)
-    tfm = transforms.Compose([
-        transforms.ToPILImage(),
-        transforms.Resize((IM_SIZE, IM_SIZE)),
-        transforms.ToTensor(),
-        transforms.Normalize(IMNET_MEAN, IMNET_STD),
-    ])
-    return tfm(rgb).unsqueeze(0)
+_resize = transforms.Compose([
+    transforms.ToPILImage(),
+    transforms.Resize((IM_SIZE, IM_SIZE)),
+])
+_MEAN = torch.tensor(IMNET_MEAN).view(3, 1, 1)
+_STD = torch.tensor(IMNET_STD).view(3, 1, 1)
 
-# --- Main Inference Function (CHANGED) ---
-def run_inference(image_bytes: bytes, force_predict: bool = False):
-    # 1. Decode and Ensure 3-Channel BGR
-    arr = np.frombuffer(image_bytes, np.uint8)
-    bgr = cv2.imdecode(arr, cv2.IMREAD_UNCHANGED)
-    if bgr is None: raise ValueError("Invalid image data")
-    
-    if bgr.ndim == 2: bgr = cv2.cvtColor(bgr, cv2.COLOR_GRAY2BGR)
-    if bgr.shape[2] == 4: bgr = cv2.cvtColor(bgr, cv2.COLOR_BGRA2BGR)
+def preprocess(img: np.ndarray):
+    """
+    Resizes and normalizes a grayscale or BGR image into a (1, 3, IM_SIZE, IM_SIZE)
+    tensor. Grayscale images are resized as one channel and only broadcast to
+    three by the normalization, which gives the same tensor as the RGB path.
+    """
+    return to_model_tensor(resize_for_model(img))
 
-    # 2. Run heuristic check (if not forced)
-    if not force_predict:
-        warning_message = is_valid_mri(bgr)
-        if warning_message:
-            # If there's a warning, return it immediately
-            return {"warning": warning_message}
+def resize_for_model(img: np.ndarray) -> np.ndarray:
+    """First half of preprocess: the uint8 (IM_SIZE, IM_SIZE[, 3]) RGB or grayscale image."""
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return np.array(_resize(img))  # Writable copy, so torch.from_numpy can share it
 
-    # 3. Load model and run prediction
-    model_instance = ModelSingleton()
-    model, T, classes = model_instance.model, model_instance.T, model_instance.classes
-    tens = preprocess_bgr(bgr).to(DEVICE)
-    
-    with torch.no_grad():
-        logits = model(tens) / T
-        probs = torch.softmax(logits, dim=1)[0].cpu().numpy()
-        pred_idx = int(np.argmax(probs))
-        pred_label = classes[pred_idx]
-        confidence = float(probs[pred_idx])
-
-    # 4. Generate Grad-CAM
-    cam = GradCAM(model, target_layer_name='layer4')
-    heatmap = cam(tens, class_idx=pred_idx)
-    H0, W0 = bgr.shape[:2]
-    heatmap_full = cv2.resize(heatmap, (W0, H0), interpolation=cv2.INTER_LINEAR)
+def to_model_tensor(resized: np.ndarray):
+    """Second half of preprocess (same arithmetic as ToTensor + Normalize)."""
+    tens = torch.from_numpy(resized)
+    tens = tens.unsqueeze(0) if tens.ndim == 2 else tens.permute(2, 0, 1)
+    return ((tens.float().div(255) - _MEAN) / _STD).unsqueeze(0)
 
-    # 5. Apply "No-Tumor" Gating Logic
-    cam_mask = (heatmap_full > CAM_THRESHOLD).astype(np.uint8)
-    cam_area_frac = cam_mask.sum() / cam_mask.size
-    
+# --- Stored Model Outputs ---
+# Each prediction keeps its calibrated probabilities, the coarse CAM and the
+# area curve of the model-resolution heatmap, so overlays can be re-rendered and
+# gating thresholds re-applied without running the model again.
+def encode_probabilities(probs: np.ndarray) -> bytes:
+    return np.asarray(probs, dtype=np.float32).tobytes()
+
+def decode_probabilities(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=np.float32)
+
+def encode_cam(coarse: np.ndarray) -> bytes:
+    """
+    Packs a coarse (h, w) CAM as uint8 scaled to its maximum, zlib-compressed
+    (a few hundred bytes). The scale is irrelevant: heatmaps are min-max normalized.
+    """
+    peak = float(coarse.max())
+    q = np.rint(coarse * (255.0 / peak)) if peak > 0 else np.zeros_like(coarse)
+    return struct.pack("<HH", *coarse.shape) + zlib.compress(q.astype(np.uint8).tobytes())
+
+def decode_cam(blob: bytes) -> np.ndarray:
+    h, w = struct.unpack_from("<HH", blob)
+    return np.frombuffer(zlib.decompress(blob[4:]), np.uint8).reshape(h, w).astype(np.float32) / 255.0
+
+def cam_area_curve(heatmap: np.ndarray) -> np.ndarray:
+    """
+    Fraction of a [0,1] heatmap above each 8-bit level (the levels heatmap_to_circle
+    thresholds), as uint16 in units of 1/65535: the CAM area at any CAM_THRESHOLD.
+    """
+    counts = np.bincount((heatmap * 255).astype(np.uint8).ravel(), minlength=256)
+    above = heatmap.size - np.cumsum(counts)
+    return np.rint(above * (65535.0 / heatmap.size)).astype(np.uint16)
+
+def encode_area_curve(curve: np.ndarray) -> bytes:
+    return np.asarray(curve, dtype="<u2").tobytes()  # Fixed width, so many rows load with one frombuffer
+
+def decode_area_curve(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype="<u2")
+
+def cam_area_fraction(curve: np.ndarray, threshold: float = CAM_THRESHOLD):
+    """
+    CAM area above `threshold` from one (256,) area curve or a stacked (N, 256)
+    array: the fraction at 8-bit levels >= threshold * 255. Heatmap values
+    between the threshold and the next level up are counted as below it, so
+    this is for re-gating stored outputs; live gating uses the heatmap itself.
+    """
+    level = int(np.ceil(threshold * 255 - 1e-6))  # Lowest level whose pixels are all above threshold
+    return curve[..., max(level, 1) - 1] / 65535.0
+
+# --- "No-Tumor" Gating ---
+def gate_prediction(pred_label: str, confidence: float, cam_area_frac: float,
+                    conf_thresh: float = None, cam_area_thresh: float = None):
+    """
+    Falls back to no_tumor when the model is unsure or its focus area is tiny.
+    Returns (final_label, is_final_no_tumor, reason).
+    """
+    conf_thresh = CONF_THRESH if conf_thresh is None else conf_thresh
+    cam_area_thresh = CAM_AREA_THRESH if cam_area_thresh is None else cam_area_thresh
     pred_is_no_tumor = "no" in pred_label.lower()
-    is_final_no_tumor = pred_is_no_tumor or (confidence < CONF_THRESH) or (cam_area_frac < CAM_AREA_THRESH)
+    is_final_no_tumor = pred_is_no_tumor or (confidence < conf_thresh) or (cam_area_frac < cam_area_thresh)
     final_label = "no_tumor" if is_final_no_tumor else pred_label
-    
-    # 6. Construct Reason and Overlay Image
+
     reason = f"Model focus consistent with '{final_label}' features."
     if is_final_no_tumor and not pred_is_no_tumor:
-        reason_detail = 'low confidence' if confidence < CONF_THRESH else 'tiny CAM area'
+        reason_detail = 'low confidence' if confidence < conf_thresh else 'tiny CAM area'
         reason += f" (Flagged as no_tumor due to {reason_detail})"
+    return final_label, is_final_no_tumor, reason
+
+# --- Overlay Rendering ---
+def render_overlay(img: np.ndarray, heatmap: np.ndarray, is_final_no_tumor: bool,
+                   alpha: float = None, colormap: str = None) -> bytes:
+    """
+    Draws the CAM overlay and focus circle on the original (grayscale or BGR) image.
+    `heatmap` is the (IM_SIZE, IM_SIZE) normalized CAM; returns PNG bytes.
+    """
+    alpha = OVERLAY_ALPHA if alpha is None else alpha
+    colormap = COLORMAPS[colormap or OVERLAY_COLORMAP]
+    bgr = to_bgr(img)  # The overlay is the only stage that needs color
+    H0, W0 = bgr.shape[:2]
+    heatmap_full = cv2.resize(heatmap, (W0, H0), interpolation=cv2.INTER_LINEAR)
+    overlay_img = overlay_cam(bgr, heatmap_full, alpha=alpha, colormap=colormap)
+    circle, _ = heatmap_to_circle(heatmap, threshold=CAM_THRESHOLD)
 
-    overlay_img = overlay_cam(bgr, heatmap_full, alpha=0.35)
-    circle, _ = heatmap_to_circle(cv2.resize(heatmap, (IM_SIZE, IM_SIZE)), threshold=CAM_THRESHOLD)
-    
     cx = int(circle[0] * (W0 / IM_SIZE))
     cy = int(circle[1] * (H0 / IM_SIZE))
     r  = int(circle[2] * ((W0 + H0) / (2 * IM_SIZE)))
     circle_color = (0, 255, 0) if is_final_no_tumor else (0, 0, 255)
-    
+
     if r > 0:
         cv2.circle(overlay_img, (cx, cy), r, circle_color, thickness=3)
 
     _, buf = cv2.imencode(".png", overlay_img)
-    overlay_bytes = buf.tobytes()
+    return buf.tobytes()
+
+def render_stored_overlay(image_bytes: bytes, cam_blob: bytes, predicted_class: str,
+                          alpha: float = None, colormap: str = None) -> bytes:
+    """Re-renders an overlay from the stored original and coarse CAM, without the model."""
+    heatmap = upsample_cam(decode_cam(cam_blob)[None], (IM_SIZE, IM_SIZE))[0]
+    is_final_no_tumor = "no" in predicted_class.lower()
+    return render_overlay(decode_image(image_bytes), heatmap, is_final_no_tumor, alpha, colormap)
+
+# --- Main Inference Function (CHANGED) ---
+def run_inference(image_bytes: bytes, force_predict: bool = False, render: bool = None, img: np.ndarray = None):
+    """
+    Runs the full prediction pipeline on an encoded image.
+
+    `render` controls the overlay: None lets the load policy decide (see
+    scheduler.InferenceScheduler.overloaded), False skips it and marks the result
+    with `overlay_pending` so it can be rendered on demand later from the stored
+    original and CAM. `img` is the upload already decoded with decode_image.
+    """
+    # 1. Decode, keeping single-channel scans single-channel
+    if img is None:
+        img = decode_image(image_bytes)
+
+    # 2. Run heuristic check (if not forced)
+    if not force_predict:
+        warning_message = is_valid_mri(img)
+        if warning_message:
+            # If there's a warning, return it immediately
+            return {"warning": warning_message}
+
+    # 3. Run prediction + Grad-CAM in a single pass on the serving model; the
+    # snapshot is kept for the whole request, so a hot-swap cannot split it
+    model_version, model_instance = registry.serving()
+    cam, T, classes = model_instance.cam, model_instance.T, model_instance.classes
+    tens = preprocess(img).to(DEVICE)
+
+    acts, pooled, logits = cam.forward(tens)
+    with torch.no_grad():
+        probs = torch.softmax(logits / T, dim=1)[0].cpu().numpy()
+        embedding = encode_embedding(pooled[0].cpu().numpy())
+    pred_idx = int(np.argmax(probs))
+    pred_label = classes[pred_idx]
+    confidence = float(probs[pred_idx])
+
+    # 4. Grad-CAM at model resolution
+    coarse = cam.coarse(acts, logits, pred_idx)
+    heatmap = cam.upsample(coarse, size=(IM_SIZE, IM_SIZE))[0]
+    area_curve = cam_area_curve(heatmap)
+
+    # 5. Apply "No-Tumor" Gating Logic
+    cam_area_frac = float((heatmap > CAM_THRESHOLD).mean())
+    final_label, is_final_no_tumor, reason = gate_prediction(pred_label, confidence, cam_area_frac)
 
-    # 7. Return the final, robust result
+    # 6. Render the Overlay Image (unless shedding load)
+    if render is None:
+        render = not scheduler.inference_scheduler.overloaded
+    overlay_bytes = render_overlay(img, heatmap, is_final_no_tumor) if render else None
+    original_bytes = None
+    if img.ndim == 2 and image_bytes[:8] == PNG_SIGNATURE:
+        # Color-encoded grayscale PNG: keep the (lossless) single-channel copy instead
+        original_bytes = cv2.imencode(".png", img)[1].tobytes()
+
+    # 7. Compare with the shadow model, if any (in the background, and never under load)
+    if render and registry.shadow_version is not None:
+        registry.shadow(
+            model_version,
+            {"class": final_label, "confidence": confidence},
+            lambda shadow_model: score_batch(shadow_model, tens)[1][0],
+        )
+
+    # 8. Return the final, robust result
     return {
         "prediction": {"class": final_label, "confidence": round(confidence, 4)},
+        "model_version": model_version,
         "reason": reason,
         "overlay_image_bytes": overlay_bytes,
-    }
\ No newline at end of file
+        "overlay_pending": not render,
+        "original_image_bytes": original_bytes,
+        "embedding": embedding,
+        "probabilities": encode_probabilities(probs),
+        "cam": encode_cam(coarse[0].cpu().numpy()),
+        "cam_area_curve": encode_area_curve(area_curve),
+    }
+
+# --- Batched Inference (volumes) ---
+def run_batch_inference(images, model_instance: LoadedModel = None):
+    """
+    Classifies a batch of already validated grayscale or BGR images in one forward pass.
+    Returns (probs, results): the (B, C) calibrated probabilities and, per image,
+    the gated prediction in the same shape as run_inference's "prediction".
+    Multi-batch callers pass one `model_instance` so a hot-swap cannot split them.
+    """
+    tens = torch.cat([preprocess(img) for img in images])
+    return score_batch(model_instance or registry.serving()[1], tens)
+
+def score_batch(model_instance: LoadedModel, tens):
+    """
+    Runs `model_instance` on a preprocessed (B, 3, IM_SIZE, IM_SIZE) batch.
+    Each result also carries the encoded outputs stored with a prediction
+    (probabilities, cam, cam_area_curve).
+    """
+    cam, T, classes = model_instance.cam, model_instance.T, model_instance.classes
+    acts, _, logits = cam.forward(tens.to(DEVICE))
+    with torch.no_grad():
+        probs = torch.softmax(logits / T, dim=1).cpu().numpy()
+    pred_idx = probs.argmax(axis=1)
+    coarse = cam.coarse(acts, logits, pred_idx.tolist())
+    heatmaps = cam.upsample(coarse, size=(IM_SIZE, IM_SIZE))
+    coarse = coarse.cpu().numpy()
+
+    results = []
+    for i, idx in enumerate(pred_idx):
+        area_curve = cam_area_curve(heatmaps[i])
+        confidence = float(probs[i, idx])
+        final_label, _, reason = gate_prediction(classes[idx], confidence, float((heatmaps[i] > CAM_THRESHOLD).mean()))
+        results.append({
+            "class": final_label,
+            "confidence": round(confidence, 4),
+            "reason": reason,
+            "probabilities": encode_probabilities(probs[i]),
+            "cam": encode_cam(coarse[i]),
+            "cam_area_curve": encode_area_curve(area_curve),
+        })
+    return probs, results
@@ -0,0 +1,310 @@
+import json
+import logging
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+import torch.nn as nn
+from torchvision import models
+
+from .utils_cam import GradCAM
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+MODEL_DIR = Path(os.getenv("MODEL_DIR", "outputs"))  # Checkpoints can only be registered from here
+MODEL_PATH = MODEL_DIR / "model_calibrated.pt"
+LABEL_MAP_PATH = MODEL_DIR / "label_map.json"
+DEFAULT_MODEL_VERSION = os.getenv("MODEL_VERSION", "default")  # Version name of MODEL_PATH
+# Registered versions and the serving/shadow choice; shared by all API processes
+MODEL_REGISTRY_PATH = Path(os.getenv("MODEL_REGISTRY_PATH", str(MODEL_DIR / "model_registry.json")))
+MODEL_REGISTRY_POLL_SECONDS = float(os.getenv("MODEL_REGISTRY_POLL_SECONDS", 10))
+SHADOW_MAX_PENDING = int(os.getenv("SHADOW_MAX_PENDING", 8))  # Shadow runs beyond this are dropped
+DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+
+class LoadedModel:
+    """A classifier checkpoint ready for inference: network, Grad-CAM, temperature and class names."""
+    def __init__(self, model_path: Path = MODEL_PATH, label_map_path: Path = LABEL_MAP_PATH):
+        checkpoint = torch.load(model_path, map_location=DEVICE)
+
+        with open(label_map_path, "r") as f:
+            self.classes = json.load(f)["classes"]
+
+        num_classes = len(self.classes)
+
+        model = models.resnet50()
+        model.fc = nn.Linear(model.fc.in_features, num_classes)
+        model.load_state_dict(checkpoint['model'])
+        model.to(DEVICE)
+        model.eval()
+
+        self.model = model
+        self.cam = GradCAM(model, target_layer_name='layer4')
+        self.T = float(checkpoint.get('T', 1.0))
+
+
+def resolve_model_file(path: str) -> Path:
+    """Resolves a checkpoint or label map path, which must lie inside MODEL_DIR."""
+    resolved = (MODEL_DIR / path).resolve() if not Path(path).is_absolute() else Path(path).resolve()
+    if MODEL_DIR.resolve() not in resolved.parents:
+        raise ValueError(f"Model files must be inside {MODEL_DIR}")
+    if not resolved.is_file():
+        raise ValueError(f"'{path}' does not exist")
+    return resolved
+
+
+class VersionExists(ValueError):
+    pass
+
+
+class ShadowStats:
+    def __init__(self):
+        self.runs = 0
+        self.agreements = 0
+        self.dropped = 0
+        self.errors = 0
+
+    def as_dict(self):
+        return {
+            "runs": self.runs,
+            "agreements": self.agreements,
+            "agreement_rate": round(self.agreements / self.runs, 4) if self.runs else None,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+
+class ModelRegistry:
+    """
+    Model versions loaded side by side. One serves live traffic; optionally a
+    second runs in shadow on a sampled fraction of requests.
+
+    Callers take a snapshot with `serving()` and use it for the whole request,
+    so a swap never affects requests already running: they finish on the old
+    model, which is freed once the last of them drops it (unless still registered).
+    The configuration lives in MODEL_REGISTRY_PATH; `watch()` applies changes
+    made by other processes.
+    """
+    def __init__(self, config_path: Path = MODEL_REGISTRY_PATH):
+        self.config_path = config_path
+        self._lock = threading.RLock()
+        self._paths: Dict[str, Tuple[str, str]] = {}
+        self._models: Dict[str, LoadedModel] = {}
+        self._serving: Optional[Tuple[str, LoadedModel]] = None
+        self.shadow_version: Optional[str] = None
+        self.shadow_fraction = 0.0
+        self.shadow_stats: Dict[str, ShadowStats] = {}
+        self._shadow_executor = None
+        self._shadow_pending = 0
+        self._config_mtime = None
+        self._stop = threading.Event()
+
+    # --- Serving ---
+    def serving(self) -> Tuple[str, LoadedModel]:
+        """(version, model) currently serving; loads the configuration on first use."""
+        snapshot = self._serving
+        if snapshot is None:
+            with self._lock:
+                if self._serving is None:
+                    self.reload()
+                snapshot = self._serving
+        return snapshot
+
+    @property
+    def serving_version(self) -> Optional[str]:
+        return self._serving[0] if self._serving else None
+
+    # --- Configuration ---
+    def _read_config(self) -> dict:
+        if self.config_path.exists():
+            return json.loads(self.config_path.read_text())
+        return {
+            "versions": {DEFAULT_MODEL_VERSION: {"model_path": MODEL_PATH.name, "label_map_path": LABEL_MAP_PATH.name}},
+            "serving": DEFAULT_MODEL_VERSION,
+            "shadow": None,
+            "shadow_fraction": 0.0,
+        }
+
+    def label_map_paths(self) -> Dict[str, str]:
+        """Label map of every registered version, from the stored configuration (no model is loaded)."""
+        with self._lock:
+            config = self._read_config()
+        return {v: c["label_map_path"] for v, c in config["versions"].items()}
+
+    def _write_config(self):
+        config = {
+            "versions": {v: {"model_path": m, "label_map_path": l} for v, (m, l) in self._paths.items()},
+            "serving": self.serving_version,
+            "shadow": self.shadow_version,
+            "shadow_fraction": self.shadow_fraction,
+        }
+        tmp = self.config_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(config, indent=2))
+        tmp.replace(self.config_path)  # Atomic for the other processes polling it
+        self._config_mtime = self.config_path.stat().st_mtime
+
+    def _load(self, version: str) -> LoadedModel:
+        if version not in self._models:
+            model_path, label_map_path = self._paths[version]
+            logger.info("Loading model version '%s'", version)
+            self._models[version] = LoadedModel(resolve_model_file(model_path), resolve_model_file(label_map_path))
+        return self._models[version]
+
+    def reload(self):
+        """Applies the stored configuration: loads the serving and shadow models, then swaps."""
+        with self._lock:
+            config = self._read_config()
+            self._config_mtime = self.config_path.stat().st_mtime if self.config_path.exists() else None
+            self._paths = {v: (c["model_path"], c["label_map_path"]) for v, c in config["versions"].items()}
+            serving = config["serving"]
+            model = self._load(serving)
+            if config.get("shadow"):
+                self._load(config["shadow"])
+            self._serving = (serving, model)
+            self.shadow_version = config.get("shadow")
+            self.shadow_fraction = float(config.get("shadow_fraction", 0.0))
+            # Drop models no longer referenced by the configuration
+            for version in list(self._models):
+                if version not in self._paths:
+                    del self._models[version]
+
+    def watch(self, interval: float = MODEL_REGISTRY_POLL_SECONDS):
+        """Starts a thread that reloads the configuration when another process changes it."""
+        def poll():
+            while not self._stop.wait(interval):
+                try:
+                    mtime = self.config_path.stat().st_mtime if self.config_path.exists() else None
+                    if mtime != self._config_mtime:
+                        self.reload()
+                except Exception:
+                    logger.exception("Failed to reload the model registry")
+        self._stop.clear()
+        threading.Thread(target=poll, name="model-registry-watch", daemon=True).start()
+
+    def stop(self):
+        with self._lock:
+            self._stop.set()
+            if self._shadow_executor is not None:
+                self._shadow_executor.shutdown(wait=False)
+                self._shadow_executor = None
+
+    # --- Administration ---
+    def register(self, version: str, model_path: str, label_map_path: str = LABEL_MAP_PATH.name):
+        """
+        Loads a new version next to the current ones (slow: call off the event
+        loop). Version names are never reused, so one name always means the same
+        weights in every process; raises VersionExists otherwise.
+        """
+        with self._lock:
+            self.serving()
+            if version in self._paths:
+                raise VersionExists(f"Model version '{version}' is already registered")
+        model = LoadedModel(resolve_model_file(model_path), resolve_model_file(label_map_path))
+        with self._lock:
+            if version in self._paths:  # Registered by a concurrent call while this one loaded
+                raise VersionExists(f"Model version '{version}' is already registered")
+            self._paths[version] = (model_path, label_map_path)
+            self._models[version] = model
+            self._write_config()
+
+    def activate(self, version: str):
+        """Atomically switches live traffic to `version`."""
+        with self._lock:
+            self.serving()
+            if version not in self._paths:
+                raise KeyError(version)
+            self._serving = (version, self._load(version))
+            if self.shadow_version == version:
+                self.shadow_version, self.shadow_fraction = None, 0.0
+            self._write_config()
+
+    def set_shadow(self, version: Optional[str], fraction: float):
+        with self._lock:
+            self.serving()
+            if version is not None:
+                if version not in self._paths:
+                    raise KeyError(version)
+                self._load(version)
+            self.shadow_version = version
+            self.shadow_fraction = fraction if version is not None else 0.0
+            self._write_config()
+
+    def unregister(self, version: str):
+        with self._lock:
+            self.serving()
+            if version == self.serving_version:
+                raise ValueError("The serving version cannot be removed")
+            self._paths.pop(version, None)
+            self._models.pop(version, None)
+            if self.shadow_version == version:
+                self.shadow_version, self.shadow_fraction = None, 0.0
+            self._write_config()
+
+    def describe(self) -> dict:
+        with self._lock:
+            self.serving()
+            return {
+                "serving": self.serving_version,
+                "shadow": self.shadow_version,
+                "shadow_fraction": self.shadow_fraction,
+                "versions": {
+                    v: {"model_path": m, "label_map_path": l, "loaded": v in self._models}
+                    for v, (m, l) in self._paths.items()
+                },
+                "shadow_stats": {v: s.as_dict() for v, s in self.shadow_stats.items()},
+            }
+
+    # --- Shadow Inference ---
+    def shadow(self, primary_version: str, primary: dict, run: Callable[[LoadedModel], dict]):
+        """
+        For a sampled fraction of calls, runs `run(shadow_model)` on a background
+        thread and records whether its gated class agrees with `primary`
+        ({"class", "confidence"}). Never blocks the caller; runs beyond
+        SHADOW_MAX_PENDING are dropped.
+        """
+        version = self.shadow_version
+        if version is None or version == primary_version or random.random() >= self.shadow_fraction:
+            return
+        model = self._models.get(version)
+        if model is None:
+            return
+
+        def task():
+            try:
+                result = run(model)
+                agree = result["class"] == primary["class"]
+                with self._lock:
+                    stats.runs += 1
+                    stats.agreements += agree
+                logger.info(
+                    "shadow %s vs %s: %s (%s %.4f / %s %.4f)", version, primary_version,
+                    "agree" if agree else "DISAGREE", primary["class"], primary["confidence"],
+                    result["class"], result["confidence"],
+                )
+            except Exception:
+                with self._lock:
+                    stats.errors += 1
+                logger.exception("Shadow inference with model version '%s' failed", version)
+            finally:
+                with self._lock:
+                    self._shadow_pending -= 1
+
+        with self._lock:
+            if self._stop.is_set():
+                return  # Shutting down
+            stats = self.shadow_stats.setdefault(version, ShadowStats())
+            if self._shadow_pending >= SHADOW_MAX_PENDING:
+                stats.dropped += 1
+                return
+            self._shadow_pending += 1
+            if self._shadow_executor is None:
+                self._shadow_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shadow")
+            self._shadow_executor.submit(task)
+
+
+registry = ModelRegistry()
@@ -1,10 +1,10 @@
 import datetime as _dt
 import sqlalchemy as _sql
 import sqlalchemy.orm as _orm
-import passlib.hash as _hash
 
 # We import Base from database.py now
 from .database import Base
+from . import passwords
 
 # We no longer need this line: Base = declarative_base()
 
@@ -15,10 +15,17 @@ class User(Base):
     id = _sql.Column(_sql.Integer, primary_key=True, index=True)
     email = _sql.Column(_sql.String, unique=True, index=True, nullable=False)
     hashed_password = _sql.Column(_sql.String, nullable=False)
+    # Per-user override of the scheduler's concurrent inference limit (None = default)
+    max_concurrent_inferences = _sql.Column(_sql.Integer, nullable=True)
+    # May manage model versions (/admin/...)
+    is_admin = _sql.Column(_sql.Boolean, nullable=False, default=False, server_default=_sql.false())
+    # Bumped when existing predictions of the user change in place (overlays, re-gating, storage
+    # maintenance); part of the history ETag, alongside the newest prediction id and the count
+    history_revision = _sql.Column(_sql.Integer, nullable=False, default=0, server_default="0")
     predictions = _orm.relationship("Prediction", back_populates="owner")
 
     def verify_password(self, password: str):
-        return _hash.bcrypt.verify(password, self.hashed_password)
+        return passwords.verify_and_update(password, self.hashed_password)[0]
 
 # CORRECTED LINE 2: Inherit from Base
 class Patient(Base):
@@ -29,8 +36,15 @@ class Patient(Base):
     name = _sql.Column(_sql.String, nullable=False)
     age = _sql.Column(_sql.Integer, nullable=False)
     gender = _sql.Column(_sql.String, nullable=False)
+    # One row per (owner, patient_id); demographics follow the latest upload (see services.upsert_patient)
+    owner_id = _sql.Column(_sql.Integer, _sql.ForeignKey("users.id"), nullable=True)
     predictions = _orm.relationship("Prediction", back_populates="patient")
 
+    __table_args__ = (
+        # A unique index rather than a constraint, so migrations can add it to an existing table
+        _sql.Index("uq_patients_owner_patient_id", "owner_id", "patient_id", unique=True),
+    )
+
 # CORRECTED LINE 3: Inherit from Base
 class Prediction(Base):
     """Represents a single model prediction and its associated data."""
@@ -39,9 +53,100 @@ class Prediction(Base):
     predicted_class = _sql.Column(_sql.String, nullable=False)
     confidence = _sql.Column(_sql.Float, nullable=False)
     reason = _sql.Column(_sql.String, nullable=True)
-    image_url = _sql.Column(_sql.String, nullable=False)
+    image_url = _sql.Column(_sql.String, nullable=True)  # None until the overlay is rendered
+    # Set when the overlay was skipped under load (or invalidated by a re-gate); it is rendered on demand
+    overlay_pending = _sql.Column(_sql.Boolean, nullable=False, default=False, server_default=_sql.false())
+    original_url = _sql.Column(_sql.String, nullable=True)
+    # Set by the maintenance job when a referenced file no longer exists in storage
+    image_missing = _sql.Column(_sql.Boolean, nullable=False, default=False, server_default=_sql.false())
+    # L2-normalized ResNet50 pooled features as float16 (see vector_index.encode_embedding)
+    embedding = _sql.Column(_sql.LargeBinary, nullable=True)
+    # Raw model outputs for re-rendering and re-gating without the model (see ml_services "Stored Model Outputs"):
+    # calibrated float32 probabilities in label_map order, the compressed uint8 coarse CAM,
+    # and the CAM area above each 8-bit level of the full-resolution heatmap
+    probabilities = _sql.Column(_sql.LargeBinary, nullable=True)
+    cam = _sql.Column(_sql.LargeBinary, nullable=True)
+    cam_area_curve = _sql.Column(_sql.LargeBinary, nullable=True)
+    # Registry version of the model that produced the result (see model_registry)
+    model_version = _sql.Column(_sql.String, nullable=True)
+    # 64-bit perceptual hash, plus its four 16-bit bands for indexed near-duplicate lookup
+    phash = _sql.Column(_sql.BigInteger, nullable=True)
+    phash_b0 = _sql.Column(_sql.Integer, nullable=True)
+    phash_b1 = _sql.Column(_sql.Integer, nullable=True)
+    phash_b2 = _sql.Column(_sql.Integer, nullable=True)
+    phash_b3 = _sql.Column(_sql.Integer, nullable=True)
+    # Earlier prediction this scan is a near-duplicate of; result_reused when its result was returned as-is
+    duplicate_of_id = _sql.Column(_sql.Integer, _sql.ForeignKey("predictions.id"), nullable=True)
+    result_reused = _sql.Column(_sql.Boolean, nullable=False, default=False, server_default=_sql.false())
     prediction_timestamp = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
     owner_id = _sql.Column(_sql.Integer, _sql.ForeignKey("users.id"))
     patient_record_id = _sql.Column(_sql.Integer, _sql.ForeignKey("patients.id"))
     owner = _orm.relationship("User", back_populates="predictions")
-    patient = _orm.relationship("Patient", back_populates="predictions")
\ No newline at end of file
+    patient = _orm.relationship("Patient", back_populates="predictions")
+
+    __table_args__ = tuple(
+        _sql.Index(f"ix_predictions_owner_phash_b{band}", "owner_id", f"phash_b{band}") for band in range(4)
+    ) + (
+        _sql.Index("ix_predictions_patient_timestamp", "patient_record_id", "prediction_timestamp"),  # Patient timelines
+        _sql.Index("ix_predictions_owner_timestamp_id", "owner_id", "prediction_timestamp", "id"),  # History pages
+    )
+class DailyPredictionStats(Base):
+    """
+    Per user, UTC day and predicted class: how many predictions and their summed
+    confidence. Maintained in the transaction of every prediction insert (see stats.py).
+    """
+    __tablename__ = "daily_prediction_stats"
+    user_id = _sql.Column(_sql.Integer, _sql.ForeignKey("users.id"), primary_key=True)
+    day = _sql.Column(_sql.Date, primary_key=True)
+    predicted_class = _sql.Column(_sql.String, primary_key=True)
+    prediction_count = _sql.Column(_sql.Integer, nullable=False, default=0)
+    confidence_sum = _sql.Column(_sql.Float, nullable=False, default=0.0)
+
+class RefreshToken(Base):
+    """
+    A refresh token, stored only as its keyed hash (see credentials.py). Rotation
+    marks a token replaced and issues the next one of the same family; presenting
+    a replaced token again revokes the whole family.
+    """
+    __tablename__ = "refresh_tokens"
+    id = _sql.Column(_sql.Integer, primary_key=True, index=True)
+    user_id = _sql.Column(_sql.Integer, _sql.ForeignKey("users.id"), nullable=False, index=True)
+    token_hash = _sql.Column(_sql.String, nullable=False, unique=True, index=True)
+    family = _sql.Column(_sql.String, nullable=False, index=True)  # Shared by every rotation of one sign-in
+    created_at = _sql.Column(_sql.DateTime, nullable=False, default=_dt.datetime.utcnow)
+    expires_at = _sql.Column(_sql.DateTime, nullable=False)
+    replaced_at = _sql.Column(_sql.DateTime, nullable=True)
+    revoked_at = _sql.Column(_sql.DateTime, nullable=True)
+
+class ApiKey(Base):
+    """A long-lived, scoped credential for machine clients, stored only as its keyed hash."""
+    __tablename__ = "api_keys"
+    id = _sql.Column(_sql.Integer, primary_key=True, index=True)
+    user_id = _sql.Column(_sql.Integer, _sql.ForeignKey("users.id"), nullable=False, index=True)
+    name = _sql.Column(_sql.String, nullable=False)
+    key_hash = _sql.Column(_sql.String, nullable=False, unique=True, index=True)
+    prefix = _sql.Column(_sql.String, nullable=False)  # Leading characters of the key, to recognise it in listings
+    scopes = _sql.Column(_sql.String, nullable=False)  # Space-separated, see credentials.GRANTABLE_SCOPES
+    created_at = _sql.Column(_sql.DateTime, nullable=False, default=_dt.datetime.utcnow)
+    expires_at = _sql.Column(_sql.DateTime, nullable=True)
+    revoked_at = _sql.Column(_sql.DateTime, nullable=True)
+
+class PredictionScore(Base):
+    """A prediction's original re-scored by another model version (see rescore.py)."""
+    __tablename__ = "prediction_scores"
+    id = _sql.Column(_sql.Integer, primary_key=True, index=True)
+    prediction_id = _sql.Column(_sql.Integer, _sql.ForeignKey("predictions.id"), nullable=False, index=True)
+    model_version = _sql.Column(_sql.String, nullable=False)
+    predicted_class = _sql.Column(_sql.String, nullable=False)
+    confidence = _sql.Column(_sql.Float, nullable=False)
+    reason = _sql.Column(_sql.String, nullable=True)
+    # Same encodings as the Prediction columns
+    probabilities = _sql.Column(_sql.LargeBinary, nullable=True)
+    cam = _sql.Column(_sql.LargeBinary, nullable=True)
+    cam_area_curve = _sql.Column(_sql.LargeBinary, nullable=True)
+    scored_at = _sql.Column(_sql.DateTime, default=_dt.datetime.utcnow)
+
+    __table_args__ = (
+        # Also the resume point: the highest prediction_id scored by a version
+        _sql.UniqueConstraint("model_version", "prediction_id", name="uq_prediction_scores_version_prediction"),
+    )
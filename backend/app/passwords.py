@@ -0,0 +1,108 @@
+"""
+Password hashing off the request path.
+
+Hashes are computed and verified on a small dedicated thread pool
+(PASSWORD_HASH_WORKERS), apart from the inference workers and the shared
+request threadpool, so a login burst can take at most that many cores. At most
+PASSWORD_HASH_MAX_PENDING calls wait for the pool; beyond that callers get
+HashingBusy (503 + Retry-After) instead of queueing without bound.
+
+Stored hashes that use another scheme or cost than the configured one still
+verify, and are replaced with a current hash on the next successful login.
+"""
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Tuple
+
+from passlib.context import CryptContext
+from passlib.exc import MissingBackendError
+
+# --- Configuration ---
+PASSWORD_HASH_SCHEME = os.getenv("PASSWORD_HASH_SCHEME", "bcrypt")  # bcrypt, argon2 or pbkdf2_sha256
+# Cost (bcrypt log2 rounds, argon2 time cost, pbkdf2 iterations); unset = passlib's default
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS")) if os.getenv("PASSWORD_HASH_ROUNDS") else None
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", 2))
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", 64))
+
+# Schemes existing hashes may use; all but the configured one are deprecated (rehashed on login)
+SCHEMES = ("bcrypt", "argon2", "pbkdf2_sha256")
+
+
+class HashingBusy(Exception):
+    """Raised when more than PASSWORD_HASH_MAX_PENDING hashing calls are waiting."""
+    def __init__(self, detail: str = "Too many sign-ins in progress", retry_after: int = 1):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+def _context() -> CryptContext:
+    if PASSWORD_HASH_SCHEME not in SCHEMES:
+        raise ValueError(f"PASSWORD_HASH_SCHEME must be one of {', '.join(SCHEMES)}")
+    settings = {}
+    if PASSWORD_HASH_ROUNDS is not None:
+        # min = max = default: a hash with any other cost counts as outdated
+        for key in ("default_rounds", "min_rounds", "max_rounds"):
+            settings[f"{PASSWORD_HASH_SCHEME}__{key}"] = PASSWORD_HASH_ROUNDS
+    schemes = [PASSWORD_HASH_SCHEME] + [scheme for scheme in SCHEMES if scheme != PASSWORD_HASH_SCHEME]
+    context = CryptContext(schemes=schemes, default=PASSWORD_HASH_SCHEME, deprecated="auto", **settings)
+    # Fail at startup, not on the first sign-up, when the scheme's library is missing
+    handler = context.handler(PASSWORD_HASH_SCHEME)
+    if hasattr(handler, "get_backend"):
+        try:
+            handler.get_backend()
+        except MissingBackendError as e:
+            raise RuntimeError(f"PASSWORD_HASH_SCHEME={PASSWORD_HASH_SCHEME} needs its library: {e}") from e
+    return context
+
+
+context = _context()
+
+
+def hash_password(password: str) -> str:
+    return context.hash(password)
+
+
+def verify_and_update(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    """
+    (valid, new_hash): new_hash is a replacement for `hashed` when the password
+    is valid but the stored hash uses outdated parameters, else None.
+    """
+    try:
+        return context.verify_and_update(password, hashed)
+    except ValueError:  # Unrecognised or malformed stored hash
+        return False, None
+
+
+# --- Bounded executor for request handlers ---
+_executor: Optional[ThreadPoolExecutor] = None
+_pending = 0  # Only touched from the event loop
+
+
+async def _run(fn, *args):
+    global _executor, _pending
+    if _pending >= PASSWORD_HASH_MAX_PENDING:
+        raise HashingBusy()
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password")
+    _pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_executor, fn, *args)
+    finally:
+        _pending -= 1
+
+
+async def hash_password_async(password: str) -> str:
+    return await _run(hash_password, password)
+
+
+async def verify_and_update_async(password: str, hashed: str) -> Tuple[bool, Optional[str]]:
+    return await _run(verify_and_update, password, hashed)
+
+
+def shutdown():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
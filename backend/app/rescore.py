@@ -0,0 +1,202 @@
+"""
+Bulk re-scoring of historical predictions with a new model.
+
+    python -m app.rescore --model-path outputs/new_model.pt [--model-version v2] [--label-map outputs/v2.json] [--workers N]
+
+Streams the stored originals of all predictions, decodes and resizes them in
+worker processes, runs batched inference in the main process and bulk-inserts
+the results as PredictionScore rows tagged with the model version. Live
+predictions are left untouched. Interrupted runs resume after the last
+committed batch of the same version.
+
+The checkpoint's class names come from --label-map, else from the label map
+registered for --model-version (see model_registry), else from the default one.
+"""
+import argparse
+import hashlib
+import multiprocessing
+import os
+import time
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+import cv2
+import sqlalchemy as _sql
+import torch
+
+from . import database, ml_services, model_registry, models, storage
+
+# --- Configuration ---
+RESCORE_BATCH_SIZE = int(os.getenv("RESCORE_BATCH_SIZE", 32))  # images per forward pass
+RESCORE_COMMIT_EVERY = int(os.getenv("RESCORE_COMMIT_EVERY", 256))  # rows per insert + commit
+RESCORE_NICE = int(os.getenv("RESCORE_NICE", 10))  # Yield the CPU to the live API on a shared box
+FETCH_BATCH_SIZE = 1000
+
+
+def checkpoint_version(model_path: Path) -> str:
+    """Default model version: a short content hash of the checkpoint."""
+    digest = hashlib.sha256()
+    with open(model_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()[:12]
+
+
+def resume_after(db, model_version: str) -> int:
+    """Highest prediction id already scored by `model_version` (0 if none)."""
+    last = (
+        db.query(_sql.func.max(models.PredictionScore.prediction_id))
+        .filter(models.PredictionScore.model_version == model_version)
+        .scalar()
+    )
+    return last or 0
+
+
+def iter_originals(db, after_id: int) -> Iterator[Tuple[int, str]]:
+    """(prediction id, original key) for predictions with a stored original, in id order (keyset paginated)."""
+    while True:
+        rows = (
+            db.query(models.Prediction.id, models.Prediction.original_url)
+            .filter(models.Prediction.id > after_id, models.Prediction.original_url.isnot(None))
+            .order_by(models.Prediction.id)
+            .limit(FETCH_BATCH_SIZE)
+            .all()
+        )
+        if not rows:
+            return
+        yield from rows
+        after_id = rows[-1].id
+
+
+def _windows(items, size):
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) >= size:
+            yield window
+            window = []
+    if window:
+        yield window
+
+
+# --- Worker Processes ---
+def _init_worker(nice: int):
+    if nice:
+        os.nice(nice)
+    cv2.setNumThreads(1)  # One image per process; avoid oversubscribing the cores
+    torch.set_num_threads(1)
+
+
+def _load(item: Tuple[int, str]):
+    """Reads, decodes and resizes one original. Returns (id, resized uint8 image or None)."""
+    prediction_id, key = item
+    try:
+        img = ml_services.decode_image(storage.get_storage().read(key))
+        return prediction_id, ml_services.resize_for_model(img)
+    except Exception:  # Missing or undecodable originals are reported and skipped
+        return prediction_id, None
+
+def resolve_label_map(model_version: str, label_map_path: Optional[Path] = None) -> Path:
+    if label_map_path is not None:
+        return label_map_path
+    registered = model_registry.registry.label_map_paths().get(model_version)
+    return model_registry.resolve_model_file(registered) if registered else ml_services.LABEL_MAP_PATH
+
+
+# --- Pipeline ---
+def rescore(model_path: Path, model_version: Optional[str] = None, workers: Optional[int] = None,
+            threads: Optional[int] = None, limit: Optional[int] = None, nice: int = RESCORE_NICE,
+            label_map_path: Optional[Path] = None) -> dict:
+    model_version = model_version or checkpoint_version(model_path)
+    # Loaded before the workers start, so a checkpoint that does not match its label map fails fast
+    model_instance = ml_services.LoadedModel(model_path, resolve_label_map(model_version, label_map_path))
+    workers = workers or max(1, (os.cpu_count() or 2) - 1)
+    # Spawned workers never share torch's thread pools with the parent
+    pool = multiprocessing.get_context("spawn").Pool(workers, initializer=_init_worker, initargs=(nice,))
+    if nice:
+        os.nice(nice)
+    if threads:
+        torch.set_num_threads(threads)
+
+    read_db, write_db = database.SessionLocal(), database.SessionLocal()
+    stats = {"model_version": model_version, "scored": 0, "skipped": 0}
+    started = time.monotonic()
+    try:
+        after_id = resume_after(write_db, model_version)
+        stats["resumed_after"] = after_id
+        items = iter_originals(read_db, after_id)
+        if limit:
+            items = (item for _, item in zip(range(limit), items))
+
+        batch_ids, batch_images, pending = [], [], []
+
+        def run_batch():
+            tens = torch.cat([ml_services.to_model_tensor(image) for image in batch_images])
+            _, results = ml_services.score_batch(model_instance, tens)
+            for prediction_id, result in zip(batch_ids, results):
+                pending.append({
+                    "prediction_id": prediction_id,
+                    "model_version": model_version,
+                    "predicted_class": result["class"],
+                    "confidence": result["confidence"],
+                    "reason": result["reason"],
+                    "probabilities": result["probabilities"],
+                    "cam": result["cam"],
+                    "cam_area_curve": result["cam_area_curve"],
+                })
+            batch_ids.clear()
+            batch_images.clear()
+
+        def flush():
+            # Rows are written in id order, so the highest committed id is a safe resume point
+            write_db.execute(_sql.insert(models.PredictionScore), pending)
+            write_db.commit()
+            stats["scored"] += len(pending)
+            pending.clear()
+            rate = stats["scored"] / max(time.monotonic() - started, 1e-6)
+            print(f"{stats['scored']} scored ({rate:.1f}/s), {stats['skipped']} skipped", flush=True)
+
+        # The workers decode window N+1 while the model runs on window N; at
+        # most two windows of images are in memory
+        windows = _windows(items, RESCORE_BATCH_SIZE * 4)
+        ahead = pool.imap(_load, next(windows, []), chunksize=4)
+        while ahead is not None:
+            window = next(windows, None)
+            current, ahead = ahead, (pool.imap(_load, window, chunksize=4) if window else None)
+            for prediction_id, image in current:  # imap keeps input (id) order
+                if image is None:
+                    stats["skipped"] += 1
+                    continue
+                batch_ids.append(prediction_id)
+                batch_images.append(image)
+                if len(batch_images) >= RESCORE_BATCH_SIZE:
+                    run_batch()
+                if len(pending) >= RESCORE_COMMIT_EVERY:
+                    flush()
+        if batch_images:
+            run_batch()
+        if pending:
+            flush()
+    finally:
+        pool.terminate()
+        read_db.close()
+        write_db.close()
+    stats["seconds"] = round(time.monotonic() - started, 1)
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.rescore", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--model-path", type=Path, default=ml_services.MODEL_PATH)
+    parser.add_argument("--model-version", help="tag for the new scores (default: checkpoint hash)")
+    parser.add_argument("--label-map", type=Path, help="class names of the checkpoint (default: registered or default)")
+    parser.add_argument("--workers", type=int, help="decode processes (default: CPU count - 1)")
+    parser.add_argument("--threads", type=int, help="torch threads for inference")
+    parser.add_argument("--limit", type=int, help="stop after this many predictions")
+    parser.add_argument("--nice", type=int, default=RESCORE_NICE)
+    args = parser.parse_args(argv)
+    print(rescore(args.model_path, args.model_version, args.workers, args.threads, args.limit, args.nice, args.label_map))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import asyncio
+import collections
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, Hashable, Optional
+
+from starlette.responses import JSONResponse
+
+# --- Configuration ---
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", 1))
+INFERENCE_QUEUE_MAX_DEPTH = int(os.getenv("INFERENCE_QUEUE_MAX_DEPTH", 16))
+INFERENCE_QUEUE_MAX_WAIT_SECONDS = float(os.getenv("INFERENCE_QUEUE_MAX_WAIT_SECONDS", 10))
+INFERENCE_REQUEST_TIMEOUT_SECONDS = float(os.getenv("INFERENCE_REQUEST_TIMEOUT_SECONDS", 30))
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+UPLOAD_FORM_OVERHEAD_BYTES = 64 * 1024  # Multipart boundaries and text fields on top of the file itself
+
+# --- Load Shedding Thresholds ---
+# Above either threshold new predictions skip the overlay (prediction-only mode)
+DEGRADE_QUEUE_DEPTH = int(os.getenv("DEGRADE_QUEUE_DEPTH", max(1, INFERENCE_QUEUE_MAX_DEPTH // 2)))
+DEGRADE_LATENCY_SECONDS = float(os.getenv("DEGRADE_LATENCY_SECONDS", 5))
+
+# --- Priority Classes and Per-User Limits ---
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = (INTERACTIVE, BULK)  # Dispatch order: interactive work always goes first
+# Bulk work may only fill part of the queue, so an interactive upload always finds
+# room. With several workers it also never occupies all of them. A single worker
+# has to be shared: interactive jobs are dispatched first and bulk jobs are kept
+# short (volumes run one slice batch per job), so an interactive scan waits for
+# at most one bulk batch.
+BULK_MAX_QUEUED = int(os.getenv("SCHED_BULK_MAX_QUEUED", max(1, INFERENCE_QUEUE_MAX_DEPTH // 2)))
+BULK_MAX_RUNNING = int(os.getenv("SCHED_BULK_MAX_RUNNING", max(1, INFERENCE_WORKERS - 1)))
+# Defaults for users without an explicit limit (models.User.max_concurrent_inferences)
+USER_MAX_RUNNING = int(os.getenv("SCHED_USER_MAX_RUNNING", max(1, INFERENCE_WORKERS // 2)))
+USER_MAX_QUEUED = int(os.getenv("SCHED_USER_MAX_QUEUED", max(1, INFERENCE_QUEUE_MAX_DEPTH // 4)))
+
+
+class InferenceRejected(Exception):
+    """
+    Raised when a request is refused or dropped by the scheduler.
+    `retry_after` is the number of seconds the client should wait before retrying.
+    """
+    def __init__(self, detail: str, retry_after: int = 1, status_code: int = 503):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+        self.status_code = status_code
+
+
+class _Job:
+    __slots__ = ("fn", "future", "enqueued_at", "deadline", "is_disconnected", "user", "priority", "max_running")
+
+    def __init__(self, fn, future, deadline, is_disconnected, user, priority, max_running):
+        self.fn = fn
+        self.future = future
+        self.enqueued_at = time.monotonic()
+        self.deadline = deadline
+        self.is_disconnected = is_disconnected
+        self.user = user
+        self.priority = priority
+        self.max_running = max_running
+
+
+class InferenceScheduler:
+    """
+    Bounded, priority-aware queue in front of the model.
+
+    A fixed number of workers pull jobs from the queue and run them in a thread
+    pool, so at most `workers` inferences compete for the CPU at any time. New work
+    is refused once `max_depth` jobs are waiting, and queued jobs are dropped before
+    reaching the model if they waited longer than `max_wait`, passed their deadline
+    or their client disconnected.
+
+    Interactive jobs are always dispatched before bulk ones. Within a class, the
+    next job comes from the backlogged user who has consumed the least worker time
+    (start-time fair queueing), subject to each user's concurrency limit.
+    """
+    def __init__(self, workers: int = INFERENCE_WORKERS, max_depth: int = INFERENCE_QUEUE_MAX_DEPTH,
+                 max_wait: float = INFERENCE_QUEUE_MAX_WAIT_SECONDS,
+                 degrade_depth: int = DEGRADE_QUEUE_DEPTH, degrade_latency: float = DEGRADE_LATENCY_SECONDS,
+                 bulk_max_queued: int = BULK_MAX_QUEUED, bulk_max_running: int = BULK_MAX_RUNNING,
+                 user_max_running: int = USER_MAX_RUNNING, user_max_queued: int = USER_MAX_QUEUED):
+        self.workers = max(1, workers)
+        self.max_depth = max_depth
+        self.max_wait = max_wait
+        self.degrade_depth = degrade_depth
+        self.degrade_latency = degrade_latency
+        self.bulk_max_queued = bulk_max_queued
+        self.bulk_max_running = bulk_max_running
+        self.user_max_running = user_max_running
+        self.user_max_queued = user_max_queued
+        # priority -> user -> FIFO of that user's jobs
+        self._queues = {priority: collections.OrderedDict() for priority in PRIORITIES}
+        self._queued = collections.Counter()  # by priority
+        self._queued_by_user = collections.Counter()
+        self._running = collections.Counter()  # by priority
+        self._running_by_user = collections.Counter()
+        # Worker seconds consumed per user; the virtual clock lets returning users
+        # re-enter at the current level instead of cashing in their idle time
+        self._usage = {}
+        self._vclock = 0.0
+        self._executor = None
+        self._ready = None
+        self._tasks = []
+        # Exponentially weighted average of the time a job spends on a worker
+        self.avg_service_time = 1.0
+        # Same for the time from enqueue to completion, as seen by the client
+        self.recent_latency = 0.0
+
+    # --- Lifecycle ---
+    async def start(self):
+        # asyncio primitives are created here so they bind to the server's event loop
+        self._ready = asyncio.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="inference")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for users in self._queues.values():
+            for jobs in users.values():
+                for job in jobs:
+                    if not job.future.done():
+                        job.future.set_exception(InferenceRejected("Server is shutting down.", retry_after=5))
+            users.clear()
+        self._queued.clear()
+        self._queued_by_user.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    # --- Admission ---
+    @property
+    def depth(self) -> int:
+        return sum(self._queued.values())
+
+    @property
+    def running(self) -> int:
+        return sum(self._running.values())
+
+    def retry_after(self) -> int:
+        """Rough estimate of how long it takes to drain the current backlog."""
+        backlog = self.depth + self.running
+        return max(1, math.ceil(self.avg_service_time * backlog / self.workers))
+
+    @property
+    def overloaded(self) -> bool:
+        """True while the queue or recent latency is past the load shedding thresholds."""
+        return self.depth >= self.degrade_depth or self.recent_latency >= self.degrade_latency
+
+    def ensure_capacity(self, user: Hashable = None, priority: str = INTERACTIVE):
+        """
+        Cheap admission check. UploadAdmissionMiddleware runs it (without user
+        and class) before the upload body is read; handlers repeat it per user and
+        class once the form is parsed.
+        """
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority class '{priority}'")
+        if self.depth >= self.max_depth or (priority == BULK and self._queued[BULK] >= self.bulk_max_queued):
+            raise InferenceRejected("Server is busy, please retry later.", retry_after=self.retry_after())
+        if user is not None and self._queued_by_user[user] >= self.user_max_queued:
+            raise InferenceRejected("Too many queued requests for this user.",
+                                    retry_after=self.retry_after(), status_code=429)
+
+    async def submit(self, fn: Callable, timeout: float = INFERENCE_REQUEST_TIMEOUT_SECONDS,
+                     is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+                     user: Hashable = None, priority: str = INTERACTIVE, max_running: Optional[int] = None):
+        """
+        Queues `fn` for execution on an inference worker and waits for its result.
+        `user` keys fair sharing and per-user limits; `max_running` overrides the
+        default concurrency limit for that user.
+        Raises InferenceRejected when the queue is full or the deadline passes.
+        """
+        self.ensure_capacity(user, priority)
+        loop = asyncio.get_running_loop()
+        job = _Job(fn, loop.create_future(), time.monotonic() + timeout, is_disconnected,
+                   user, priority, max_running or self.user_max_running)
+        async with self._ready:
+            self._enqueue(job)
+            self._ready.notify()
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(job.future), timeout)
+        except asyncio.TimeoutError:
+            self._discard(job)
+            raise InferenceRejected("Inference deadline exceeded.", retry_after=self.retry_after())
+        except asyncio.CancelledError:
+            self._discard(job)
+            raise
+
+    # --- Queue Bookkeeping ---
+    def _enqueue(self, job: _Job):
+        if not self._queued_by_user[job.user] and not self._running_by_user[job.user]:
+            self._usage[job.user] = max(self._usage.get(job.user, 0.0), self._vclock)
+        self._queues[job.priority].setdefault(job.user, collections.deque()).append(job)
+        self._queued[job.priority] += 1
+        self._queued_by_user[job.user] += 1
+
+    def _remove(self, job: _Job, jobs: collections.deque):
+        jobs.remove(job)
+        if not jobs:
+            del self._queues[job.priority][job.user]
+        self._queued[job.priority] -= 1
+        self._queued_by_user[job.user] -= 1
+
+    def _discard(self, job: _Job):
+        # Cancelling the future tells a worker that already picked the job up to ignore its result
+        job.future.cancel()
+        jobs = self._queues[job.priority].get(job.user)
+        if jobs is not None and job in jobs:
+            self._remove(job, jobs)
+            self._forget_idle(job.user)
+
+    def _pop(self) -> Optional[_Job]:
+        """Picks the next job to dispatch, or None if nothing is currently eligible."""
+        for priority in PRIORITIES:
+            if priority == BULK and self._running[BULK] >= self.bulk_max_running:
+                continue
+            best = None
+            for user, jobs in self._queues[priority].items():
+                if self._running_by_user[user] >= jobs[0].max_running:
+                    continue
+                if best is None or self._usage[user] < self._usage[best[0]]:
+                    best = (user, jobs)
+            if best is not None:
+                user, jobs = best
+                job = jobs[0]
+                self._remove(job, jobs)
+                self._vclock = max(self._vclock, self._usage[user])
+                return job
+        return None
+
+    # --- Workers ---
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self._ready:
+                job = self._pop()
+                while job is None:
+                    await self._ready.wait()
+                    job = self._pop()
+                # Counted as running from the moment it is picked, so other workers
+                # respect the limits while this one checks whether to drop it
+                self._running[job.priority] += 1
+                self._running_by_user[job.user] += 1
+
+            started = time.monotonic()
+            try:
+                if job.future.done():
+                    continue
+                reason = await self._drop_reason(job)
+                if reason:
+                    job.future.set_exception(InferenceRejected(reason, retry_after=self.retry_after()))
+                    continue
+                try:
+                    result = await loop.run_in_executor(self._executor, job.fn)
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                else:
+                    if not job.future.done():
+                        job.future.set_result(result)
+                finished = time.monotonic()
+                self._usage[job.user] = self._usage.get(job.user, 0.0) + (finished - started)
+                self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * (finished - started)
+                self.recent_latency = 0.8 * self.recent_latency + 0.2 * (finished - job.enqueued_at)
+            finally:
+                self._running[job.priority] -= 1
+                self._running_by_user[job.user] -= 1
+                self._forget_idle(job.user)
+                # Finishing may make jobs held back by a concurrency limit eligible
+                async with self._ready:
+                    self._ready.notify_all()
+
+    def _forget_idle(self, user: Hashable):
+        if not self._queued_by_user[user] and not self._running_by_user[user]:
+            del self._queued_by_user[user]
+            del self._running_by_user[user]
+            # Keep the usage entry small: idle users restart at the virtual clock anyway
+            self._usage.pop(user, None)
+
+    async def _drop_reason(self, job: _Job) -> Optional[str]:
+        now = time.monotonic()
+        if now >= job.deadline:
+            return "Inference deadline exceeded."
+        if now - job.enqueued_at > self.max_wait:
+            return "Server is busy, please retry later."
+        if job.is_disconnected is not None and await job.is_disconnected():
+            return "Client disconnected."
+        return None
+
+
+inference_scheduler = InferenceScheduler()
+
+
+class UploadAdmissionMiddleware:
+    """
+    Refuses inference uploads before their body is read. FastAPI parses and
+    spools File(...) bodies before the handler runs, so checks in the handler come
+    too late to save the transfer. This one applies the size limit (from
+    Content-Length, which uploads must send) and the global queue check; the
+    per-user and per-class checks need the caller and the form, so they stay in
+    the handlers.
+    """
+    def __init__(self, app, limits: Dict[str, int], scheduler: Optional[InferenceScheduler] = None):
+        self.app = app
+        self.limits = limits  # path -> maximum file bytes
+        self.scheduler = scheduler
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "POST" and scope["path"] in self.limits:
+            refusal = self._refusal(scope)
+            if refusal is not None:
+                await refusal(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+    def _refusal(self, scope) -> Optional[JSONResponse]:
+        length = dict(scope["headers"]).get(b"content-length")
+        if length is None:
+            return JSONResponse(status_code=411, content={"detail": "Uploads must send a Content-Length header."})
+        try:
+            length = int(length)
+        except ValueError:
+            return JSONResponse(status_code=400, content={"detail": "Invalid Content-Length header."})
+        if length > self.limits[scope["path"]] + UPLOAD_FORM_OVERHEAD_BYTES:
+            return JSONResponse(status_code=413, content={"detail": "Upload is too large."})
+        try:
+            (self.scheduler or inference_scheduler).ensure_capacity()
+        except InferenceRejected as e:
+            return JSONResponse(status_code=e.status_code, content={"detail": e.detail},
+                                headers={"Retry-After": str(e.retry_after)})
+        return None
@@ -1,5 +1,7 @@
-from pydantic import BaseModel
+from typing import List, Optional
+from pydantic import BaseModel, field_serializer, field_validator
 import datetime as _dt
+from .storage import get_storage
 
 # --- Base Schemas ---
 # These have fields that are shared when creating or reading data.
@@ -17,7 +19,15 @@ class _PredictionBase(BaseModel):
     predicted_class: str
     confidence: float
     reason: str
-    image_url: str
+    image_url: Optional[str] = None
+    overlay_pending: bool = False
+    image_missing: bool = False
+    duplicate_of_id: Optional[int] = None
+    result_reused: bool = False
+    model_version: Optional[str] = None
+
+    class Config:
+        protected_namespaces = ()  # Allow the "model_" field names
 
 # --- Schemas for Creating Data ---
 # These are used when a user sends data to the API (e.g., signing up).
@@ -50,6 +60,11 @@ class Prediction(_PredictionBase):
     owner_id: int
     patient_record_id: int
     prediction_timestamp: _dt.datetime
+
+    # The column holds a storage key; clients get a URL they can load
+    @field_serializer("image_url")
+    def _image_url(self, key: Optional[str]):
+        return get_storage().url(key) if key else None
     class Config:
         orm_mode = True
 
@@ -57,4 +72,81 @@ class PredictionWithPatient(Prediction):
     patient: Patient
 
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+class PatientTimeline(Patient):
+    predictions: List[Prediction]  # Oldest first
+
+class SimilarCase(BaseModel):
+    similarity: float
+    prediction: PredictionWithPatient
+
+class ClassStats(BaseModel):
+    predicted_class: str
+    count: int
+    mean_confidence: float
+
+class DailyClassCount(BaseModel):
+    day: _dt.date
+    predicted_class: str
+    count: int
+
+class UserStats(BaseModel):
+    total: int
+    by_class: List[ClassStats]
+    daily: List[DailyClassCount]  # UTC days, oldest first
+
+# --- Users (admin) ---
+
+class UserUpdate(BaseModel):
+    is_admin: Optional[bool] = None
+    max_concurrent_inferences: Optional[int] = None  # Scheduler limit override
+
+# --- Credentials ---
+
+class Token(BaseModel):
+    access_token: str
+    token_type: str = "bearer"
+    refresh_token: str
+
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
+class ApiKeyCreate(BaseModel):
+    name: str
+    scopes: List[str] = ["predict", "read"]  # See credentials.GRANTABLE_SCOPES
+    expires_in_days: Optional[int] = None  # None = until revoked
+
+class ApiKey(BaseModel):
+    id: int
+    name: str
+    prefix: str
+    scopes: List[str]
+    created_at: _dt.datetime
+    expires_at: Optional[_dt.datetime] = None
+    revoked_at: Optional[_dt.datetime] = None
+
+    @field_validator("scopes", mode="before")
+    @classmethod
+    def split_scopes(cls, scopes):
+        return scopes.split() if isinstance(scopes, str) else scopes
+
+    class Config:
+        orm_mode = True
+
+class ApiKeyCreated(ApiKey):
+    key: str  # Only ever returned here; the server keeps a hash
+
+# --- Model Registry (admin) ---
+
+class ModelRegistration(BaseModel):
+    version: str
+    model_path: str  # Relative to the model directory
+    label_map_path: str = "label_map.json"
+
+    class Config:
+        protected_namespaces = ()
+
+class ShadowConfig(BaseModel):
+    version: Optional[str] = None  # None turns shadow inference off
+    fraction: float = 0.1
@@ -0,0 +1,77 @@
+"""
+Fast JSON path for list endpoints.
+
+List endpoints select plain row tuples (see services.HISTORY_COLUMNS) and turn
+them into dicts here, skipping per-object Pydantic validation; the dicts follow
+the field order and encodings of the response schemas exactly. FastJSONResponse
+encodes with orjson when it is installed, else with the standard library.
+"""
+import datetime as _dt
+import json
+from typing import Any, Iterable, List
+
+from fastapi.responses import JSONResponse
+
+from . import schemas
+from .storage import get_storage
+
+try:
+    import orjson
+except ImportError:  # Optional: same output, slower
+    orjson = None
+
+# Field order of the response schemas, which is also the column order of
+# services.PREDICTION_COLUMNS and HISTORY_COLUMNS
+PREDICTION_FIELDS = list(schemas.Prediction.model_fields)
+PATIENT_FIELDS = list(schemas.Patient.model_fields)
+_PATIENT_PK = PATIENT_FIELDS.index("id")  # None when the prediction has no patient
+
+
+def _default(value):
+    if isinstance(value, (_dt.datetime, _dt.date)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, default=_default, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
+
+
+def prediction_dict(row, url) -> dict:
+    """
+    A schemas.Prediction as JSON-ready dict from a row whose first columns are
+    services.PREDICTION_COLUMNS (read by position: attribute access on rows is slow).
+    `url` maps a stored image key to its URL.
+    """
+    item = dict(zip(PREDICTION_FIELDS, row))
+    if item["image_url"]:
+        item["image_url"] = url(item["image_url"])
+    return item
+
+
+def prediction_with_patient_dict(row, url) -> dict:
+    """A schemas.PredictionWithPatient from a services.HISTORY_COLUMNS row."""
+    item = prediction_dict(row, url)
+    patient = row[len(PREDICTION_FIELDS):]
+    item["patient"] = dict(zip(PATIENT_FIELDS, patient)) if patient[_PATIENT_PK] is not None else None
+    return item
+
+
+def patient_timeline(patient, rows: Iterable) -> dict:
+    """A schemas.PatientTimeline from a Patient and its prediction rows."""
+    return {**{field: getattr(patient, field) for field in PATIENT_FIELDS}, "predictions": predictions(rows)}
+
+
+def predictions_with_patients(rows: Iterable) -> List[dict]:
+    return [prediction_with_patient_dict(row, get_storage().url) for row in rows]
+
+
+def predictions(rows: Iterable) -> List[dict]:
+    return [prediction_dict(row, get_storage().url) for row in rows]
@@ -1,12 +1,16 @@
+import base64
+import hashlib
 import os
+import time
 from datetime import datetime, timedelta, timezone
-from fastapi import Depends, HTTPException, status
-from fastapi.security import OAuth2PasswordBearer
-import passlib.hash as _hash
+from fastapi import Depends, HTTPException, Security, status
+from fastapi.security import OAuth2PasswordBearer, SecurityScopes
 from jose import JWTError, jwt
 import sqlalchemy.orm as _orm
+import sqlalchemy as _sql
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import joinedload 
-from . import models, database, schemas, services
+from . import models, database, schemas, services, ml_services, stats, auth_cache, passwords, credentials
 
 def get_user_by_email(db: _orm.Session, email: str):
     """
@@ -14,12 +18,14 @@ def get_user_by_email(db: _orm.Session, email: str):
     """
     return db.query(models.User).filter(models.User.email == email).first()
 
-def create_user(db: _orm.Session, user: schemas.UserCreate):
+def create_user(db: _orm.Session, user: schemas.UserCreate, hashed_password: str = None):
     """
     Creates a new user in the database with a hashed password.
+    Request handlers pass a hash computed with passwords.hash_password_async.
     """
     # Hash the user's password for security
-    hashed_password = _hash.bcrypt.hash(user.password)
+    if hashed_password is None:
+        hashed_password = passwords.hash_password(user.password)
     # Create a new User database model instance
     db_user = models.User(email=user.email, hashed_password=hashed_password)
     # Add the new user to the session and commit to the database
@@ -28,16 +34,45 @@ def create_user(db: _orm.Session, user: schemas.UserCreate):
     db.refresh(db_user) # Refresh to get the new ID from the DB
     return db_user
 
+def update_user(db: _orm.Session, user_id: int, changes: dict):
+    """
+    Applies `changes` to a user and drops it from the authentication cache.
+    Returns the user, or None if it does not exist.
+    """
+    db_user = db.query(models.User).filter(models.User.id == user_id).first()
+    if db_user is None:
+        return None
+    for field, value in changes.items():
+        setattr(db_user, field, value)
+    db.commit()
+    db.refresh(db_user)
+    auth_cache.invalidate_user(db_user.id, db_user.email)
+    return db_user
+
 SECRET_KEY = os.getenv("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 30))
 
-def authenticate_user(db, email, password):
-    user = get_user_by_email(db, email=email)
+def set_password_hash(db: _orm.Session, user: models.User, hashed_password: str):
+    """Replaces the stored hash of an unchanged password (see passwords.verify_and_update)."""
+    db.query(models.User).filter(models.User.id == user.id).update({"hashed_password": hashed_password})
+    db.commit()
+    auth_cache.invalidate_user(user.id, user.email)
+
+async def authenticate_user(db: AsyncSession, email: str, password: str):
+    """
+    The user for valid credentials, else False. The password is checked on the
+    passwords executor, and a stored hash with outdated parameters is replaced.
+    """
+    user = await db.run_sync(get_user_by_email, email)
+    await db.commit()  # Release the connection while the hash is checked
     if not user:
         return False
-    if not user.verify_password(password):
+    valid, new_hash = await passwords.verify_and_update_async(password, user.hashed_password)
+    if not valid:
         return False
+    if new_hash is not None:
+        await db.run_sync(set_password_hash, user, new_hash)
     return user
 
 def create_access_token(data: dict):
@@ -50,58 +85,365 @@ def create_access_token(data: dict):
 # This tells FastAPI where to look for the token (in the Authorization header)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def get_current_user(token: str = Depends(oauth2_scheme), db: _orm.Session = Depends(database.get_db)):
+def _load_user(subject):
+    """User row for a token subject, detached so it can be cached and shared across requests."""
+    db = database.SessionLocal()
+    try:
+        kind, value = subject
+        if kind == "id":
+            user = db.query(models.User).filter(models.User.id == value).first()
+        else:
+            user = get_user_by_email(db, email=value)
+        if user is not None:
+            db.expunge(user)
+        return user
+    finally:
+        db.close()
+
+def get_current_user(security_scopes: SecurityScopes, token: str = Depends(oauth2_scheme)):
+    """
+    Resolves the bearer token (a JWT access token or an API key) to its user.
+    Verified claims, API keys and user rows are cached (auth_cache), so a repeat
+    caller costs no JWT verification and no database round-trip; tokens from
+    before the uid claim are looked up by email. API keys must hold every scope
+    the endpoint declares (Security(get_current_user, scopes=[...])).
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+    if token.startswith(credentials.API_KEY_PREFIX):
+        principal = credentials.authenticate_api_key(token)
+        if principal is None:
+            raise credentials_exception
+        user_id, scopes = principal
+        missing = [scope for scope in security_scopes.scopes if scope not in scopes]
+        if missing:
+            raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=f"API key lacks scope: {' '.join(missing)}")
+        subject = ("id", user_id)
+    else:
+        payload = auth_cache.token_cache.get(token)
+        if payload is None:
+            try:
+                payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            except JWTError:
+                raise credentials_exception
+            auth_cache.token_cache.set(token, payload, ttl=payload.get("exp", 0) - time.time())
+        if payload.get("uid") is not None:
+            subject = ("id", payload["uid"])
+        elif payload.get("sub") is not None:
+            subject = ("email", payload["sub"])
+        else:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    
-    user = get_user_by_email(db, email=email)
+
+    user = auth_cache.user_cache.get(subject)
     if user is None:
-        raise credentials_exception
+        user = _load_user(subject)
+        if user is None:
+            raise credentials_exception
+        auth_cache.user_cache.set(subject, user)
     return user
 
-def create_patient(db: _orm.Session, patient: schemas.PatientCreate):
+def get_current_admin(current_user: models.User = Security(get_current_user, scopes=[credentials.ADMIN])):
+    if not current_user.is_admin:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin privileges required")
+    return current_user
+
+PATIENT_KEY = ("owner_id", "patient_id")
+
+def patient_upsert(dialect_name: str, rows):
+    """
+    INSERT ... ON CONFLICT (owner_id, patient_id) DO UPDATE for patient rows:
+    an existing patient keeps its id and takes the latest demographics.
+    Rows must not repeat an (owner_id, patient_id) pair.
+    """
+    stmt = database.dialect_insert(dialect_name)(models.Patient).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=list(PATIENT_KEY),
+        set_={column: stmt.excluded[column] for column in ("name", "age", "gender")},
+    ).returning(models.Patient.id, models.Patient.owner_id, models.Patient.patient_id)
+
+def upsert_patient(db: _orm.Session, patient: schemas.PatientCreate, owner_id: int) -> int:
+    """
+    Returns the id of the owner's record for this patient, creating it or
+    updating its demographics. Does not commit.
+    """
+    stmt = patient_upsert(db.get_bind().dialect.name, [dict(patient.dict(), owner_id=owner_id)])
+    return db.execute(stmt).one().id
+
+OUTPUT_COLUMNS = ("probabilities", "cam", "cam_area_curve")
+
+def prediction_values(prediction: schemas.PredictionCreate, user_id: int, original_url: str = None,
+                      embedding: bytes = None, phash: int = None, outputs: dict = None):
+    """
+    Column values of a new prediction, less its patient. Every prediction gets
+    the same set of keys, so rows from different requests can share one multi-row insert.
+    `outputs` holds the stored model outputs (probabilities, cam, cam_area_curve).
     """
-    Creates a new patient record in the database.
+    outputs = outputs or {}
+    return {
+        **prediction.dict(),
+        "owner_id": user_id,
+        "original_url": original_url,
+        "embedding": embedding,
+        **{column: outputs.get(column) for column in OUTPUT_COLUMNS},
+        **phash_columns(phash),
+    }
+
+def insert_patient_and_prediction(db: _orm.Session, patient: schemas.PatientCreate, values: dict):
     """
-    db_patient = models.Patient(**patient.dict())
-    db.add(db_patient)
+    Upserts a patient and writes its prediction in a single transaction. RETURNING hands
+    back the new rows, so no refresh SELECTs follow the commit.
+    Returns the prediction as a row of the predictions table.
+    """
+    patient_id = upsert_patient(db, patient, owner_id=values["owner_id"])
+    row = db.execute(
+        _sql.insert(models.Prediction)
+        .values(**values, patient_record_id=patient_id)
+        .returning(*models.Prediction.__table__.c)
+    ).one()
+    stats.record_predictions(db, [row])
     db.commit()
-    db.refresh(db_patient)
-    return db_patient
+    return row
+
+def create_prediction(db: _orm.Session, patient: schemas.PatientCreate, prediction: schemas.PredictionCreate,
+                      user_id: int, original_url: str = None, embedding: bytes = None, phash: int = None,
+                      outputs: dict = None):
+    """
+    Creates a new prediction record in the database, creating or updating its patient record.
+    """
+    values = prediction_values(prediction, user_id, original_url=original_url, embedding=embedding,
+                               phash=phash, outputs=outputs)
+    return insert_patient_and_prediction(db, patient, values)
 
-def create_prediction(db: _orm.Session, prediction: schemas.PredictionCreate, user_id: int, patient_id: int):
+def get_prediction_for_user(db: _orm.Session, prediction_id: int, user_id: int):
     """
-    Creates a new prediction record in the database, linked to a user and a patient.
+    Returns a single prediction if it belongs to the given user, otherwise None.
     """
-    db_prediction = models.Prediction(
-        **prediction.dict(), 
-        owner_id=user_id, 
-        patient_record_id=patient_id
+    return (
+        db.query(models.Prediction)
+        .filter(models.Prediction.id == prediction_id, models.Prediction.owner_id == user_id)
+        .first()
     )
-    db.add(db_prediction)
+
+def set_prediction_overlay(db: _orm.Session, db_prediction: models.Prediction, image_url: str):
+    """
+    Attaches a freshly rendered overlay to a prediction made in prediction-only mode.
+    """
+    db_prediction.image_url = image_url
+    db_prediction.overlay_pending = False
+    bump_history_revision(db, [db_prediction.owner_id])
     db.commit()
     db.refresh(db_prediction)
     return db_prediction
 
-# Find the get_predictions_for_user function and update it
-def get_predictions_for_user(db: _orm.Session, user_id: int):
+def reused_prediction_values(duplicate: models.Prediction, phash: int):
     """
-    Queries the database for all predictions made by a specific user.
+    Column values recording a re-submitted scan by copying the result of its
+    near-duplicate instead of running the model again.
     """
-    return (
+    prediction = schemas.PredictionCreate(
+        predicted_class=duplicate.predicted_class,
+        confidence=duplicate.confidence,
+        reason=duplicate.reason,
+        image_url=duplicate.image_url,
+        overlay_pending=duplicate.overlay_pending,
+        duplicate_of_id=duplicate.id,
+        result_reused=True,
+        model_version=duplicate.model_version,
+    )
+    return prediction_values(
+        prediction, duplicate.owner_id, original_url=duplicate.original_url, embedding=duplicate.embedding,
+        phash=phash, outputs={column: getattr(duplicate, column) for column in OUTPUT_COLUMNS},
+    )
+
+def reuse_prediction(db: _orm.Session, duplicate: models.Prediction, patient: schemas.PatientCreate, phash: int):
+    return insert_patient_and_prediction(db, patient, reused_prediction_values(duplicate, phash))
+
+def phash_columns(phash: int):
+    """
+    Splits a perceptual hash into the stored value and its four 16-bit bands.
+    Two hashes within Hamming distance 3 always share at least one band, so the
+    band indexes find every near-duplicate candidate.
+    """
+    if phash is None:
+        return {}
+    unsigned = phash & ((1 << 64) - 1)
+    bands = {f"phash_b{band}": (unsigned >> (16 * band)) & 0xFFFF for band in range(4)}
+    return {"phash": phash, **bands}
+
+def find_near_duplicate(db: _orm.Session, user_id: int, patient_id: str, phash: int, max_distance: int):
+    """
+    Returns the most recent prediction of this user for the same patient whose
+    scan is within `max_distance` bits of `phash`, or None.
+    """
+    bands = phash_columns(phash)
+    candidates = (
         db.query(models.Prediction)
-        .options(joinedload(models.Prediction.patient))  # eager load related patient
+        .join(models.Patient, models.Prediction.patient_record_id == models.Patient.id)
+        .filter(
+            models.Prediction.owner_id == user_id,
+            models.Patient.patient_id == patient_id,
+            _sql.or_(*[getattr(models.Prediction, f"phash_b{band}") == bands[f"phash_b{band}"] for band in range(4)]),
+        )
+        .order_by(models.Prediction.id.desc())
+        .all()
+    )
+    for candidate in candidates:
+        if ml_services.hamming_distance(candidate.phash, phash) <= max_distance:
+            return candidate
+    return None
+
+# --- History Pagination ---
+HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", 50))
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", 500))
+# Timestamps are set before commit, so a prediction can become visible after newer
+# ones a client has already synced; `since` re-reads this much before its cursor
+HISTORY_SYNC_OVERLAP_SECONDS = float(os.getenv("HISTORY_SYNC_OVERLAP_SECONDS", 60))
+
+# Only what the history response shows: the Prediction schema's columns and the
+# patient's, labelled patient_<field>
+PREDICTION_COLUMNS = tuple(getattr(models.Prediction, field) for field in schemas.Prediction.model_fields)
+HISTORY_COLUMNS = PREDICTION_COLUMNS + tuple(
+    getattr(models.Patient, field).label(f"patient_{field}") for field in schemas.Patient.model_fields
+)
+
+def encode_cursor(prediction) -> str:
+    """Opaque keyset cursor: the (timestamp, id) of the last prediction on a page."""
+    raw = f"{prediction.prediction_timestamp.isoformat()}|{prediction.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str):
+    """Inverse of encode_cursor; raises ValueError for malformed cursors."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        timestamp, prediction_id = raw.split("|")
+        return datetime.fromisoformat(timestamp), int(prediction_id)
+    except (TypeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+def naive_utc(value: datetime) -> datetime:
+    """Timestamps are stored as naive UTC; aware filter values are converted."""
+    return value.astimezone(timezone.utc).replace(tzinfo=None) if value.tzinfo is not None else value
+
+def get_predictions_for_user(db: _orm.Session, user_id: int, limit: int = HISTORY_PAGE_SIZE, cursor: str = None,
+                             predicted_class: str = None, date_from: datetime = None, date_to: datetime = None,
+                             patient_id: str = None, since: str = None):
+    """
+    One page of a user's predictions with their patients (HISTORY_COLUMNS rows,
+    see serializers.py), newest first, and the cursor of the next page (None on the last page). Keyset pagination on
+    (prediction_timestamp, id) is served by ix_predictions_owner_timestamp_id,
+    so every page costs the same however deep it is.
+    With `since` (a cursor of the newest prediction a client has), returns the
+    predictions made after it instead, oldest first, starting
+    HISTORY_SYNC_OVERLAP_SECONDS early so late commits are not missed (clients
+    dedupe by id); `cursor` then continues that sync with the next page.
+    """
+    query = (
+        db.query(*HISTORY_COLUMNS)
+        .outerjoin(models.Patient, models.Prediction.patient_record_id == models.Patient.id)
         .filter(models.Prediction.owner_id == user_id)
-        .order_by(models.Prediction.prediction_timestamp.desc())
+    )
+    key = _sql.tuple_(models.Prediction.prediction_timestamp, models.Prediction.id)
+    if since is not None:
+        timestamp, prediction_id = decode_cursor(since)
+        if cursor is not None:
+            query = query.filter(key > decode_cursor(cursor))
+        else:
+            query = query.filter(key > (timestamp - timedelta(seconds=HISTORY_SYNC_OVERLAP_SECONDS), prediction_id))
+    elif cursor is not None:
+        query = query.filter(key < decode_cursor(cursor))
+    if predicted_class is not None:
+        query = query.filter(models.Prediction.predicted_class == predicted_class)
+    if date_from is not None:
+        query = query.filter(models.Prediction.prediction_timestamp >= naive_utc(date_from))
+    if date_to is not None:
+        query = query.filter(models.Prediction.prediction_timestamp < naive_utc(date_to))
+    if patient_id is not None:
+        # Resolved up front so the planner can walk ix_predictions_patient_timestamp instead
+        patient_record_id = (
+            db.query(models.Patient.id)
+            .filter(models.Patient.owner_id == user_id, models.Patient.patient_id == patient_id)
+            .scalar()
+        )
+        if patient_record_id is None:
+            return [], None
+        query = query.filter(models.Prediction.patient_record_id == patient_record_id)
+    if since is not None:
+        order = (models.Prediction.prediction_timestamp, models.Prediction.id)
+    else:
+        order = (models.Prediction.prediction_timestamp.desc(), models.Prediction.id.desc())
+    rows = query.order_by(*order).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def bump_history_revision(db: _orm.Session, user_ids=None):
+    """Invalidates the history ETags of these users (default: everyone). Does not commit."""
+    query = db.query(models.User)
+    if user_ids is not None:
+        query = query.filter(models.User.id.in_(list(user_ids)))
+    query.update({models.User.history_revision: models.User.history_revision + 1}, synchronize_session=False)
+
+def history_etag(db: _orm.Session, user_id: int, params, url_epoch: int) -> str:
+    """
+    ETag of a history response: changes when the user gains or loses predictions,
+    when existing ones change (history_revision), when embedded media URLs are
+    due for renewal (url_epoch) and with the query parameters. Costs one indexed lookup.
+    """
+    latest, count, revision = (
+        db.query(_sql.func.max(models.Prediction.id), _sql.func.count(models.Prediction.id), models.User.history_revision)
+        .select_from(models.User)
+        .outerjoin(models.Prediction, models.Prediction.owner_id == models.User.id)
+        .filter(models.User.id == user_id)
+        .group_by(models.User.id, models.User.history_revision)
+        .one()
+    )
+    state = repr((user_id, latest, count, revision, url_epoch, sorted(params)))
+    return '"' + hashlib.sha256(state.encode()).hexdigest()[:32] + '"'
+
+def get_patient_timeline(db: _orm.Session, user_id: int, patient_id: str):
+    """
+    Returns the user's patient record with its predictions (PREDICTION_COLUMNS
+    rows) oldest first, or None.
+    """
+    patient = (
+        db.query(models.Patient)
+        .filter(models.Patient.owner_id == user_id, models.Patient.patient_id == patient_id)
+        .first()
+    )
+    if patient is None:
+        return None
+    predictions = (
+        db.query(*PREDICTION_COLUMNS)
+        .filter(models.Prediction.patient_record_id == patient.id)
+        .order_by(models.Prediction.prediction_timestamp, models.Prediction.id)
         .all()
-    )
\ No newline at end of file
+    )
+    return patient, predictions
+
+def get_predictions_by_ids(db: _orm.Session, prediction_ids, user_id: int):
+    """
+    Loads the given predictions (with patients) of one user, keyed by id.
+    """
+    rows = (
+        db.query(models.Prediction)
+        .options(joinedload(models.Prediction.patient))
+        .filter(models.Prediction.id.in_(list(prediction_ids)), models.Prediction.owner_id == user_id)
+        .all()
+    )
+    return {row.id: row for row in rows}
+
+def iter_embeddings(db: _orm.Session, after_id: int = 0, batch_size: int = 1000):
+    """
+    Streams (id, owner_id, embedding) of predictions newer than `after_id`,
+    used to catch the similarity index up with the database.
+    """
+    query = (
+        db.query(models.Prediction.id, models.Prediction.owner_id, models.Prediction.embedding)
+        .filter(models.Prediction.id > after_id, models.Prediction.embedding.isnot(None))
+        .order_by(models.Prediction.id)
+        .yield_per(batch_size)
+    )
+    for row in query:
+        yield row.id, row.owner_id, row.embedding
@@ -0,0 +1,138 @@
+"""
+Per-user prediction statistics rollups.
+
+    python -m app.stats backfill [--user-id N]
+
+DailyPredictionStats holds one row per user, UTC day and predicted class. New
+predictions add to it in their own insert transaction; `backfill` rebuilds it
+from the predictions table (for existing data, or after a bulk re-gate).
+"""
+import argparse
+import collections
+import datetime as _dt
+from typing import Iterable, List, Optional
+
+import sqlalchemy as _sql
+import sqlalchemy.orm as _orm
+
+from . import database, models
+
+Stats = models.DailyPredictionStats
+
+
+def rollup_rows(predictions: Iterable) -> List[dict]:
+    """Aggregates prediction rows (owner_id, predicted_class, confidence, prediction_timestamp) into rollup increments."""
+    totals = collections.defaultdict(lambda: [0, 0.0])
+    for prediction in predictions:
+        key = (prediction.owner_id, prediction.prediction_timestamp.date(), prediction.predicted_class)
+        totals[key][0] += 1
+        totals[key][1] += prediction.confidence
+    return [
+        {"user_id": user_id, "day": day, "predicted_class": predicted_class,
+         "prediction_count": count, "confidence_sum": confidence_sum}
+        for (user_id, day, predicted_class), (count, confidence_sum) in totals.items()
+    ]
+
+
+def rollup_upsert(dialect_name: str, rows: List[dict]):
+    """Adds increments from rollup_rows to the stored totals (INSERT ... ON CONFLICT DO UPDATE)."""
+    stmt = database.dialect_insert(dialect_name)(Stats).values(rows)
+    return stmt.on_conflict_do_update(
+        index_elements=[Stats.user_id, Stats.day, Stats.predicted_class],
+        set_={
+            "prediction_count": Stats.prediction_count + stmt.excluded.prediction_count,
+            "confidence_sum": Stats.confidence_sum + stmt.excluded.confidence_sum,
+        },
+    )
+
+
+def record_predictions(db: _orm.Session, predictions: Iterable):
+    """Counts newly inserted predictions; call inside their insert transaction."""
+    rows = rollup_rows(predictions)
+    if rows:
+        db.execute(rollup_upsert(db.get_bind().dialect.name, rows))
+
+
+def _day(column, dialect_name: str):
+    # SQLite keeps dates as ISO strings, and CAST(... AS DATE) there yields a number
+    return _sql.func.date(column) if dialect_name == "sqlite" else _sql.cast(column, _sql.Date)
+
+
+def _lock_rollups(db: _orm.Session):
+    """
+    Keeps prediction inserts from adding to the rollups between backfill's DELETE
+    and INSERT ... SELECT, where an increment committed in between would be lost
+    or counted twice. Inserts wait for the rebuild to commit. SQLite needs no
+    lock: the DELETE already holds its database-wide write lock until the commit.
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(_sql.text(f"LOCK TABLE {Stats.__tablename__} IN EXCLUSIVE MODE"))
+
+
+def backfill(db: _orm.Session, user_id: Optional[int] = None) -> int:
+    """
+    Rebuilds the rollups (of one user, or everyone) from the predictions table in
+    one transaction. Returns the number of rollup rows written.
+    """
+    _lock_rollups(db)
+    day = _day(models.Prediction.prediction_timestamp, db.get_bind().dialect.name)
+    source = (
+        _sql.select(
+            models.Prediction.owner_id, day, models.Prediction.predicted_class,
+            _sql.func.count(), _sql.func.sum(models.Prediction.confidence),
+        )
+        .where(models.Prediction.owner_id.isnot(None), models.Prediction.prediction_timestamp.isnot(None))
+        .group_by(models.Prediction.owner_id, day, models.Prediction.predicted_class)
+    )
+    delete = _sql.delete(Stats)
+    if user_id is not None:
+        source = source.where(models.Prediction.owner_id == user_id)
+        delete = delete.where(Stats.user_id == user_id)
+    db.execute(delete)
+    written = db.execute(_sql.insert(Stats).from_select(
+        ["user_id", "day", "predicted_class", "prediction_count", "confidence_sum"], source,
+    )).rowcount
+    db.commit()
+    return written
+
+
+def get_user_stats(db: _orm.Session, user_id: int, days: int) -> dict:
+    """Class totals over all time and per-day counts for the last `days` days, read from the rollups only."""
+    by_class = (
+        db.query(Stats.predicted_class, _sql.func.sum(Stats.prediction_count), _sql.func.sum(Stats.confidence_sum))
+        .filter(Stats.user_id == user_id)
+        .group_by(Stats.predicted_class)
+        .all()
+    )
+    since = _dt.datetime.utcnow().date() - _dt.timedelta(days=days - 1)
+    daily = (
+        db.query(Stats.day, Stats.predicted_class, Stats.prediction_count)
+        .filter(Stats.user_id == user_id, Stats.day >= since)
+        .order_by(Stats.day, Stats.predicted_class)
+        .all()
+    )
+    return {
+        "total": sum(count for _, count, _ in by_class),
+        "by_class": [
+            {"predicted_class": predicted_class, "count": count, "mean_confidence": confidence_sum / count}
+            for predicted_class, count, confidence_sum in sorted(by_class)
+        ],
+        "daily": [{"day": day, "predicted_class": predicted_class, "count": count} for day, predicted_class, count in daily],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.stats", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("command", choices=["backfill"])
+    parser.add_argument("--user-id", type=int, help="only rebuild this user's rollups")
+    args = parser.parse_args(argv)
+
+    db = database.SessionLocal()
+    try:
+        print(f"{backfill(db, args.user_id)} rollup rows written")
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+import abc
+import asyncio
+import hashlib
+import hmac
+import os
+import tempfile
+import time
+import uuid
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+# --- Configuration ---
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "local")  # "local" or "s3"
+LOCAL_STORAGE_ROOT = Path(os.getenv("LOCAL_STORAGE_ROOT", "uploads"))
+LOCAL_STORAGE_URL_PREFIX = "uploads"  # Prefix of image paths stored before the storage layer
+MEDIA_URL_PREFIX = "media"  # Route of main.read_media
+# URLs stay identical for a whole bucket so browsers can cache them; each is
+# valid for one to two buckets
+MEDIA_URL_BUCKET_SECONDS = int(os.getenv("MEDIA_URL_BUCKET_SECONDS", 24 * 3600))
+# When set (e.g. "/_protected_uploads/"), the API only authorizes media requests
+# and nginx serves the bytes from this internal location
+MEDIA_ACCEL_REDIRECT_PREFIX = os.getenv("MEDIA_ACCEL_REDIRECT_PREFIX")
+MEDIA_CACHE_CONTROL = "private, max-age=31536000, immutable"
+SECRET_KEY = os.getenv("SECRET_KEY")
+S3_BUCKET = os.getenv("S3_BUCKET", "predictions")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # e.g. http://minio:9000 for a local stand-in
+S3_REGION = os.getenv("S3_REGION", "us-east-1")
+S3_URL_EXPIRES_SECONDS = int(os.getenv("S3_URL_EXPIRES_SECONDS", 3600))
+
+
+def new_key(suffix: str, name: Optional[str] = None) -> str:
+    """
+    Returns a sharded object key like "3f/a2/3fa2....png". Two levels of 256
+    directories keep any single directory small on the local backend and spread
+    keys across prefixes on S3.
+    """
+    name = name or uuid.uuid4().hex
+    return f"{name[:2]}/{name[2:4]}/{name}{suffix}"
+
+
+def content_key(data: bytes, suffix: str) -> str:
+    """
+    Sharded key derived from the content hash: the same bytes always map to the
+    same key, and a key never changes content, so its URL can be cached forever.
+    """
+    return new_key(suffix, name=hashlib.sha256(data).hexdigest()[:32])
+
+
+# --- Signed Media URLs ---
+def _media_signature(key: str, expires: int) -> str:
+    message = f"{key}:{expires}".encode()
+    return hmac.new(SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()[:32]
+
+def signed_media_url(key: str) -> str:
+    """
+    Relative URL of main.read_media for `key`. Only users who were served the URL
+    (i.e. authorized for the prediction) can load the image.
+    """
+    expires = (int(time.time()) // MEDIA_URL_BUCKET_SECONDS + 2) * MEDIA_URL_BUCKET_SECONDS
+    return f"{MEDIA_URL_PREFIX}/{key}?expires={expires}&signature={_media_signature(key, expires)}"
+
+def verify_media_signature(key: str, expires: int, signature: str) -> bool:
+    if expires < time.time():
+        return False
+    return hmac.compare_digest(_media_signature(key, expires), signature)
+
+
+class Storage(abc.ABC):
+    """
+    Object storage for prediction images. Backends implement the blocking
+    primitives; the async wrappers run them off the event loop.
+    Keys are "/"-separated relative paths (see new_key).
+    """
+    @abc.abstractmethod
+    def write(self, key: str, data: bytes, content_type: str = "application/octet-stream"):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def read(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def remove(self, key: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stat(self, key: str) -> Tuple[int, float]:
+        """Returns (size in bytes, last modified as a POSIX timestamp)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def iter_objects(self, prefix: str = "") -> Iterator[Tuple[str, int, float]]:
+        """Yields (key, size in bytes, last modified) for every stored object."""
+        raise NotImplementedError
+
+    def iter_keys(self, prefix: str = "") -> Iterator[str]:
+        for key, _, _ in self.iter_objects(prefix):
+            yield key
+
+    @abc.abstractmethod
+    def url(self, key: str) -> str:
+        """URL a browser can load the object from."""
+        raise NotImplementedError
+
+    def url_epoch(self) -> int:
+        """
+        Changes whenever URLs handed out earlier may be about to expire; responses
+        embedding URLs include it in their ETag. Signed media URLs issued in the
+        current bucket stay valid for at least one more bucket.
+        """
+        return int(time.time()) // MEDIA_URL_BUCKET_SECONDS
+
+    # --- Non-blocking wrappers for request handlers ---
+    async def put(self, key: str, data: bytes, content_type: str = "application/octet-stream"):
+        await asyncio.to_thread(self.write, key, data, content_type)
+
+    async def get(self, key: str) -> bytes:
+        return await asyncio.to_thread(self.read, key)
+
+    async def delete(self, key: str):
+        await asyncio.to_thread(self.remove, key)
+
+    async def has(self, key: str) -> bool:
+        return await asyncio.to_thread(self.exists, key)
+
+    @staticmethod
+    def normalize_key(key: str) -> str:
+        # Rows written before the storage layer hold paths like "uploads\\<uuid>.png"
+        key = key.replace("\\", "/")
+        prefix = LOCAL_STORAGE_URL_PREFIX + "/"
+        return key[len(prefix):] if key.startswith(prefix) else key
+
+
+class LocalStorage(Storage):
+    """Files under a local directory, served through signed /media URLs."""
+    def __init__(self, root: Path = LOCAL_STORAGE_ROOT):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        key = self.normalize_key(key)
+        if key.startswith("/") or ".." in key.split("/"):
+            raise ValueError(f"Invalid storage key '{key}'")
+        return self.root / key
+
+    def write(self, key, data, content_type="application/octet-stream"):
+        path = self.path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write-then-rename so readers never see a partial file
+        with tempfile.NamedTemporaryFile(dir=path.parent, prefix=".tmp-", delete=False) as tmp:
+            tmp.write(data)
+        os.replace(tmp.name, path)
+
+    def read(self, key):
+        return self.path(key).read_bytes()
+
+    def remove(self, key):
+        self.path(key).unlink(missing_ok=True)
+
+    def exists(self, key):
+        return self.path(key).is_file()
+
+    def stat(self, key):
+        st = self.path(key).stat()
+        return st.st_size, st.st_mtime
+
+    def iter_objects(self, prefix=""):
+        base = self.root / prefix if prefix else self.root
+        for path in base.rglob("*"):
+            if path.is_file() and not path.name.startswith(".tmp-"):
+                st = path.stat()
+                yield path.relative_to(self.root).as_posix(), st.st_size, st.st_mtime
+
+    def url(self, key):
+        return signed_media_url(self.normalize_key(key))
+
+
+class S3Storage(Storage):
+    """S3-compatible bucket (AWS, MinIO, ...); browsers read through presigned URLs."""
+    def __init__(self, bucket: str = S3_BUCKET, endpoint_url: Optional[str] = S3_ENDPOINT_URL):
+        try:
+            import boto3
+            from botocore.config import Config
+        except ImportError:
+            raise RuntimeError("STORAGE_BACKEND=s3 requires the 'boto3' package")
+        self.bucket = bucket
+        # Self-hosted endpoints such as MinIO generally need path-style addressing
+        config = Config(s3={"addressing_style": "path"}) if endpoint_url else None
+        self.client = boto3.client("s3", endpoint_url=endpoint_url, region_name=S3_REGION, config=config)
+
+    def write(self, key, data, content_type="application/octet-stream"):
+        self.client.put_object(Bucket=self.bucket, Key=self.normalize_key(key), Body=data, ContentType=content_type)
+
+    def read(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=self.normalize_key(key))["Body"].read()
+
+    def remove(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.normalize_key(key))
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.normalize_key(key))
+        except self.client.exceptions.ClientError:
+            return False
+        return True
+
+    def stat(self, key):
+        head = self.client.head_object(Bucket=self.bucket, Key=self.normalize_key(key))
+        return head["ContentLength"], head["LastModified"].timestamp()
+
+    def iter_objects(self, prefix=""):
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                yield obj["Key"], obj["Size"], obj["LastModified"].timestamp()
+
+    def url_epoch(self):
+        # A presigned URL from the current half of its lifetime has the other half left
+        return int(time.time()) // max(1, S3_URL_EXPIRES_SECONDS // 2)
+
+    def url(self, key):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": self.bucket, "Key": self.normalize_key(key)},
+            ExpiresIn=S3_URL_EXPIRES_SECONDS,
+        )
+
+
+_storage = None
+
+def get_storage() -> Storage:
+    """Returns the configured storage backend (created on first use)."""
+    global _storage
+    if _storage is None:
+        _storage = S3Storage() if STORAGE_BACKEND == "s3" else LocalStorage()
+    return _storage
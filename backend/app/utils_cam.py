@@ -3,36 +3,61 @@
 import cv2
 import numpy as np
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 
 class GradCAM:
     """
-    Minimal Grad-CAM for a single target layer on ResNet-like models.
+    Grad-CAM for a single target layer on ResNet-like models (a stack of children
+    ending in `avgpool` and `fc`).
     Usage:
       cam = GradCAM(model, target_layer_name='layer4')
-      heatmap = cam(tensor, class_idx)  # (H, W) float32 in [0,1]
+      acts, pooled, logits = cam.forward(tensor)
+      heatmaps = cam.heatmaps(acts, logits, class_idx, size=(H, W))  # (B, H, W) float32 in [0,1]
+
+    The network is split at the target layer instead of using module hooks, so a
+    single forward pass yields the logits, the pooled features and the CAM, only
+    the small head is back-propagated, and one instance can be shared safely
+    between threads.
     """
     def __init__(self, model, target_layer_name='layer4'):
         self.model = model
         self.model.eval()
-        self.activations = None
-        self.gradients = None
-
-        target_layer = dict([*self.model.named_modules()])[target_layer_name]
-        target_layer.register_forward_hook(self._forward_hook)
-        target_layer.register_full_backward_hook(self._backward_hook)
+        children = list(self.model.named_children())
+        split = [name for name, _ in children].index(target_layer_name) + 1
+        self.body = nn.Sequential(*[module for _, module in children[:split]])
 
-    def _forward_hook(self, module, input, output):
-        self.activations = output.detach()
+    def forward(self, input_tensor):
+        """
+        input_tensor: (B, 3, H, W) torch.FloatTensor
+        returns (activations, pooled features, logits); logits carry the graph
+        back to the activations only.
+        """
+        with torch.no_grad():
+            acts = self.body(input_tensor)  # (B, Ck, h, w)
+        acts.requires_grad_(True)
+        with torch.enable_grad():
+            pooled = torch.flatten(self.model.avgpool(acts), 1)  # (B, Ck)
+            logits = self.model.fc(pooled)  # (B, C)
+        return acts, pooled, logits
+
+    def coarse(self, acts, logits, class_idx):
+        """
+        Un-normalized CAM at the target layer's resolution, (B, h, w).
+        class_idx: int or sequence of ints (one per batch item)
+        """
+        idx = torch.as_tensor(class_idx, device=logits.device).reshape(-1, 1).expand(logits.shape[0], 1)
+        score = logits.gather(1, idx).sum()
+        grads, = torch.autograd.grad(score, acts)
+        weights = grads.mean(dim=(2, 3), keepdim=True)  # (B, Ck, 1, 1)
+        cam = (weights * acts.detach()).sum(dim=1)  # (B, h, w)
+        return F.relu(cam)  # only positive
 
-    def _backward_hook(self, module, grad_input, grad_output):
-        self.gradients = grad_output[0].detach()
+    def upsample(self, coarse, size, eps=1e-6):
+        return upsample_cam(coarse, size, eps)
 
-    @torch.no_grad()
-    def _normalize(self, x, eps=1e-6):
-        x = x - x.min()
-        x = x / (x.max() + eps)
-        return x
+    def heatmaps(self, acts, logits, class_idx, size):
+        return self.upsample(self.coarse(acts, logits, class_idx), size)
 
     def __call__(self, input_tensor, class_idx: int):
         """
@@ -40,22 +65,21 @@ class GradCAM:
         class_idx: int
         returns heatmap: (H, W) np.float32 in [0,1]
         """
-        self.model.zero_grad(set_to_none=True)
-        logits = self.model(input_tensor)  # (1, C)
-        score = logits[0, class_idx]
-        self.model.zero_grad(set_to_none=True)
-        score.backward(retain_graph=True)
-
-        # activations: (1, Ck, h, w); gradients: (1, Ck, h, w)
-        grads = self.gradients
-        acts = self.activations
-        weights = grads.mean(dim=(2, 3), keepdim=True)  # (1, Ck, 1, 1)
-
-        cam = (weights * acts).sum(dim=1, keepdim=True)  # (1,1,h,w)
-        cam = F.relu(cam)  # only positive
-        cam = F.interpolate(cam, size=input_tensor.shape[-2:], mode='bilinear', align_corners=False)
-        cam = cam[0, 0].cpu().numpy().astype(np.float32)
-        return self._normalize(cam)
+        acts, _, logits = self.forward(input_tensor)
+        return self.heatmaps(acts, logits, class_idx, size=input_tensor.shape[-2:])[0]
+
+@torch.no_grad()
+def upsample_cam(coarse, size, eps=1e-6):
+    """
+    Bilinear upsampling of (B, h, w) coarse CAMs to `size`, each normalized to [0,1].
+    Also re-renders stored CAMs, so it does not need the model.
+    """
+    coarse = torch.as_tensor(coarse, dtype=torch.float32)
+    cam = F.interpolate(coarse.unsqueeze(1), size=size, mode='bilinear', align_corners=False)[:, 0]
+    flat = cam.reshape(cam.shape[0], -1)
+    flat = flat - flat.min(dim=1, keepdim=True).values
+    flat = flat / (flat.max(dim=1, keepdim=True).values + eps)
+    return flat.reshape(cam.shape).cpu().numpy().astype(np.float32)
 
 def heatmap_to_circle(heatmap: np.ndarray,
                       threshold: float = 0.35,
@@ -99,10 +123,10 @@ def draw_circle_overlay(bgr_img: np.ndarray, circle, thickness: int = 3):
         cv2.circle(out, (x, y), r, (0, 0, 255), thickness)  # red circle
     return out
 
-def overlay_cam(bgr_img: np.ndarray, heatmap: np.ndarray, alpha: float = 0.35):
+def overlay_cam(bgr_img: np.ndarray, heatmap: np.ndarray, alpha: float = 0.35, colormap: int = cv2.COLORMAP_JET):
     # Make a colored heatmap and blend with image
     hm8 = (heatmap * 255).astype(np.uint8)
-    hm_color = cv2.applyColorMap(hm8, cv2.COLORMAP_JET)
+    hm_color = cv2.applyColorMap(hm8, colormap)
     overlay = cv2.addWeighted(bgr_img, 1.0, hm_color, alpha, 0)
     return overlay
 
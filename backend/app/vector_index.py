@@ -0,0 +1,277 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+try:
+    import hnswlib
+except ImportError:  # Exact NumPy search is used instead
+    hnswlib = None
+
+try:
+    import fcntl
+except ImportError:  # Not POSIX: snapshots are written without a writer lock
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+EMBEDDING_DIM = 2048  # ResNet50 pooled features
+EMBEDDING_DTYPE = np.float16
+INDEX_DIR = Path(os.getenv("EMBEDDING_INDEX_DIR", "outputs/embedding_index"))
+INDEX_SNAPSHOT_EVERY = int(os.getenv("EMBEDDING_INDEX_SNAPSHOT_EVERY", 1000))  # inserts between snapshots
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+
+def encode_embedding(features: np.ndarray) -> bytes:
+    """L2-normalizes pooled features and packs them as float16 (4 KiB per scan)."""
+    features = np.asarray(features, dtype=np.float32).ravel()
+    features = features / (np.linalg.norm(features) + 1e-12)
+    return features.astype(EMBEDDING_DTYPE).tobytes()
+
+
+def decode_embedding(blob: bytes) -> np.ndarray:
+    return np.frombuffer(blob, dtype=EMBEDDING_DTYPE).astype(np.float32)
+
+
+class _OwnerIndex:
+    """Approximate (HNSW) or exact inner-product index over one user's embeddings."""
+    def __init__(self, capacity: int = 1024):
+        self.count = 0
+        if hnswlib is not None:
+            self.hnsw = hnswlib.Index(space="ip", dim=EMBEDDING_DIM)
+            self.hnsw.init_index(max_elements=capacity, ef_construction=HNSW_EF_CONSTRUCTION, M=HNSW_M)
+            self.hnsw.set_ef(HNSW_EF_SEARCH)
+        else:
+            self.hnsw = None
+            self.ids = np.zeros(capacity, np.int64)
+            self.vectors = np.zeros((capacity, EMBEDDING_DIM), EMBEDDING_DTYPE)
+
+    def add(self, ids: np.ndarray, vectors: np.ndarray):
+        needed = self.count + len(ids)
+        if self.hnsw is not None:
+            if needed > self.hnsw.get_max_elements():
+                self.hnsw.resize_index(max(needed, 2 * self.hnsw.get_max_elements()))
+            self.hnsw.add_items(vectors, ids)
+        else:
+            if needed > len(self.ids):
+                capacity = max(needed, 2 * len(self.ids))
+                self.ids = np.resize(self.ids, capacity)
+                self.vectors = np.resize(self.vectors, (capacity, EMBEDDING_DIM))
+            self.ids[self.count:needed] = ids
+            self.vectors[self.count:needed] = vectors
+        self.count = needed
+
+    def search(self, vector: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        k = min(k, self.count)
+        if k == 0:
+            return np.empty(0, np.int64), np.empty(0, np.float32)
+        if self.hnsw is not None:
+            labels, distances = self.hnsw.knn_query(vector, k=k)
+            # hnswlib's "ip" distance is 1 - dot product
+            return labels[0].astype(np.int64), 1.0 - distances[0]
+        scores = self.vectors[:self.count] @ vector.astype(EMBEDDING_DTYPE)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return self.ids[top], scores[top].astype(np.float32)
+
+    def save(self, path: Path):
+        if self.hnsw is not None:
+            self.hnsw.save_index(str(path.with_suffix(".bin")))
+        else:
+            np.savez(path.with_suffix(".npz"), ids=self.ids[:self.count], vectors=self.vectors[:self.count])
+
+    def stored_ids(self) -> np.ndarray:
+        if self.hnsw is not None:
+            return np.asarray(self.hnsw.get_ids_list(), np.int64)
+        return self.ids[:self.count]
+
+    @classmethod
+    def load(cls, path: Path) -> "_OwnerIndex":
+        """
+        The count comes from the file, not the manifest: a crash between writing
+        owner files and the manifest leaves files ahead of it.
+        """
+        index = cls.__new__(cls)
+        if hnswlib is not None and path.with_suffix(".bin").exists():
+            index.hnsw = hnswlib.Index(space="ip", dim=EMBEDDING_DIM)
+            index.hnsw.load_index(str(path.with_suffix(".bin")))
+            index.hnsw.set_ef(HNSW_EF_SEARCH)
+            index.count = index.hnsw.get_current_count()
+        elif hnswlib is None and path.with_suffix(".npz").exists():
+            data = np.load(path.with_suffix(".npz"))
+            index.hnsw = None
+            index.ids, index.vectors = data["ids"], data["vectors"]
+            index.count = len(index.ids)
+        else:
+            raise FileNotFoundError(path)
+        return index
+
+
+class EmbeddingIndex:
+    """
+    In-process nearest-neighbour index of prediction embeddings, one HNSW graph
+    per owner so searches only ever walk the caller's own cases.
+
+    Snapshots go to INDEX_DIR together with a manifest recording the highest
+    prediction id they contain; on startup the snapshot is loaded and only newer
+    predictions are read back from the database. Embeddings added while that
+    load runs are held back and inserted once it finishes, so none is lost or
+    inserted twice, and no snapshot is written before the index is complete.
+
+    INDEX_DIR belongs to one process: the first to save takes a lock on it, and
+    other API workers (uvicorn --workers N) keep their index in memory only,
+    rebuilding from the last snapshot and the database when they start.
+    """
+    def __init__(self, directory: Path = INDEX_DIR):
+        self.directory = directory
+        self._owners = {}
+        self._lock = threading.Lock()
+        self.max_id = 0
+        self._since_snapshot = 0
+        self._dirty = set()  # Owners changed since the last snapshot
+        self._loading = False
+        self._pending = []  # Rows added during a load
+        self._pending_ids = set()
+        self._present = set()  # Ids above the manifest's max_id found in the snapshot files
+        self._writer_lock = None  # Open lock file while this process owns the directory
+        self._read_only = False
+
+    def add(self, prediction_id: int, owner_id: int, embedding: bytes):
+        self.add_many([(prediction_id, owner_id, embedding)])
+
+    def add_many(self, rows: Iterable[Tuple[int, int, bytes]]):
+        rows = [row for row in rows if row[2] is not None]
+        with self._lock:
+            if self._loading:
+                # Inserted when the load finishes; the load skips these ids
+                self._pending.extend(rows)
+                self._pending_ids.update(row[0] for row in rows)
+                return
+            snapshot_due = self._insert(rows)
+        if snapshot_due:
+            self.save()
+
+    def _insert(self, rows: List[Tuple[int, int, bytes]]) -> bool:
+        """Inserts rows (caller holds the lock); True when a snapshot is due."""
+        by_owner = {}
+        for prediction_id, owner_id, embedding in rows:
+            by_owner.setdefault(owner_id, []).append((prediction_id, decode_embedding(embedding)))
+        for owner_id, items in by_owner.items():
+            ids = np.array([item[0] for item in items], np.int64)
+            vectors = np.stack([item[1] for item in items])
+            self._owners.setdefault(owner_id, _OwnerIndex()).add(ids, vectors)
+            self._dirty.add(owner_id)
+            self.max_id = max(self.max_id, int(ids.max()))
+            self._since_snapshot += len(ids)
+        return self._since_snapshot >= INDEX_SNAPSHOT_EVERY
+
+    def search(self, owner_id: int, embedding: bytes, k: int, exclude_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        """Returns up to k (prediction_id, cosine similarity) pairs, most similar first."""
+        with self._lock:
+            index = self._owners.get(owner_id)
+            if index is None:
+                return []
+            ids, scores = index.search(decode_embedding(embedding), k + (exclude_id is not None))
+        return [(int(i), float(s)) for i, s in zip(ids, scores) if i != exclude_id][:k]
+
+    # --- Snapshots ---
+    def save(self):
+        with self._lock:
+            if self._loading:
+                return  # Incomplete; the previous snapshot stays valid
+            if not self._acquire_directory():
+                return
+            for owner_id in self._dirty:
+                self._owners[owner_id].save(self.directory / f"owner_{owner_id}")
+            manifest = {"max_id": self.max_id, "owners": {str(o): i.count for o, i in self._owners.items()}}
+            tmp = self.directory / "manifest.json.tmp"
+            tmp.write_text(json.dumps(manifest))
+            tmp.replace(self.directory / "manifest.json")  # Atomic: a crash never leaves a torn manifest
+            self._since_snapshot = 0
+            self._dirty.clear()
+
+    def _acquire_directory(self) -> bool:
+        """Takes the directory's writer lock (caller holds self._lock); False if another process has it."""
+        if self._writer_lock is not None or fcntl is None:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            return True
+        if self._read_only:
+            return False
+        self.directory.mkdir(parents=True, exist_ok=True)
+        lock_file = open(self.directory / "writer.lock", "w")
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            self._read_only = True
+            logger.warning("%s is written by another process; this one keeps its embedding index in memory only",
+                           self.directory)
+            return False
+        self._writer_lock = lock_file
+        return True
+
+    def begin_load(self):
+        """
+        From now until load() finishes, adds are held back. Call before serving
+        requests when load() itself runs in the background.
+        """
+        with self._lock:
+            if not self._loading:
+                self._loading = True
+                self._pending, self._pending_ids = [], set()
+
+    def load(self, rows_after: Callable[[int], Iterable[Tuple[int, int, bytes]]]):
+        """
+        Loads the last snapshot, then inserts the rows returned by
+        `rows_after(max_id)` (predictions newer than the snapshot). Falls back to a
+        full rebuild if the snapshot is missing or unreadable.
+        """
+        self.begin_load()
+        manifest_path = self.directory / "manifest.json"
+        try:
+            with self._lock:
+                self._owners, self.max_id, self._dirty, self._present = {}, 0, set(), set()
+                if manifest_path.exists():
+                    try:
+                        manifest = json.loads(manifest_path.read_text())
+                        for owner_id in manifest["owners"]:
+                            self._owners[int(owner_id)] = _OwnerIndex.load(self.directory / f"owner_{owner_id}")
+                        self.max_id = manifest["max_id"]
+                    except (OSError, ValueError, KeyError, RuntimeError):
+                        self._owners, self.max_id = {}, 0
+                # Ids saved after the manifest (crash between the writes) are in the graphs already
+                for index in self._owners.values():
+                    ids = index.stored_ids()
+                    self._present.update(int(i) for i in ids[ids > self.max_id])
+            batch = []
+            for row in rows_after(self.max_id):
+                batch.append(row)
+                if len(batch) >= 1000:
+                    self._load_batch(batch)
+                    batch = []
+            if batch:
+                self._load_batch(batch)
+        finally:
+            with self._lock:
+                self._loading = False
+                snapshot_due = self._insert([row for row in self._pending if row[0] not in self._present])
+                self._pending, self._pending_ids, self._present = [], set(), set()
+        if snapshot_due:
+            self.save()
+
+    def _load_batch(self, rows: List[Tuple[int, int, bytes]]):
+        with self._lock:
+            self._insert([
+                row for row in rows
+                if row[2] is not None and row[0] not in self._pending_ids and row[0] not in self._present
+            ])
+
+
+embedding_index = EmbeddingIndex()
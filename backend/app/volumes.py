@@ -0,0 +1,292 @@
+import gzip
+import os
+import tempfile
+import threading
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+from . import ml_services
+
+# --- Configuration ---
+VOLUME_BATCH_SIZE = int(os.getenv("VOLUME_BATCH_SIZE", 8))
+VOLUME_TOP_SLICES = int(os.getenv("VOLUME_TOP_SLICES", 5))
+VOLUME_TIMEOUT_SECONDS = float(os.getenv("VOLUME_TIMEOUT_SECONDS", 300))
+MAX_VOLUME_BYTES = int(os.getenv("MAX_VOLUME_BYTES", 512 * 1024 * 1024))
+# Limit on a .nii.gz once inflated to disk; MAX_VOLUME_BYTES only caps the compressed upload
+MAX_VOLUME_INFLATED_BYTES = int(os.getenv("MAX_VOLUME_INFLATED_BYTES", 4 * MAX_VOLUME_BYTES))
+INFLATE_CHUNK_BYTES = 1024 * 1024
+# Slices whose (subsampled) foreground fraction is below this are skipped as empty
+EMPTY_SLICE_FOREGROUND_FRAC = float(os.getenv("EMPTY_SLICE_FOREGROUND_FRAC", 0.05))
+EMPTY_SLICE_FOREGROUND_LEVEL = 20  # Same "black background" level as is_valid_mri
+NIFTI_SUFFIXES = (".nii", ".nii.gz")
+
+
+# --- Windowing ---
+def window_to_uint8(pixels: np.ndarray, low: float, high: float) -> np.ndarray:
+    """Maps the [low, high] intensity window of one slice to 0..255."""
+    scale = 255.0 / max(high - low, 1e-6)
+    out = (pixels.astype(np.float32, copy=False) - low) * scale
+    return np.clip(out, 0, 255).astype(np.uint8)
+
+
+def is_empty_slice(slice8: np.ndarray) -> bool:
+    """Cheap pre-filter on a strided subsample; skips air/padding slices before the model."""
+    sample = slice8[::4, ::4]
+    return (sample > EMPTY_SLICE_FOREGROUND_LEVEL).mean() < EMPTY_SLICE_FOREGROUND_FRAC
+
+
+# --- DICOM ---
+def _import_pydicom():
+    try:
+        import pydicom
+    except ImportError:
+        raise ValueError("DICOM support requires the 'pydicom' package")
+    return pydicom
+
+
+def iter_dicom_slices(files: List[BinaryIO]) -> Iterator[np.ndarray]:
+    """
+    Yields the slices of a DICOM series as 8-bit images, ordered along the scan.
+    Headers are read first (without pixel data) to sort the series; pixel data is
+    then decoded one slice at a time.
+    """
+    pydicom = _import_pydicom()
+    headers = []
+    for f in files:
+        f.seek(0)
+        ds = pydicom.dcmread(f, stop_before_pixels=True, force=True)
+        position = getattr(ds, "ImagePositionPatient", None)
+        order = float(position[2]) if position is not None else float(getattr(ds, "InstanceNumber", 0) or 0)
+        headers.append((order, f, ds))
+    headers.sort(key=lambda item: item[0])
+
+    # Slices without a stored window share one estimated for the whole series, like
+    # NIfTI volumes: a per-slice window would stretch near-empty slices to full
+    # contrast and defeat is_empty_slice
+    series_window = None
+    if any(_header_window(ds) is None for _, _, ds in headers):
+        series_window = _dicom_series_window(pydicom, [f for _, f, _ in headers])
+
+    for _, f, header in headers:
+        low, high = _header_window(header) or series_window
+        for values in _dicom_frames(pydicom, f):
+            yield window_to_uint8(values, low, high)
+
+
+def _dicom_frames(pydicom, f: BinaryIO) -> Iterator[np.ndarray]:
+    """The rescaled grayscale frames of one DICOM file."""
+    f.seek(0)
+    ds = pydicom.dcmread(f, force=True)
+    if "PixelData" not in ds:
+        return
+    pixels = ds.pixel_array
+    if pixels.ndim == 3 and getattr(ds, "SamplesPerPixel", 1) == 1:
+        # Multi-frame object: every frame is a slice
+        frames = pixels
+    else:
+        frames = [pixels]
+    slope = float(getattr(ds, "RescaleSlope", 1) or 1)
+    intercept = float(getattr(ds, "RescaleIntercept", 0) or 0)
+    for frame in frames:
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        yield frame * slope + intercept if (slope != 1 or intercept != 0) else frame
+
+
+def _header_window(ds) -> Optional[Tuple[float, float]]:
+    center, width = getattr(ds, "WindowCenter", None), getattr(ds, "WindowWidth", None)
+    if center is None or width is None:
+        return None
+    # Multi-valued windows list alternatives; the first one is the default
+    center = float(center[0] if hasattr(center, "__len__") and not isinstance(center, str) else center)
+    width = float(width[0] if hasattr(width, "__len__") and not isinstance(width, str) else width)
+    return center - width / 2, center + width / 2
+
+
+def _dicom_series_window(pydicom, files: List[BinaryIO]) -> Tuple[float, float]:
+    """One window estimated from a sparse sample of the series' slices."""
+    sample_idx = np.unique(np.linspace(0, len(files) - 1, num=min(len(files), 16)).astype(int))
+    sample = [values[::4, ::4].ravel() for k in sample_idx for values in _dicom_frames(pydicom, files[k])]
+    if not sample:
+        return 0.0, 1.0
+    low, high = np.percentile(np.concatenate(sample), (0.5, 99.5))
+    return float(low), float(high)
+
+
+# --- NIfTI ---
+def _import_nibabel():
+    try:
+        import nibabel
+    except ImportError:
+        raise ValueError("NIfTI support requires the 'nibabel' package")
+    return nibabel
+
+
+def iter_nifti_slices(path: str) -> Iterator[np.ndarray]:
+    """
+    Yields the axial slices of a NIfTI volume as 8-bit images.
+    Slices are read lazily through nibabel's array proxy (memory-mapped for
+    uncompressed files), so the volume is never materialized as float.
+    """
+    nibabel = _import_nibabel()
+    img = nibabel.load(path)
+    proxy = img.dataobj
+    if len(proxy.shape) < 3:
+        raise ValueError("NIfTI file is not a volume")
+    depth = proxy.shape[2]
+
+    # One global window estimated from a sparse sample of slices
+    sample_idx = np.unique(np.linspace(0, depth - 1, num=min(depth, 16)).astype(int))
+    sample = np.concatenate([np.asarray(_nifti_slice(proxy, k))[::4, ::4].ravel() for k in sample_idx])
+    low, high = (float(v) for v in np.percentile(sample, (0.5, 99.5)))
+
+    for k in range(depth):
+        # Rotate so rows run anterior to posterior, as in the 2D exports
+        yield np.rot90(window_to_uint8(np.asarray(_nifti_slice(proxy, k)), low, high)).copy()
+
+
+def _nifti_slice(proxy, k: int):
+    # 4D series: only the first volume is analyzed
+    return proxy[:, :, k] if len(proxy.shape) == 3 else proxy[:, :, k, 0]
+
+
+# --- Volume Inference ---
+def is_nifti(filename: str) -> bool:
+    return (filename or "").lower().endswith(NIFTI_SUFFIXES)
+
+
+class VolumeInference:
+    """
+    Batched slice inference over a DICOM series (one file per slice, or a
+    multi-frame file) or a single NIfTI volume, run one batch per step().
+    Each step is a separate scheduler job, so interactive scans get a worker
+    between batches instead of waiting behind a whole study.
+    Steps run one at a time, possibly on different worker threads.
+    """
+    def __init__(self, files: List[BinaryIO], filenames: List[str]):
+        self._files = files
+        self._filenames = filenames
+        self._slices = None
+        self._tmp_path = None
+        self.model_version, self._model = None, None
+        self.total, self.skipped = 0, 0
+        self.analyzed = []  # (slice index, gated prediction, tumor score)
+        self._prob_max = self._prob_sum = self._tumor_cols = None
+        # A step can still be running on a worker after its request timed out
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # One model for every slice, so a hot-swap between steps cannot split the volume
+        self.model_version, self._model = ml_services.registry.serving()
+        classes = self._model.classes
+        self._prob_max = np.zeros(len(classes), np.float32)
+        self._prob_sum = np.zeros(len(classes), np.float64)
+        self._tumor_cols = [i for i, label in enumerate(classes) if "no" not in label.lower()]
+        if len(self._files) == 1 and is_nifti(self._filenames[0]):
+            # nibabel needs a real path; the upload may still be an in-memory spool.
+            # Compressed volumes are inflated once here so slices can be memory-mapped
+            # instead of re-decompressing the stream for every slice.
+            self._files[0].seek(0)
+            gz = self._filenames[0].lower().endswith(".gz")
+            source = gzip.GzipFile(fileobj=self._files[0], mode="rb") if gz else self._files[0]
+            with tempfile.NamedTemporaryFile(suffix=".nii", delete=False) as tmp:
+                self._tmp_path = tmp.name  # Removed by close(), also when the limit below is hit
+                written = 0
+                for chunk in iter(lambda: source.read(INFLATE_CHUNK_BYTES), b""):
+                    written += len(chunk)
+                    if written > MAX_VOLUME_INFLATED_BYTES:
+                        raise ValueError(f"Volume exceeds {MAX_VOLUME_INFLATED_BYTES} bytes uncompressed")
+                    tmp.write(chunk)
+            self._slices = iter_nifti_slices(self._tmp_path)
+        else:
+            self._slices = iter_dicom_slices(self._files)
+
+    def step(self) -> bool:
+        """Decodes slices up to the next full batch and classifies it; False once the volume is done."""
+        with self._lock:
+            if self._slices is None:
+                self._open()
+            return self._step()
+
+    def _step(self) -> bool:
+        batch, batch_idx = [], []
+        for slice8 in self._slices:
+            index = self.total
+            self.total += 1
+            if is_empty_slice(slice8):
+                self.skipped += 1
+                continue
+            batch.append(slice8)  # Preprocessing broadcasts the single channel itself
+            batch_idx.append(index)
+            if len(batch) >= VOLUME_BATCH_SIZE:
+                break
+        if not batch:
+            return False
+        probs, results = ml_services.run_batch_inference(batch, self._model)
+        np.maximum(self._prob_max, probs.max(axis=0), out=self._prob_max)
+        self._prob_sum += probs.sum(axis=0)
+        tumor_scores = probs[:, self._tumor_cols].max(axis=1) if self._tumor_cols else np.zeros(len(batch))
+        self.analyzed.extend(zip(batch_idx, results, tumor_scores.tolist()))
+        return True
+
+    def close(self):
+        """Waits for a running step, then releases the slice reader and the temporary file."""
+        with self._lock:
+            if self._slices is not None:
+                self._slices.close()
+            if self._tmp_path is not None:
+                os.unlink(self._tmp_path)
+                self._tmp_path = None
+
+    def result(self):
+        return aggregate(self.model_version, self._model.classes, self.total, self.skipped, self.analyzed,
+                         self._prob_max, self._prob_sum)
+
+
+def run_volume_inference(files: List[BinaryIO], filenames: List[str]):
+    """Runs a whole VolumeInference in the calling thread."""
+    volume = VolumeInference(files, filenames)
+    try:
+        while volume.step():
+            pass
+        return volume.result()
+    finally:
+        volume.close()
+
+
+def aggregate(model_version: str, classes, total: int, skipped: int, analyzed, prob_max, prob_sum):
+    """Per-volume result from the per-slice predictions of a VolumeInference."""
+    if total == 0:
+        raise ValueError("No image slices found in the upload")
+    if not analyzed:
+        return {
+            "prediction": {"class": "no_tumor", "confidence": None},
+            "model_version": model_version,
+            "slices": {"total": total, "skipped_empty": skipped, "analyzed": 0},
+            "per_class": {},
+            "top_slices": [],
+        }
+
+    top = sorted(analyzed, key=lambda item: item[2], reverse=True)[:VOLUME_TOP_SLICES]
+    positive = [item for item in analyzed if item[1]["class"] != "no_tumor"]
+    if positive:
+        best = max(positive, key=lambda item: item[1]["confidence"])
+        volume_prediction = {"class": best[1]["class"], "confidence": best[1]["confidence"], "slice": best[0]}
+    else:
+        volume_prediction = {"class": "no_tumor", "confidence": None}
+
+    return {
+        "prediction": volume_prediction,
+        "model_version": model_version,
+        "slices": {"total": total, "skipped_empty": skipped, "analyzed": len(analyzed)},
+        "per_class": {
+            label: {"max": round(float(prob_max[i]), 4), "mean": round(float(prob_sum[i] / len(analyzed)), 4)}
+            for i, label in enumerate(classes)
+        },
+        "top_slices": [
+            {"slice": index, "class": result["class"], "confidence": result["confidence"], "reason": result["reason"]}
+            for index, result, _ in top
+        ],
+    }
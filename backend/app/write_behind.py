@@ -0,0 +1,130 @@
+import asyncio
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import sqlalchemy as _sql
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import database, models, schemas, services, stats
+
+logger = logging.getLogger(__name__)
+
+# --- Configuration ---
+PREDICTION_WRITE_BEHIND = os.getenv("PREDICTION_WRITE_BEHIND", "false").lower() == "true"
+WRITE_BEHIND_FLUSH_MS = float(os.getenv("WRITE_BEHIND_FLUSH_MS", 5))  # Longest a write waits for company
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", 256))
+
+
+class PredictionWriter:
+    """
+    Coalesces the patient upserts and prediction inserts of concurrent requests
+    into one transaction with two multi-row statements using RETURNING, flushed
+    every `flush_ms` milliseconds or once `max_batch` writes are waiting.
+
+    Durability: a request is answered only after the batch holding its rows has
+    committed, exactly as with a direct write; batching adds at most `flush_ms`
+    of latency and never acknowledges a write that could still be lost. A crash
+    loses only queued writes whose requests have not been answered. If a batch
+    fails, its writes are retried one transaction each, so a bad row fails only
+    its own request. Pending writes are flushed on shutdown.
+    """
+    def __init__(self, flush_ms: float = WRITE_BEHIND_FLUSH_MS, max_batch: int = WRITE_BEHIND_MAX_BATCH):
+        self.flush_interval = flush_ms / 1000
+        self.max_batch = max(1, max_batch)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.batches = 0
+        self.rows = 0
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.put(None)  # Flushes what is already queued, then exits
+        await self._task
+        self._task = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    async def write(self, patient: schemas.PatientCreate, values: dict):
+        """Queues one patient + prediction; returns the prediction row once it is committed."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((patient.dict(), values, future))
+        return await future
+
+    async def _run(self):
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = asyncio.get_running_loop().time() + self.flush_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - asyncio.get_running_loop().time()
+                try:
+                    item = self._queue.get_nowait() if timeout <= 0 else await asyncio.wait_for(self._queue.get(), timeout)
+                except (asyncio.QueueEmpty, asyncio.TimeoutError):
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Tuple[dict, dict, asyncio.Future]]):
+        try:
+            rows = await self._insert([(patient, values) for patient, values, _ in batch])
+        except Exception as e:
+            if len(batch) > 1:
+                logger.warning("Batched write of %d predictions failed; retrying them one by one", len(batch))
+                for item in batch:
+                    await self._flush([item])
+                return
+            logger.exception("Prediction write failed")
+            rows = [e]
+        self.batches += 1
+        self.rows += len(batch)
+        for (_, _, future), row in zip(batch, rows):
+            if future.done():  # The request was cancelled meanwhile
+                continue
+            if isinstance(row, Exception):
+                future.set_exception(row)
+            else:
+                future.set_result(row)
+
+    async def _insert(self, items: List[Tuple[dict, dict]]):
+        # One upsert row per patient: later uploads in the batch carry the newer demographics
+        patients = {}
+        for patient, values in items:
+            patients[(values["owner_id"], patient["patient_id"])] = dict(patient, owner_id=values["owner_id"])
+        engine = database.get_async_engine()
+        async with engine.begin() as conn:
+            result = await conn.execute(services.patient_upsert(engine.dialect.name, list(patients.values())))
+            patient_ids = {(row.owner_id, row.patient_id): row.id for row in result}
+            # sort_by_parameter_order keeps RETURNING rows in the order of the parameter sets
+            rows = (await conn.execute(
+                _sql.insert(models.Prediction).returning(*models.Prediction.__table__.c, sort_by_parameter_order=True),
+                [dict(values, patient_record_id=patient_ids[(values["owner_id"], patient["patient_id"])])
+                 for patient, values in items],
+            )).all()
+            await conn.execute(stats.rollup_upsert(engine.dialect.name, stats.rollup_rows(rows)))
+            return rows
+
+async def store_prediction(db: AsyncSession, patient: schemas.PatientCreate, values: dict):
+    """
+    Writes a patient and its prediction (see services.prediction_values): through
+    the write-behind batcher when it is running, else in the request's own transaction.
+    """
+    if prediction_writer.running:
+        return await prediction_writer.write(patient, values)
+    return await db.run_sync(services.insert_patient_and_prediction, patient, values)
+
+
+prediction_writer = PredictionWriter()
@@ -0,0 +1,89 @@
+import json
+import os
+import tempfile
+
+# Configuration is read at import time, so it is set before any app module loads
+_tmp = tempfile.mkdtemp(prefix="app-tests-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp}/test.db")
+os.environ.setdefault("SECRET_KEY", "test-secret")
+os.environ.setdefault("PASSWORD_HASH_ROUNDS", "4")
+os.environ.setdefault("LOCAL_STORAGE_ROOT", os.path.join(_tmp, "uploads"))
+os.environ.setdefault("EMBEDDING_INDEX_DIR", os.path.join(_tmp, "embedding_index"))
+os.environ.setdefault("MODEL_DIR", os.path.join(_tmp, "models"))
+
+import pytest
+
+from app import auth_cache, database, model_registry, models, schemas, services
+
+
+@pytest.fixture
+def db():
+    """A session on an empty schema."""
+    models.Base.metadata.drop_all(bind=database.engine)
+    models.Base.metadata.create_all(bind=database.engine)
+    auth_cache.user_cache.clear()
+    auth_cache.token_cache.clear()
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def user(db):
+    db_user = models.User(email="user@example.com", hashed_password="x")
+    db.add(db_user)
+    db.commit()
+    return db_user
+
+
+@pytest.fixture
+def make_prediction(db, user):
+    """
+    Factory inserting a prediction of `user` and its patient the way the API
+    does; other keyword arguments override prediction columns (e.g. prediction_timestamp).
+    """
+    def make(predicted_class="glioma", confidence=0.9, reason="r", patient_id="P1", name="N", **columns):
+        values = services.prediction_values(
+            schemas.PredictionCreate(predicted_class=predicted_class, confidence=confidence, reason=reason),
+            user_id=user.id,
+        )
+        values.update(columns)
+        patient = schemas.PatientCreate(patient_id=patient_id, name=name, age=40, gender="F")
+        return services.insert_patient_and_prediction(db, patient, values)
+    return make
+
+
+@pytest.fixture
+def client(db):
+    """The API without its startup hooks (no models or index are loaded)."""
+    from fastapi.testclient import TestClient
+
+    from app import main
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def auth(user):
+    """Authorization header with an access token for `user`."""
+    token = services.create_access_token({"sub": user.email, "uid": user.id})
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    """Two registered versions whose label maps differ in class order and count."""
+    monkeypatch.setattr(model_registry, "MODEL_DIR", tmp_path)
+    for name, classes in [("label_map.json", ["glioma", "meningioma", "notumor", "pituitary"]),
+                          ("v2_labels.json", ["pituitary", "glioma", "notumor"])]:
+        (tmp_path / name).write_text(json.dumps({"classes": classes}))
+    config = tmp_path / "model_registry.json"
+    config.write_text(json.dumps({
+        "versions": {
+            model_registry.DEFAULT_MODEL_VERSION: {"model_path": "model.pt", "label_map_path": "label_map.json"},
+            "v2": {"model_path": "v2.pt", "label_map_path": "v2_labels.json"},
+        },
+        "serving": "v2", "shadow": None, "shadow_fraction": 0.0,
+    }))
+    monkeypatch.setattr(model_registry, "registry", model_registry.ModelRegistry(config))
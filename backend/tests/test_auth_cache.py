@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+from fastapi.security import SecurityScopes
+
+from app import auth_cache, credentials, models, services
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Replaces the caches' monotonic clock; advance with `clock.now += seconds`."""
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(auth_cache, "time", SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+def _current_user(auth):
+    return services.get_current_user(SecurityScopes(), auth["Authorization"].split()[1])
+
+
+def test_entries_expire_and_evict_least_recently_used(clock):
+    cache = auth_cache.TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("short", 2, ttl=5)
+    cache.set("long", 3, ttl=600)  # Capped at the cache's ttl; evicts "a", the least recently used
+    assert cache.get("a") is None
+
+    clock.now += 5
+    assert cache.get("short") is None and cache.get("long") == 3
+    clock.now += 55
+    assert cache.get("long") is None
+    cache.set("expired", 4, ttl=0)
+    assert cache.get("expired") is None
+
+
+def test_changed_user_is_served_until_ttl_without_invalidation(db, user, auth, clock):
+    assert _current_user(auth).is_admin is False
+    # Changed behind the cache's back, as by another API process
+    db.query(models.User).filter(models.User.id == user.id).update({"is_admin": True})
+    db.commit()
+    assert _current_user(auth).is_admin is False
+
+    clock.now += auth_cache.AUTH_CACHE_TTL_SECONDS
+    assert _current_user(auth).is_admin is True
+
+
+def test_user_changes_invalidate_the_cache(db, user, auth, clock):
+    assert _current_user(auth).is_admin is False
+    services.update_user(db, user.id, {"is_admin": True})
+    assert _current_user(auth).is_admin is True
+
+    services.set_password_hash(db, user, "new-hash")
+    assert _current_user(auth).hashed_password == "new-hash"
+
+
+def test_revoked_api_key_stops_working_at_once(db, user, clock):
+    db_key, key = credentials.create_api_key(db, user, "k", ["read"])
+    assert credentials.authenticate_api_key(key) == (user.id, frozenset({"read"}))
+    assert auth_cache.token_cache.get(("api_key", db_key.key_hash)) is not None
+
+    credentials.revoke_api_key(db, user.id, db_key.id)
+    assert credentials.authenticate_api_key(key) is None
@@ -0,0 +1,70 @@
+import datetime as _dt
+
+import pytest
+
+from app import models
+
+
+@pytest.fixture
+def signed_in(db, client):
+    """Signs up and in: the /token response (access and refresh token)."""
+    assert client.post("/users", json={"email": "a@example.com", "password": "pw"}).status_code == 200
+    response = client.post("/token", data={"username": "a@example.com", "password": "pw"})
+    assert response.status_code == 200
+    return response.json()
+
+
+def _refresh(client, token):
+    return client.post("/token/refresh", json={"refresh_token": token})
+
+
+def _bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_refresh_rotates(client, signed_in):
+    first = signed_in["refresh_token"]
+    response = _refresh(client, first)
+    assert response.status_code == 200
+    tokens = response.json()
+    assert tokens["refresh_token"] != first
+    assert client.get("/users/me", headers=_bearer(tokens["access_token"])).json()["email"] == "a@example.com"
+    assert _refresh(client, tokens["refresh_token"]).status_code == 200
+
+
+def test_reused_refresh_token_revokes_the_family(client, signed_in):
+    first = signed_in["refresh_token"]
+    second = _refresh(client, first).json()["refresh_token"]
+    reused = _refresh(client, first)
+    assert reused.status_code == 401 and "reused" in reused.json()["detail"]
+    # The legitimate successor stopped working too
+    assert _refresh(client, second).status_code == 401
+
+
+def test_revoke_and_expiry(db, client, signed_in):
+    token = signed_in["refresh_token"]
+    assert client.post("/token/revoke", json={"refresh_token": token}).status_code == 204
+    assert _refresh(client, token).status_code == 401
+
+    token = client.post("/token", data={"username": "a@example.com", "password": "pw"}).json()["refresh_token"]
+    db.query(models.RefreshToken).update({"expires_at": _dt.datetime.utcnow() - _dt.timedelta(seconds=1)})
+    db.commit()
+    response = _refresh(client, token)
+    assert response.status_code == 401 and "expired" in response.json()["detail"]
+
+
+def test_api_key_scopes(client, signed_in):
+    headers = _bearer(signed_in["access_token"])
+    assert client.post("/users/me/api-keys", json={"name": "k", "scopes": ["admin"]}, headers=headers).status_code == 400
+    created = client.post("/users/me/api-keys", json={"name": "k", "scopes": ["read"]}, headers=headers)
+    assert created.status_code == 201
+    key = created.json()["key"]
+
+    assert client.get("/users/me/history", headers=_bearer(key)).status_code == 200
+    # Keys never manage keys
+    assert client.get("/users/me/api-keys", headers=_bearer(key)).status_code == 403
+    listed = client.get("/users/me/api-keys", headers=headers).json()
+    assert [item["scopes"] for item in listed] == [["read"]] and "key" not in listed[0]
+
+    assert client.delete(f"/users/me/api-keys/{created.json()['id']}", headers=headers).status_code == 204
+    assert client.get("/users/me/history", headers=_bearer(key)).status_code == 401
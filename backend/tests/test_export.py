@@ -0,0 +1,20 @@
+import csv
+import io
+import json
+
+
+def test_csv_cells_cannot_start_formulas(client, auth, make_prediction):
+    make_prediction(reason="-r", name="=HYPERLINK(1)")
+    response = client.get("/users/me/export", headers=auth)
+    assert response.status_code == 200
+    (row,) = list(csv.DictReader(io.StringIO(response.text)))
+    assert row["patient_name"] == "'=HYPERLINK(1)"
+    assert row["reason"] == "'-r"
+    assert row["confidence"] == "0.9"
+
+
+def test_ndjson_keeps_values(client, auth, make_prediction):
+    make_prediction(reason="-r", name="=HYPERLINK(1)")
+    response = client.get("/users/me/export?format=ndjson", headers=auth)
+    (row,) = [json.loads(line) for line in response.text.splitlines()]
+    assert row["patient_name"] == "=HYPERLINK(1)"
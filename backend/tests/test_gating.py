@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from app import gating, ml_services, model_registry, models
+
+LARGE_AREA = ml_services.encode_area_curve(np.full(256, 65535, np.uint16))
+
+
+def _stored(make_prediction, model_version, probs):
+    return make_prediction(
+        predicted_class="stale", model_version=model_version, cam_area_curve=LARGE_AREA,
+        probabilities=ml_services.encode_probabilities(np.array(probs)),
+    ).id
+
+
+def test_regate_reads_each_version_with_its_label_map(db, make_prediction, registry):
+    legacy = _stored(make_prediction, None, [0.9, 0.04, 0.03, 0.03])
+    default = _stored(make_prediction, model_registry.DEFAULT_MODEL_VERSION, [0.03, 0.9, 0.04, 0.03])
+    v2 = _stored(make_prediction, "v2", [0.9, 0.05, 0.05])
+    gone = _stored(make_prediction, "removed", [0.9, 0.05, 0.05])
+
+    report = gating.regate(db)
+    assert report["rows"] == 3 and report["changed"] == 3 and report["skipped_versions"] == ["removed"]
+    labels = dict(db.query(models.Prediction.id, models.Prediction.predicted_class))
+    assert labels == {legacy: "glioma", default: "meningioma", v2: "pituitary", gone: "stale"}
+
+
+def test_sweep_needs_one_class_list(db, make_prediction, registry, tmp_path):
+    default = _stored(make_prediction, None, [0.9, 0.04, 0.03, 0.03])
+    v2 = _stored(make_prediction, "v2", [0.9, 0.05, 0.05])
+    labels = tmp_path / "labels.csv"
+    labels.write_text(f"prediction_id,label\n{default},glioma\n{v2},pituitary\n")
+    grid = np.array([0.5])
+    with pytest.raises(SystemExit, match="different classes"):
+        gating.run_sweep(db, str(labels), grid, grid, grid)
+    (result,) = gating.run_sweep(db, str(labels), grid, np.array([0.0]), grid, model_version="v2")
+    assert result["accuracy"] == 1.0 and set(result["per_class"]) == {"pituitary", "glioma", "notumor"}
+
+
+@pytest.mark.parametrize("threshold", [0.1, 0.2, 0.35, 0.4, 0.5, 0.9])
+def test_area_curve_never_counts_pixels_at_or_below_threshold(threshold):
+    heatmap = np.random.default_rng(0).random((64, 64), dtype=np.float32)
+    area = float(ml_services.cam_area_fraction(ml_services.cam_area_curve(heatmap), threshold))
+    step = 1 / 65535  # Curve resolution
+    assert area <= (heatmap > threshold).mean() + step
+    # Only the gap up to the first 8-bit level at or above the threshold is lost
+    assert area >= (heatmap >= np.ceil(threshold * 255 - 1e-6) / 255).mean() - step
@@ -0,0 +1,92 @@
+import datetime as _dt
+
+import pytest
+
+from app import models, services
+
+
+def _ids(response):
+    assert response.status_code == 200, response.text
+    return [prediction["id"] for prediction in response.json()]
+
+
+@pytest.fixture
+def start():
+    return _dt.datetime(2024, 1, 1, 12)
+
+
+@pytest.fixture
+def history(make_prediction, start):
+    """Five predictions a minute apart, oldest first."""
+    return [make_prediction(prediction_timestamp=start + _dt.timedelta(minutes=i)).id for i in range(5)]
+
+
+def test_etag_revalidation(db, user, client, auth, make_prediction, history, start):
+    first = client.get("/users/me/history", headers=auth)
+    etag = first.headers["ETag"]
+    assert client.get("/users/me/history", headers={**auth, "If-None-Match": etag}).status_code == 304
+    # Other parameters are another representation
+    assert client.get("/users/me/history?limit=2", headers={**auth, "If-None-Match": etag}).status_code == 200
+
+    make_prediction(prediction_timestamp=start + _dt.timedelta(hours=1))
+    changed = client.get("/users/me/history", headers={**auth, "If-None-Match": etag})
+    assert changed.status_code == 200 and changed.headers["ETag"] != etag
+
+    etag = changed.headers["ETag"]
+    services.bump_history_revision(db, user_ids=[user.id])
+    db.commit()
+    assert client.get("/users/me/history", headers={**auth, "If-None-Match": etag}).status_code == 200
+
+
+def test_since_returns_only_newer_predictions(client, auth, make_prediction, history, start, monkeypatch):
+    monkeypatch.setattr(services, "HISTORY_SYNC_OVERLAP_SECONDS", 0)
+    first = client.get("/users/me/history?limit=2", headers=auth)
+    assert _ids(first) == history[:-3:-1]
+    sync = first.headers["X-Sync-Cursor"]
+
+    later = [make_prediction(prediction_timestamp=start + _dt.timedelta(hours=1, minutes=i)).id for i in range(3)]
+    page = client.get("/users/me/history", params={"since": sync, "limit": 2}, headers=auth)
+    assert _ids(page) == later[:2]
+    rest = client.get(
+        "/users/me/history", params={"since": sync, "cursor": page.headers["X-Next-Cursor"], "limit": 2}, headers=auth,
+    )
+    assert _ids(rest) == later[2:] and "X-Next-Cursor" not in rest.headers
+
+    caught_up = client.get("/users/me/history", params={"since": rest.headers["X-Sync-Cursor"]}, headers=auth)
+    assert _ids(caught_up) == []
+    assert caught_up.headers["X-Sync-Cursor"] == rest.headers["X-Sync-Cursor"]
+
+
+def test_since_rereads_overlap_for_late_commits(client, auth, make_prediction, history, start, monkeypatch):
+    monkeypatch.setattr(services, "HISTORY_SYNC_OVERLAP_SECONDS", 90)
+    sync = client.get("/users/me/history", headers=auth).headers["X-Sync-Cursor"]
+    # Timestamped before the newest synced prediction but committed after the sync
+    late = make_prediction(prediction_timestamp=start + _dt.timedelta(minutes=3, seconds=30)).id
+
+    page = client.get("/users/me/history", params={"since": sync}, headers=auth)
+    assert late in _ids(page)
+    assert page.headers["X-Sync-Cursor"] == sync
+
+
+def test_cursors_page_through_equal_timestamps(db, user, make_prediction, start, monkeypatch):
+    # Ties on prediction_timestamp are broken by id, so no page boundary drops or repeats a row
+    same = [make_prediction(prediction_timestamp=start).id for _ in range(5)]
+    older = make_prediction(prediction_timestamp=start - _dt.timedelta(minutes=1)).id
+
+    seen, cursor = [], None
+    while True:
+        rows, cursor = services.get_predictions_for_user(db, user.id, limit=2, cursor=cursor)
+        seen += [row.id for row in rows]
+        if cursor is None:
+            break
+    assert seen == sorted(same, reverse=True) + [older]
+
+    monkeypatch.setattr(services, "HISTORY_SYNC_OVERLAP_SECONDS", 0)
+    since = services.encode_cursor(db.get(models.Prediction, older))
+    synced, cursor = [], None
+    while True:
+        rows, cursor = services.get_predictions_for_user(db, user.id, limit=2, cursor=cursor, since=since)
+        synced += [row.id for row in rows]
+        if cursor is None:
+            break
+    assert synced == sorted(same)
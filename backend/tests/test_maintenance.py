@@ -0,0 +1,60 @@
+import datetime as _dt
+import os
+import time
+
+import cv2
+import numpy as np
+import pytest
+
+from app import maintenance, models, storage
+
+
+@pytest.fixture
+def store(tmp_path):
+    return storage.LocalStorage(tmp_path)
+
+
+def _png():
+    noise = np.random.default_rng(0).integers(0, 256, (64, 64, 3), dtype=np.uint8)
+    return cv2.imencode(".png", noise)[1].tobytes()
+
+
+def _age(store, key, hours):
+    past = time.time() - hours * 3600
+    os.utime(store.path(key), (past, past))
+
+
+def test_compaction_repoints_every_row_sharing_an_overlay(db, user, make_prediction, store):
+    data = _png()
+    old_key, new_png = storage.content_key(data, ".png"), storage.content_key(data[:-1] + b"x", ".png")
+    store.write(old_key, data)
+    store.write(new_png, data)
+    long_ago = _dt.datetime.utcnow() - _dt.timedelta(days=maintenance.COMPACT_AFTER_DAYS + 1)
+    shared = [make_prediction(image_url=old_key, prediction_timestamp=long_ago).id for _ in range(2)]
+    recent = make_prediction(image_url=new_png).id
+
+    compacted, saved = maintenance.compact_overlays(db, store)
+    assert compacted == 1 and saved > 0
+    urls = dict(db.query(models.Prediction.id, models.Prediction.image_url))
+    assert urls[shared[0]] == urls[shared[1]] and urls[shared[0]].endswith(".webp")
+    assert store.exists(urls[shared[0]]) and not store.exists(old_key)
+    assert urls[recent] == new_png and store.exists(new_png)
+    assert db.get(models.User, user.id).history_revision == 1
+
+
+def test_gc_keeps_referenced_and_young_files(db, make_prediction, store):
+    for key in ("aa/aa/referenced.png", "bb/bb/orphan.png", "cc/cc/young-orphan.png"):
+        store.write(key, b"data")
+    for key in ("aa/aa/referenced.png", "bb/bb/orphan.png"):
+        _age(store, key, maintenance.GC_GRACE_HOURS + 1)
+    kept = make_prediction(image_url="aa/aa/referenced.png").id
+    # Legacy path whose file is gone
+    lost = make_prediction(image_url="uploads\\dd\\dd\\lost.png").id
+
+    assert maintenance.collect_garbage(db, store, dry_run=True) == (1, 4, 1)
+    assert store.exists("bb/bb/orphan.png")
+
+    assert maintenance.collect_garbage(db, store) == (1, 4, 1)
+    assert sorted(store.iter_keys()) == ["aa/aa/referenced.png", "cc/cc/young-orphan.png"]
+    missing = dict(db.query(models.Prediction.id, models.Prediction.image_missing))
+    assert missing[lost] is True and not missing[kept]
@@ -0,0 +1,64 @@
+import sqlalchemy as _sql
+
+from app import migrations, models
+
+
+def _legacy_engine(tmp_path):
+    """A database from before patients were unique per (owner, patient_id)."""
+    engine = _sql.create_engine(f"sqlite:///{tmp_path / 'legacy.db'}")
+    models.Base.metadata.create_all(bind=engine)
+    with engine.begin() as conn:
+        conn.execute(_sql.text("DROP INDEX uq_patients_owner_patient_id"))
+    return engine
+
+
+def _seed(engine):
+    with engine.begin() as conn:
+        conn.execute(_sql.insert(models.User), [
+            {"id": 1, "email": "one@example.com", "hashed_password": "x"},
+            {"id": 2, "email": "two@example.com", "hashed_password": "x"},
+        ])
+        conn.execute(_sql.insert(models.Patient), [
+            {"id": 1, "patient_id": "P1", "name": "Old", "age": 40, "gender": "F", "owner_id": 1},
+            {"id": 2, "patient_id": "P1", "name": "Mid", "age": 41, "gender": "F", "owner_id": 1},
+            {"id": 3, "patient_id": "P1", "name": "Other", "age": 50, "gender": "M", "owner_id": 2},
+            # From before patients had an owner: adopted from its predictions, then merged
+            {"id": 4, "patient_id": "P1", "name": "New", "age": 42, "gender": "F", "owner_id": None},
+            # No owner and no predictions: stays as it is
+            {"id": 5, "patient_id": "P2", "name": "Orphan", "age": 30, "gender": "M", "owner_id": None},
+        ])
+        conn.execute(_sql.insert(models.Prediction), [
+            {"id": 10, "owner_id": 1, "patient_record_id": 1, "predicted_class": "glioma", "confidence": 0.9},
+            {"id": 11, "owner_id": 1, "patient_record_id": 2, "predicted_class": "glioma", "confidence": 0.9},
+            {"id": 12, "owner_id": 2, "patient_record_id": 3, "predicted_class": "glioma", "confidence": 0.9},
+            {"id": 13, "owner_id": 1, "patient_record_id": 4, "predicted_class": "glioma", "confidence": 0.9},
+        ])
+
+
+def test_upgrade_merges_duplicate_patients(tmp_path):
+    engine = _legacy_engine(tmp_path)
+    _seed(engine)
+
+    migrations.upgrade(engine)
+
+    with engine.connect() as conn:
+        patients = {row.id: row for row in conn.execute(_sql.select(models.Patient))}
+        repointed = dict(conn.execute(_sql.select(models.Prediction.id, models.Prediction.patient_record_id)).all())
+    assert sorted(patients) == [3, 4, 5]
+    assert (patients[4].owner_id, patients[4].name) == (1, "New")  # Newest row's demographics
+    assert patients[5].owner_id is None
+    assert repointed == {10: 4, 11: 4, 12: 3, 13: 4}
+    indexes = {index["name"]: index for index in _sql.inspect(engine).get_indexes("patients")}
+    assert indexes["uq_patients_owner_patient_id"]["unique"]
+
+
+def test_upgrade_is_idempotent(tmp_path):
+    engine = _legacy_engine(tmp_path)
+    _seed(engine)
+    migrations.upgrade(engine)
+
+    migrations.upgrade(engine)
+
+    with engine.connect() as conn:
+        assert conn.execute(_sql.select(_sql.func.count()).select_from(models.Patient)).scalar() == 3
+        assert conn.execute(_sql.select(_sql.func.count()).select_from(models.Prediction)).scalar() == 4
@@ -0,0 +1,34 @@
+import pytest
+
+from app import model_registry
+
+
+class FakeModel:
+    def __init__(self, model_path, label_map_path):
+        self.model_path = model_path
+
+
+@pytest.fixture
+def loaded(registry, tmp_path, monkeypatch):
+    """The test registry with stub checkpoints, serving v2."""
+    monkeypatch.setattr(model_registry, "LoadedModel", FakeModel)
+    for name in ("model.pt", "v2.pt", "v3.pt"):
+        (tmp_path / name).write_bytes(b"")
+    model_registry.registry.serving()
+    return model_registry.registry
+
+
+def test_register_never_replaces_a_version(loaded, tmp_path):
+    for version in ("v2", model_registry.DEFAULT_MODEL_VERSION):  # Serving, then idle
+        with pytest.raises(model_registry.VersionExists):
+            loaded.register(version, "v3.pt", "v2_labels.json")
+    assert loaded.serving()[1].model_path == tmp_path / "v2.pt"
+    loaded.register("v3", "v3.pt", "v2_labels.json")
+    assert "v3" in loaded.describe()["versions"]
+
+
+def test_shadow_after_stop_is_skipped(loaded):
+    loaded.set_shadow(model_registry.DEFAULT_MODEL_VERSION, 1.0)
+    loaded.stop()
+    loaded.shadow("v2", {"class": "glioma", "confidence": 0.9}, lambda model: pytest.fail("ran after stop"))
+    assert loaded._shadow_pending == 0 and loaded._shadow_executor is None
@@ -0,0 +1,20 @@
+import pytest
+
+from app import ml_services, services
+
+
+@pytest.mark.parametrize("value", ["-1", "4", "10"])
+def test_distances_the_band_index_cannot_serve_are_rejected(value):
+    with pytest.raises(ValueError, match="PHASH_MAX_DISTANCE"):
+        ml_services._phash_max_distance(value)
+
+
+def test_finds_hashes_up_to_the_max_distance(make_prediction, db, user):
+    base = 0x0123_4567_89AB_CDEF
+    # One flipped bit in three of the four bands: only band 3 still matches
+    near = base ^ (1 << 0) ^ (1 << 16) ^ (1 << 32)
+    far = near ^ (1 << 48)  # Differs from base in every band
+    stored = make_prediction(**services.phash_columns(base))
+    assert services.find_near_duplicate(db, user.id, "P1", near, ml_services.PHASH_MAX_DISTANCE).id == stored.id
+    assert services.find_near_duplicate(db, user.id, "P1", far, ml_services.PHASH_MAX_DISTANCE) is None
+    assert services.find_near_duplicate(db, user.id, "P2", near, ml_services.PHASH_MAX_DISTANCE) is None
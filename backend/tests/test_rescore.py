@@ -0,0 +1,9 @@
+from pathlib import Path
+
+from app import ml_services, rescore
+
+
+def test_label_map_of_the_registered_version(registry, tmp_path):
+    assert rescore.resolve_label_map("v2") == tmp_path / "v2_labels.json"
+    assert rescore.resolve_label_map("unregistered") == ml_services.LABEL_MAP_PATH
+    assert rescore.resolve_label_map("v2", Path("explicit.json")) == Path("explicit.json")
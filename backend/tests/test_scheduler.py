@@ -0,0 +1,139 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from app import scheduler
+
+
+def _run(test, **options):
+    """Runs `test(sched)` against a started single-worker scheduler."""
+    async def main():
+        sched = scheduler.InferenceScheduler(workers=1, **options)
+        await sched.start()
+        try:
+            return await test(sched)
+        finally:
+            await sched.stop()
+    return asyncio.run(main())
+
+
+async def _hold_worker(sched, user="holder", seconds=0.0):
+    """Occupies the only worker until the returned event is set."""
+    release = threading.Event()
+
+    def hold():
+        release.wait(5)
+        time.sleep(seconds)
+        return "held"
+    task = asyncio.create_task(sched.submit(hold, user=user))
+    while not sched.running:
+        await asyncio.sleep(0.005)
+    return release, task
+
+
+def _job(order, name):
+    return lambda: order.append(name) or name
+
+
+def test_backlogged_users_are_served_fairly():
+    async def test(sched):
+        order = []
+        release, held = await _hold_worker(sched, user="a", seconds=0.05)
+        jobs = [asyncio.create_task(sched.submit(_job(order, name), user=name[0])) for name in ("a1", "a2", "b1")]
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(held, *jobs)
+        return order
+    # "a" has used the worker already, so "b" goes ahead of a's backlog
+    assert _run(test) == ["b1", "a1", "a2"]
+
+
+def test_interactive_jobs_go_before_bulk():
+    async def test(sched):
+        order = []
+        release, held = await _hold_worker(sched)
+        bulk = asyncio.create_task(sched.submit(_job(order, "bulk"), user="c", priority=scheduler.BULK))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(sched.submit(_job(order, "interactive"), user="d"))
+        await asyncio.sleep(0.01)
+        release.set()
+        await asyncio.gather(held, bulk, interactive)
+        return order
+    assert _run(test) == ["interactive", "bulk"]
+
+
+def test_admission_limits():
+    async def test(sched):
+        release, held = await _hold_worker(sched)
+        queued = [
+            asyncio.create_task(sched.submit(lambda: None, user="u")),
+            asyncio.create_task(sched.submit(lambda: None, user="v", priority=scheduler.BULK)),
+        ]
+        await asyncio.sleep(0.01)
+        statuses = []
+        for user, priority in [("u", scheduler.INTERACTIVE), ("w", scheduler.BULK)]:
+            with pytest.raises(scheduler.InferenceRejected) as rejected:
+                sched.ensure_capacity(user, priority)
+            statuses.append(rejected.value.status_code)
+        queued.append(asyncio.create_task(sched.submit(lambda: None, user="w")))
+        await asyncio.sleep(0.01)
+        with pytest.raises(scheduler.InferenceRejected) as full:
+            sched.ensure_capacity()
+        statuses.append((full.value.status_code, full.value.retry_after >= 1))
+        release.set()
+        await asyncio.gather(held, *queued)
+        return statuses
+    # Per-user queue -> 429, bulk share of the queue -> 503, whole queue -> 503
+    assert _run(test, max_depth=3, user_max_queued=1, bulk_max_queued=1) == [429, 503, (503, True)]
+
+
+def test_timed_out_job_leaves_the_queue():
+    async def test(sched):
+        release, held = await _hold_worker(sched)
+        ran = []
+        with pytest.raises(scheduler.InferenceRejected, match="deadline"):
+            await sched.submit(lambda: ran.append(True), timeout=0.05, user="late")
+        state = (sched.depth, "late" in sched._queued_by_user)
+        release.set()
+        await held
+        await asyncio.sleep(0.01)
+        return state, ran
+    assert _run(test) == ((0, False), [])
+
+
+# --- Upload admission ---
+async def _app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b""})
+
+
+def _status(headers, path="/predict/image", sched=None):
+    middleware = scheduler.UploadAdmissionMiddleware(
+        _app, {"/predict/image": 1000}, sched or scheduler.InferenceScheduler(max_depth=1)
+    )
+    scope = {"type": "http", "method": "POST", "path": path, "headers": headers}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+    asyncio.run(middleware(scope, receive, send))
+    start = messages[0]
+    return start["status"], dict(start["headers"])
+
+
+def test_upload_admission():
+    limit = 1000 + scheduler.UPLOAD_FORM_OVERHEAD_BYTES
+    assert _status([])[0] == 411
+    assert _status([(b"content-length", b"many")])[0] == 400
+    assert _status([(b"content-length", str(limit + 1).encode())])[0] == 413
+    assert _status([(b"content-length", str(limit).encode())])[0] == 200
+    assert _status([], path="/other")[0] == 200
+
+    full = scheduler.InferenceScheduler(max_depth=0)
+    status, headers = _status([(b"content-length", b"10")], sched=full)
+    assert status == 503 and headers[b"retry-after"] == b"1"
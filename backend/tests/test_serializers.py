@@ -0,0 +1,58 @@
+import datetime as _dt
+import json
+from typing import List
+
+import pytest
+import sqlalchemy.orm as _orm
+from pydantic import TypeAdapter
+
+from app import models, schemas, serializers, services
+
+
+def _schema_json(schema, value):
+    """What FastAPI returns for response_model=schema."""
+    adapter = TypeAdapter(schema)
+    return adapter.dump_python(adapter.validate_python(value, from_attributes=True), mode="json")
+
+
+def _fast_json(content):
+    return json.loads(serializers.FastJSONResponse(content).body)
+
+
+@pytest.fixture
+def filled(make_prediction):
+    start = _dt.datetime(2024, 1, 1, 12, 30, 15, 250000)
+    for i in range(4):
+        make_prediction(
+            confidence=0.25 * i, patient_id=f"P{i % 2}", name="Näme",
+            prediction_timestamp=start + _dt.timedelta(minutes=i),
+            image_url=f"ab/cd/{i:032x}.png" if i % 2 else None,
+        )
+
+
+def test_history_fast_path_matches_schema(db, user, filled):
+    rows, _ = services.get_predictions_for_user(db, user_id=user.id, limit=10)
+    objects = (
+        db.query(models.Prediction)
+        .options(_orm.joinedload(models.Prediction.patient))
+        .order_by(models.Prediction.prediction_timestamp.desc(), models.Prediction.id.desc())
+        .all()
+    )
+    assert len(rows) == len(objects) == 4
+    expected = _schema_json(List[schemas.PredictionWithPatient], objects)
+    assert _fast_json(serializers.predictions_with_patients(rows)) == expected
+
+
+def test_timeline_fast_path_matches_schema(db, user, filled):
+    patient, rows = services.get_patient_timeline(db, user_id=user.id, patient_id="P1")
+    objects = (
+        db.query(models.Prediction)
+        .filter(models.Prediction.patient_record_id == patient.id)
+        .order_by(models.Prediction.prediction_timestamp, models.Prediction.id)
+        .all()
+    )
+    expected = _schema_json(
+        schemas.PatientTimeline, {**{field: getattr(patient, field) for field in serializers.PATIENT_FIELDS},
+                                  "predictions": objects},
+    )
+    assert _fast_json(serializers.patient_timeline(patient, rows)) == expected
@@ -0,0 +1,60 @@
+import datetime as _dt
+
+import pytest
+
+from app import models, stats
+
+
+def _rollups(db):
+    return {
+        (row.user_id, row.day, row.predicted_class): (row.prediction_count, pytest.approx(row.confidence_sum))
+        for row in db.query(models.DailyPredictionStats)
+    }
+
+
+@pytest.fixture
+def predictions(make_prediction):
+    today = _dt.datetime.utcnow().replace(hour=12)
+    yesterday = today - _dt.timedelta(days=1)
+    for predicted_class, confidence, when in [
+        ("glioma", 0.9, today), ("glioma", 0.7, today), ("notumor", 0.6, today),
+        ("glioma", 0.8, yesterday), ("pituitary", 0.5, yesterday - _dt.timedelta(days=40)),
+    ]:
+        make_prediction(predicted_class, confidence, prediction_timestamp=when)
+    return today.date(), yesterday.date()
+
+
+def test_inserts_maintain_rollups(db, user, predictions):
+    today, yesterday = predictions
+    assert _rollups(db) == {
+        (user.id, today, "glioma"): (2, pytest.approx(1.6)),
+        (user.id, today, "notumor"): (1, pytest.approx(0.6)),
+        (user.id, yesterday, "glioma"): (1, pytest.approx(0.8)),
+        (user.id, yesterday - _dt.timedelta(days=40), "pituitary"): (1, pytest.approx(0.5)),
+    }
+
+
+def test_backfill_reproduces_incremental_rollups(db, user, predictions):
+    incremental = _rollups(db)
+    db.query(models.DailyPredictionStats).delete()
+    db.commit()
+
+    assert stats.backfill(db) == len(incremental)
+    assert _rollups(db) == incremental
+    stats.backfill(db, user_id=user.id)  # Rebuilding again changes nothing
+    assert _rollups(db) == incremental
+
+
+def test_user_stats_read_from_rollups(db, user, predictions):
+    today, yesterday = predictions
+    result = stats.get_user_stats(db, user.id, days=7)
+
+    assert result["total"] == 5
+    assert [(c["predicted_class"], c["count"]) for c in result["by_class"]] == [
+        ("glioma", 3), ("notumor", 1), ("pituitary", 1),
+    ]
+    assert result["by_class"][0]["mean_confidence"] == pytest.approx(0.8)
+    # The 40-day-old prediction counts in the totals but not in a 7-day window
+    assert [(d["day"], d["predicted_class"], d["count"]) for d in result["daily"]] == [
+        (yesterday, "glioma", 1), (today, "glioma", 2), (today, "notumor", 1),
+    ]
@@ -0,0 +1,69 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from app import storage
+
+
+@pytest.fixture
+def store(tmp_path):
+    return storage.LocalStorage(tmp_path)
+
+
+def test_local_storage_round_trip(store):
+    key = storage.content_key(b"scan", ".png")
+    assert key == storage.content_key(b"scan", ".png") and key.endswith(".png")
+    assert not store.exists(key)
+    store.write(key, b"scan")
+    assert store.exists(key) and store.read(key) == b"scan"
+    assert store.stat(key)[0] == 4
+    assert [(k, size) for k, size, _ in store.iter_objects()] == [(key, 4)]
+    store.remove(key)
+    store.remove(key)  # Missing keys are fine
+    assert not store.exists(key) and list(store.iter_keys()) == []
+
+
+def test_async_wrappers(store):
+    async def run():
+        await store.put("ab/cd/x.png", b"x")
+        found = await store.has("ab/cd/x.png"), await store.get("ab/cd/x.png")
+        await store.delete("ab/cd/x.png")
+        return found, await store.has("ab/cd/x.png")
+    assert asyncio.run(run()) == ((True, b"x"), False)
+
+
+def test_keys_stay_inside_the_root(store):
+    for key in ("../outside.png", "ab/../../outside.png", "/etc/passwd"):
+        with pytest.raises(ValueError):
+            store.path(key)
+    # Paths stored before the storage layer still resolve
+    assert store.path("uploads\\old.png") == store.root / "old.png"
+
+
+@pytest.fixture
+def media(client):
+    """A stored image and its signed URL on the configured (local) store."""
+    key = storage.content_key(b"overlay", ".png")
+    storage.get_storage().write(key, b"overlay")
+    return key, "/" + storage.get_storage().url(key)
+
+
+def test_signed_media_url_serves_the_object(client, media):
+    key, url = media
+    response = client.get(url)
+    assert response.status_code == 200 and response.content == b"overlay"
+    assert response.headers["Cache-Control"] == storage.MEDIA_CACHE_CONTROL
+    assert client.get(url, headers={"If-None-Match": response.headers["ETag"]}).status_code == 304
+
+
+def test_tampered_or_expired_media_url_is_refused(client, media, monkeypatch):
+    key, url = media
+    other = storage.content_key(b"someone else's", ".png")
+    assert client.get(url.replace(key, other)).status_code == 403
+    assert client.get(url[:-1] + ("0" if url[-1] != "0" else "1")).status_code == 403
+    # Valid for one to two buckets, then refused
+    later = time.time() + 2 * storage.MEDIA_URL_BUCKET_SECONDS + 1
+    monkeypatch.setattr(storage, "time", SimpleNamespace(time=lambda: later))
+    assert client.get(url).status_code == 403
@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+
+from app import vector_index
+
+
+def _row(prediction_id, owner_id=1):
+    rng = np.random.default_rng(prediction_id)
+    return prediction_id, owner_id, vector_index.encode_embedding(rng.standard_normal(vector_index.EMBEDDING_DIM))
+
+
+@pytest.fixture(params=["hnsw", "numpy"])
+def backend(request, monkeypatch):
+    if request.param == "hnsw" and vector_index.hnswlib is None:
+        pytest.skip("hnswlib is not installed")
+    if request.param == "numpy":
+        monkeypatch.setattr(vector_index, "hnswlib", None)
+    return request.param
+
+
+def test_load_after_crash_between_owner_file_and_manifest(tmp_path, backend):
+    index = vector_index.EmbeddingIndex(tmp_path)
+    index.add_many([_row(i) for i in range(1, 6)])
+    index.save()
+    # More rows reach the owner file, then the process dies before the manifest is replaced
+    index.add_many([_row(i) for i in range(6, 9)])
+    index._owners[1].save(tmp_path / "owner_1")
+
+    reloaded = vector_index.EmbeddingIndex(tmp_path)
+    reloaded.load(lambda max_id: [_row(i) for i in range(max_id + 1, 10)])
+    assert reloaded._owners[1].count == 9
+    assert reloaded._since_snapshot == 1  # Only id 9 was inserted; 6-8 were in the file already
+    results = reloaded.search(1, _row(3)[2], k=20)
+    assert sorted(prediction_id for prediction_id, _ in results) == list(range(1, 10))
+    assert results[0][0] == 3
+
+
+def test_one_process_writes_the_directory(tmp_path):
+    writer = vector_index.EmbeddingIndex(tmp_path)
+    writer.add_many([_row(1)])
+    writer.save()
+    other = vector_index.EmbeddingIndex(tmp_path)
+    other.add_many([_row(2, owner_id=2)])
+    other.save()
+    assert not (tmp_path / "owner_2.bin").exists() and not (tmp_path / "owner_2.npz").exists()
+    assert other.search(2, _row(2)[2], k=1)[0][0] == 2  # Still served from memory
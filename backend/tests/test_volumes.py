@@ -0,0 +1,37 @@
+import gzip
+import io
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from app import ml_services, volumes
+
+
+@pytest.fixture(autouse=True)
+def serving(monkeypatch):
+    model = SimpleNamespace(classes=["glioma", "meningioma", "notumor", "pituitary"])
+    monkeypatch.setattr(ml_services, "registry", SimpleNamespace(serving=lambda: ("test", model)))
+
+
+def _gzipped(size):
+    return io.BytesIO(gzip.compress(bytes(size)))
+
+
+def test_inflated_nifti_is_capped(monkeypatch):
+    monkeypatch.setattr(volumes, "MAX_VOLUME_INFLATED_BYTES", 2 * volumes.INFLATE_CHUNK_BYTES)
+    volume = volumes.VolumeInference([_gzipped(3 * volumes.INFLATE_CHUNK_BYTES)], ["bomb.nii.gz"])
+    with pytest.raises(ValueError, match="uncompressed"):
+        volume.step()
+    tmp_path = volume._tmp_path
+    assert os.path.getsize(tmp_path) <= volumes.MAX_VOLUME_INFLATED_BYTES
+    volume.close()
+    assert not os.path.exists(tmp_path)
+
+
+def test_inflated_nifti_within_the_cap(monkeypatch):
+    monkeypatch.setattr(volumes, "MAX_VOLUME_INFLATED_BYTES", 2 * volumes.INFLATE_CHUNK_BYTES)
+    volume = volumes.VolumeInference([_gzipped(2 * volumes.INFLATE_CHUNK_BYTES)], ["scan.nii.gz"])
+    volume._open()
+    assert os.path.getsize(volume._tmp_path) == 2 * volumes.INFLATE_CHUNK_BYTES
+    volume.close()
@@ -0,0 +1,47 @@
+import asyncio
+
+from app import database, models, schemas, services, write_behind
+
+
+def _write_all(writer, user, patient_ids):
+    async def main():
+        await writer.start()
+        try:
+            return await asyncio.gather(*[
+                writer.write(
+                    schemas.PatientCreate(patient_id=patient_id, name=patient_id, age=40, gender="F"),
+                    services.prediction_values(
+                        schemas.PredictionCreate(predicted_class="glioma", confidence=0.9, reason=patient_id),
+                        user_id=user.id,
+                    ),
+                )
+                for patient_id in patient_ids
+            ])
+        finally:
+            await writer.stop()
+            await database.dispose_async_engine()  # Its connections belong to this event loop
+    return asyncio.run(main())
+
+
+def test_batches_return_each_request_its_own_row_in_order(db, user):
+    writer = write_behind.PredictionWriter(flush_ms=50, max_batch=3)
+    patient_ids = [f"P{i}" for i in range(5)]
+
+    rows = _write_all(writer, user, patient_ids)
+
+    assert [row.reason for row in rows] == patient_ids
+    assert [row.id for row in rows] == sorted(row.id for row in rows)
+    assert (writer.batches, writer.rows) == (2, 5)  # Full batch of 3, then the rest on the timer
+    patients = {p.id: p.patient_id for p in db.query(models.Patient)}
+    assert [patients[row.patient_record_id] for row in rows] == patient_ids
+    assert db.query(models.Prediction).count() == 5
+
+
+def test_same_patient_in_one_batch_is_upserted_once(db, user):
+    writer = write_behind.PredictionWriter(flush_ms=50, max_batch=10)
+
+    rows = _write_all(writer, user, ["P1", "P1", "P2"])
+
+    assert writer.batches == 1
+    assert rows[0].patient_record_id == rows[1].patient_record_id != rows[2].patient_record_id
+    assert db.query(models.Patient).count() == 2
@@ -23,4 +23,9 @@ api.interceptors.request.use(
   }
 );
 
+// Stored images come back either as absolute (e.g. presigned S3) URLs or as
+// paths relative to the API
+export const mediaUrl = (url) =>
+  /^https?:\/\//.test(url) ? url : `${api.defaults.baseURL}/${url}`;
+
 export default api;
\ No newline at end of file
@@ -1,5 +1,5 @@
 import React, { useState, useEffect } from 'react';
-import api from '../api';
+import api, { mediaUrl } from '../api';
 import {
   PieChart,
   Pie,
@@ -11,14 +11,24 @@ import {
 
 function AccountPage() {
   const [history, setHistory] = useState([]);
+  const [stats, setStats] = useState(null);
   const [error, setError] = useState('');
   const [isLoading, setIsLoading] = useState(true);
+  // Cursor of the next (older) page of history; null once everything is loaded
+  const [nextCursor, setNextCursor] = useState(null);
+  const [isLoadingMore, setIsLoadingMore] = useState(false);
 
   useEffect(() => {
     const fetchHistory = async () => {
       try {
-        const response = await api.get('/users/me/history');
+        // The chart comes from server-side rollups, so it covers all predictions, not just loaded pages
+        const [response, statsResponse] = await Promise.all([
+          api.get('/users/me/history'),
+          api.get('/users/me/stats'),
+        ]);
         setHistory(response.data);
+        setNextCursor(response.headers['x-next-cursor'] || null);
+        setStats(statsResponse.data);
       } catch (err) {
         setError('Failed to fetch prediction history.');
       } finally {
@@ -29,6 +39,31 @@ function AccountPage() {
     fetchHistory();
   }, []);
 
+  const handleLoadMore = async () => {
+    setIsLoadingMore(true);
+    try {
+      const response = await api.get('/users/me/history', { params: { cursor: nextCursor } });
+      setHistory((prev) => [...prev, ...response.data]);
+      setNextCursor(response.headers['x-next-cursor'] || null);
+    } catch (err) {
+      setError('Failed to fetch prediction history.');
+    } finally {
+      setIsLoadingMore(false);
+    }
+  };
+
+  // Predictions made while the server was under load have no overlay yet
+  const handleRenderOverlay = async (predictionId) => {
+    try {
+      const response = await api.post(`/predictions/${predictionId}/overlay`);
+      setHistory((prev) =>
+        prev.map((p) => (p.id === predictionId ? { ...p, ...response.data } : p))
+      );
+    } catch (err) {
+      setError('Failed to render the prediction image.');
+    }
+  };
+
   if (isLoading) {
     return <div>Loading history...</div>;
   }
@@ -37,15 +72,9 @@ function AccountPage() {
     return <div style={{ color: 'red' }}>{error}</div>;
   }
 
-  // --- Process history to count predicted classes ---
-  const classCounts = history.reduce((acc, pred) => {
-    acc[pred.predicted_class] = (acc[pred.predicted_class] || 0) + 1;
-    return acc;
-  }, {});
-
-  const chartData = Object.entries(classCounts).map(([label, value]) => ({
-    name: label,
-    value,
+  const chartData = (stats?.by_class || []).map(({ predicted_class, count }) => ({
+    name: predicted_class,
+    value: count,
   }));
 
   const COLORS = ['#0088FE', '#00C49F', '#FFBB28', '#FF8042']; // Add more if needed
@@ -128,19 +157,30 @@ function AccountPage() {
                 <td>{pred.predicted_class}</td>
                 <td>{pred.confidence.toFixed(4)}</td>
                 <td>
-                  <a
-                    href={`http://localhost:8000/${pred.image_url}`}
-                    target="_blank"
-                    rel="noopener noreferrer"
-                  >
-                    View Image
-                  </a>
+                  {pred.image_url ? (
+                    <a
+                      href={mediaUrl(pred.image_url)}
+                      target="_blank"
+                      rel="noopener noreferrer"
+                    >
+                      View Image
+                    </a>
+                  ) : (
+                    <button onClick={() => handleRenderOverlay(pred.id)}>
+                      Render Image
+                    </button>
+                  )}
                 </td>
               </tr>
             ))}
           </tbody>
         </table>
       )}
+      {nextCursor && (
+        <button onClick={handleLoadMore} disabled={isLoadingMore} style={{ marginTop: '10px' }}>
+          {isLoadingMore ? 'Loading...' : 'Load more'}
+        </button>
+      )}
     </div>
   );
 }
@@ -1,5 +1,5 @@
 import React, { useState } from "react";
-import api from "../api"; // Import our authenticated API client
+import api, { mediaUrl } from "../api"; // Import our authenticated API client
 
 function PredictPage() {
   const [patientId, setPatientId] = useState("");
@@ -61,6 +61,22 @@ function PredictPage() {
     }
   };
 
+  const handleRenderOverlay = async () => {
+    setIsLoading(true);
+    setError("");
+    try {
+      const response = await api.post(`/predictions/${result.id}/overlay`);
+      setResult({ ...result, ...response.data });
+    } catch (err) {
+      setError(
+        "Overlay rendering failed: " +
+          (err.response?.data?.detail || err.message)
+      );
+    } finally {
+      setIsLoading(false);
+    }
+  };
+
   return (
     <div style={{ display: "flex", alignItems: "flex-start", gap: "20px" }}>
       {/* Form Section */}
@@ -135,11 +151,18 @@ function PredictPage() {
             <p>
               <strong>Reason:</strong> {result.reason}
             </p>
-            <img
-              src={`${api.defaults.baseURL}/${result.image_url}`}
-              alt="Prediction Overlay"
-              style={{ maxWidth: "100%", marginTop: "20px" }}
-            />
+            {result.overlay_pending ? (
+              // The server skipped the overlay under load; it can be rendered on demand
+              <button onClick={handleRenderOverlay} disabled={isLoading}>
+                {isLoading ? "Rendering..." : "Show Model Focus Overlay"}
+              </button>
+            ) : (
+              <img
+                src={mediaUrl(result.image_url)}
+                alt="Prediction Overlay"
+                style={{ maxWidth: "100%", marginTop: "20px" }}
+              />
+            )}
           </div>
         )}
       </div>